@@ -0,0 +1,93 @@
+import io
+from os import PathLike
+from typing import IO, BinaryIO, Iterator, Optional, Tuple, Union
+import numpy as np
+import soundfile
+import soxr
+
+from stem_continuation_dataset_generator.utils.pcm import BUFFER_POOL, clip_float, planar_view
+
+# Audio is decoded and encoded in-process with libsndfile, instead of spawning an ffmpeg process per file
+OPUS_SAMPLE_RATES = [8000, 12000, 16000, 24000, 48000]
+OPUS_SAMPLE_RATE = 48000
+DEFAULT_OPUS_BITRATE_PER_CHANNEL = 48000  # Same as the ffmpeg libopus default for stereo files (96 kbps)
+WRITE_BLOCK_SIZE = 2**15  # In frames, large writes can crash the libsndfile Ogg encoder
+
+# libsndfile maps its compression level linearly to an Opus bitrate per channel in this range
+LIBSNDFILE_OPUS_MIN_BITRATE_PER_CHANNEL = 6000
+LIBSNDFILE_OPUS_MAX_BITRATE_PER_CHANNEL = 256000
+
+AudioFile = Union[BinaryIO, IO[bytes], str, PathLike]
+
+
+def read_audio(file: AudioFile) -> Tuple[np.ndarray, int]:
+    # Returns a float32 array with shape (channels, samples), as a view on the decoded interleaved samples
+    audio, sr = soundfile.read(file, dtype='float32', always_2d=True)
+    return planar_view(audio), sr
+
+
+def get_audio_info(file: AudioFile) -> Tuple[int, int]:
+    # Sample rate and number of channels, read from the header without decoding the audio
+    info = soundfile.info(file)
+    return info.samplerate, info.channels
+
+
+def read_blocks(file: AudioFile, block_size: int = WRITE_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    # Decodes the file a block at a time, as float32 arrays with shape (channels, frames)
+    with soundfile.SoundFile(file) as audio_file:
+        for block in audio_file.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+            yield planar_view(block)
+
+
+def get_opus_sample_rate(sample_rate: int) -> int:
+    return sample_rate if sample_rate in OPUS_SAMPLE_RATES else OPUS_SAMPLE_RATE
+
+
+def get_compression_level(bitrate: int, channels: int) -> float:
+    min_bitrate, max_bitrate = LIBSNDFILE_OPUS_MIN_BITRATE_PER_CHANNEL, LIBSNDFILE_OPUS_MAX_BITRATE_PER_CHANNEL
+    bitrate_per_channel = min(max(bitrate / channels, min_bitrate), max_bitrate)
+    return (max_bitrate - bitrate_per_channel) / (max_bitrate - min_bitrate)
+
+
+def get_blocks(audio: np.ndarray, block_size: int = WRITE_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    for start in range(0, audio.shape[1], block_size):
+        yield audio[:, start:start + block_size]
+
+
+def write_ogg_blocks(file: AudioFile, blocks: Iterator[np.ndarray], sample_rate: int, channels: int, bitrate: Optional[int] = None) -> None:
+    """
+    Encodes blocks with shape (channels, frames) to Ogg Opus. Opus only supports a few sample rates, so other rates are
+    resampled to 48 kHz on the fly (ffmpeg does the same).
+    """
+    output_sample_rate = get_opus_sample_rate(sample_rate)
+    resampler = soxr.ResampleStream(sample_rate, output_sample_rate, channels, dtype='float32') if output_sample_rate != sample_rate else None
+    bitrate = bitrate if bitrate is not None else DEFAULT_OPUS_BITRATE_PER_CHANNEL * channels
+    compression_level = get_compression_level(bitrate, channels)
+
+    with soundfile.SoundFile(file, 'w', output_sample_rate, channels, 'OPUS', format='OGG', compression_level=compression_level) as output_file:
+        for block in blocks:
+            # Blocks are clipped and interleaved in a single pass, into a buffer reused across blocks and files
+            buffer = BUFFER_POOL.get('ogg', (block.shape[1], channels), np.dtype(np.float32))
+            clip_float(block, out=planar_view(buffer))
+            output_file.write(resampler.resample_chunk(buffer) if resampler is not None else buffer)
+
+        if resampler is not None:
+            output_file.write(resampler.resample_chunk(np.zeros((0, channels), dtype=np.float32), last=True))
+
+
+def write_ogg(file: AudioFile, audio: np.ndarray, sample_rate: int, bitrate: Optional[int] = None) -> None:
+    # The audio is a float32 array with shape (channels, samples)
+    write_ogg_blocks(file, get_blocks(audio), sample_rate, audio.shape[0], bitrate)
+
+
+def encode_ogg(audio: np.ndarray, sample_rate: int, bitrate: Optional[int] = None) -> bytes:
+    data = io.BytesIO()
+    write_ogg(data, audio, sample_rate, bitrate)
+    return data.getvalue()
+
+
+def transcode_to_ogg(input_file: AudioFile, output_file: AudioFile, bitrate: Optional[int] = None) -> None:
+    # Streams the input to Ogg Opus a block at a time, so that memory usage does not depend on the length of the file
+    with soundfile.SoundFile(input_file) as audio_file:
+        blocks = audio_file.blocks(blocksize=WRITE_BLOCK_SIZE, dtype='float32', always_2d=True)
+        write_ogg_blocks(output_file, (planar_view(block) for block in blocks), audio_file.samplerate, audio_file.channels, bitrate)
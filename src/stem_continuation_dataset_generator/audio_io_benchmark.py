@@ -0,0 +1,50 @@
+import io
+import time
+from typing import Callable
+import numpy as np
+from pydub import AudioSegment
+
+from stem_continuation_dataset_generator.audio_io import encode_ogg, read_audio
+
+SAMPLE_RATE = 48000
+DURATIONS = [5, 60]  # In seconds
+REPETITIONS = 10
+
+
+def decode_and_encode_with_pydub(data: bytes) -> bytes:
+    # Previous implementation: ffmpeg processes to decode and encode, converting to int16 in between
+    segment = AudioSegment.from_ogg(io.BytesIO(data))  # type: ignore
+    audio = np.array(segment.get_array_of_samples()).reshape((-1, segment.channels)).T.astype(np.float32) / 2**15
+    samples = (np.clip(audio, -1, 1).T.reshape(-1) * (2**15 - 1)).astype(np.int16)
+    output = io.BytesIO()
+    AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=segment.frame_rate, channels=segment.channels).export(output, format='ogg', codec='libopus')
+    return output.getvalue()
+
+
+def decode_and_encode_in_process(data: bytes) -> bytes:
+    audio, sample_rate = read_audio(io.BytesIO(data))
+    return encode_ogg(audio, sample_rate)
+
+
+def benchmark(name: str, decode_and_encode: Callable[[bytes], bytes], data: bytes, duration: int) -> None:
+    decode_and_encode(data)  # Warm up
+    start = time.perf_counter()
+
+    for _ in range(REPETITIONS):
+        decode_and_encode(data)
+
+    elapsed = time.perf_counter() - start
+    print(f'{name} ({duration} s): {elapsed / REPETITIONS * 1000:.0f} ms per file, {duration * REPETITIONS / elapsed:.1f} audio seconds per second')
+
+
+def benchmark_audio_io() -> None:
+    rng = np.random.default_rng(0)
+
+    for duration in DURATIONS:
+        data = encode_ogg(rng.uniform(-0.5, 0.5, (2, SAMPLE_RATE * duration)).astype(np.float32), SAMPLE_RATE)
+        benchmark('pydub', decode_and_encode_with_pydub, data, duration)
+        benchmark('audio_io', decode_and_encode_in_process, data, duration)
+
+
+if __name__ == '__main__':
+    benchmark_audio_io()
@@ -0,0 +1,46 @@
+import io
+
+import numpy as np
+import soundfile
+
+from stem_continuation_dataset_generator.audio_io import OPUS_SAMPLE_RATE, encode_ogg, read_audio, transcode_to_ogg
+
+DURATION = 2  # In seconds
+
+
+def get_sine(sample_rate: int, channels: int) -> np.ndarray:
+    time = np.arange(sample_rate * DURATION) / sample_rate
+    return np.repeat(0.5 * np.sin(2 * np.pi * 440 * time)[None, :], channels, axis=0).astype(np.float32)
+
+
+def test_encode_ogg() -> None:
+    audio = get_sine(OPUS_SAMPLE_RATE, 2)
+
+    decoded_audio, sample_rate = read_audio(io.BytesIO(encode_ogg(audio, OPUS_SAMPLE_RATE)))
+
+    assert sample_rate == OPUS_SAMPLE_RATE
+    assert decoded_audio.dtype == np.float32
+    assert decoded_audio.shape == audio.shape
+    assert abs(np.sqrt(np.mean(decoded_audio ** 2)) - np.sqrt(np.mean(audio ** 2))) < 0.01
+
+
+def test_encode_ogg_resamples_unsupported_rates() -> None:
+    audio = get_sine(44100, 1)
+
+    decoded_audio, sample_rate = read_audio(io.BytesIO(encode_ogg(audio, 44100)))
+
+    assert sample_rate == OPUS_SAMPLE_RATE
+    assert decoded_audio.shape == (1, OPUS_SAMPLE_RATE * DURATION)
+
+
+def test_transcode_to_ogg() -> None:
+    wav_file = io.BytesIO()
+    soundfile.write(wav_file, get_sine(44100, 2).T, 44100, format='WAV')
+    wav_file.seek(0)
+    ogg_file = io.BytesIO()
+
+    transcode_to_ogg(wav_file, ogg_file, bitrate=160000)
+
+    info = soundfile.info(io.BytesIO(ogg_file.getvalue()))
+    assert (info.format, info.subtype, info.channels) == ('OGG', 'OPUS', 2)
+    assert info.frames == OPUS_SAMPLE_RATE * DURATION
@@ -1,33 +1,126 @@
-from typing import List, Tuple, Union
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Union
 import coiled
 import dask.config
-from dask.distributed import Client, LocalCluster
+from dask.distributed import Client, LocalCluster, WorkerPlugin
+from dask.system import CPU_COUNT
+from distributed.system import MEMORY_LIMIT
 
+from stem_continuation_dataset_generator.codec import CodecPreloader
 from stem_continuation_dataset_generator.constants import DASK_CLUSTER_NAME
 
 NUM_WORKERS = [4, 50]
 
+# Worker pools, named after the Dask worker resource carried by their workers. Tasks declare the pool they run on by
+# requiring one unit of its resource
+CPU_DSP_POOL = 'cpu-dsp'
+ENCODER_POOL = 'encoder'
 
-def get_client(
-    run_locally: bool = False,
-    n_workers: Union[int, List[int]] = NUM_WORKERS,
-    **kwargs,
-) -> Union[Client, Tuple[Client, str]]:
+# Units of its pool resource carried by each worker. The resources only route the tasks to the pools, the number of tasks
+# running at once on a worker is limited by its threads
+POOL_RESOURCE_CAPACITY = 1024
 
-    dask.config.set({'distributed.scheduler.allowed-failures': 12})
+CLUSTER_IDLE_TIMEOUT = '20 minutes'
+
+LOCAL_WORKER_MEMORY = 4 * 1024 * 1024 * 1024  # In bytes, memory needed by a local single-threaded worker
+
+
+@dataclass
+class WorkerPool:
+    n_workers: Union[int, List[int]]  # A range makes the pool scale adaptively, independently of the other pools
+    local_workers: Optional[int] = None  # Number of workers of the pool when running locally, by default the cores left by the other pools
+    options: Dict[str, Any] = field(default_factory=dict)  # Coiled options of the pool, e.g. the VM types of its workers
+    plugins: List[WorkerPlugin] = field(default_factory=list)  # Plugins set up on the workers of the pool when they start
+
+
+WORKER_POOLS: Dict[str, WorkerPool] = {
+    CPU_DSP_POOL: WorkerPool(n_workers=NUM_WORKERS),
+    ENCODER_POOL: WorkerPool(
+        n_workers=[1, 6],
+        local_workers=1,
+        plugins=[CodecPreloader(ENCODER_POOL)],
+        options={
+            'worker_vm_types': ['g4dn.xlarge'],
+            'scheduler_vm_types': ['t3.medium'],
+            'spot_policy': 'spot',
+            'use_best_zone': True,
+        },
+    ),
+}
+
+# Clients of the clusters created by this process, by pool (or a single one, shared by all the pools, when running locally)
+CLIENTS: Dict[str, Client] = {}
+LOCAL_CLUSTER_KEY = 'local'
+
+
+def get_pool_resources(pool_name: str) -> Dict[str, float]:
+    return {pool_name: 1}
+
+
+def get_local_workers_count(worker_memory: int = LOCAL_WORKER_MEMORY) -> int:
+    # One single-threaded worker per core, as long as the memory of the machine allows it
+    return max(1, min(CPU_COUNT, MEMORY_LIMIT // worker_memory))
 
-    if run_locally is True:
-        cluster = LocalCluster(n_workers=2, threads_per_worker=1)
 
-    else:
-        cluster = coiled.Cluster(
-            name=DASK_CLUSTER_NAME,
-            n_workers=n_workers,
-            package_sync_conda_extras=['portaudio', 'ffmpeg'],
-            idle_timeout="5 minutes",
-            **kwargs,
-        )
+def get_local_pool_sizes(pools: Dict[str, WorkerPool]) -> Dict[str, int]:
+    fixed_workers = sum([pool.local_workers for pool in pools.values() if pool.local_workers is not None])
+    remaining_workers = max(1, get_local_workers_count() - fixed_workers)
+    return {pool_name: pool.local_workers if pool.local_workers is not None else remaining_workers for pool_name, pool in pools.items()}
+
+
+def get_local_cluster(pools: Dict[str, WorkerPool] = WORKER_POOLS, processes: bool = True) -> LocalCluster:
+    """
+    Single local cluster sized to the cores and memory of the machine, whose workers carry the resources of their pools
+    like the workers of the remote pools. Worker processes limit their BLAS and OpenMP threads to one, as configured by
+    the distributed.nanny.pre-spawn-environ setting of Dask.
+    """
+    pool_sizes = get_local_pool_sizes(pools)
+    memory_limit = MEMORY_LIMIT // sum(pool_sizes.values())
+    cluster = LocalCluster(n_workers=0, threads_per_worker=1, processes=processes, memory_limit=memory_limit, dashboard_address=':0')
+    worker_spec = next(iter(cluster.new_worker_spec().values()))
+
+    for pool_name, pool_size in pool_sizes.items():
+        for i in range(pool_size):
+            options = {**worker_spec['options'], 'resources': {pool_name: POOL_RESOURCE_CAPACITY}}
+            cluster.worker_spec[f'{pool_name}-{i}'] = {'cls': worker_spec['cls'], 'options': options}
+
+    cluster.scale(len(cluster.worker_spec))
+    return cluster
+
+
+def get_coiled_cluster(pool_name: str, pool: WorkerPool) -> coiled.Cluster:
+    # A running cluster with the same name is reused, so consecutive stages and runs do not pay its startup again
+    return coiled.Cluster(
+        name=f'{DASK_CLUSTER_NAME}-{pool_name}',
+        n_workers=pool.n_workers,
+        worker_options={'resources': {pool_name: POOL_RESOURCE_CAPACITY}},
+        package_sync_conda_extras=['portaudio', 'ffmpeg'],
+        idle_timeout=CLUSTER_IDLE_TIMEOUT,
+        shutdown_on_close=False,
+        **pool.options,
+    )
+
+
+def get_pool_client(pool_name: str, run_locally: bool = False) -> Client:
+    """
+    Returns the client of the cluster running the pool, creating the cluster on first use. Each remote pool is a
+    long-lived Coiled cluster, locally all the pools are workers of the same cluster. The plugins of the pools are
+    registered on creation, they also run on the workers started later on.
+    """
+    dask.config.set({'distributed.scheduler.allowed-failures': 12})
+    key = LOCAL_CLUSTER_KEY if run_locally is True else pool_name
+
+    if key not in CLIENTS:
+        if run_locally is True:
+            cluster = get_local_cluster()
+            CLIENTS[key] = cluster.get_client()
+            CLIENTS[key].wait_for_workers(len(cluster.worker_spec))
+            plugins = [plugin for pool in WORKER_POOLS.values() for plugin in pool.plugins]
+        else:
+            CLIENTS[key] = get_coiled_cluster(pool_name, WORKER_POOLS[pool_name]).get_client()
+            plugins = WORKER_POOLS[pool_name].plugins
 
-    client = cluster.get_client()
+        for plugin in plugins:
+            CLIENTS[key].register_plugin(plugin)
 
-    return client
\ No newline at end of file
+    return CLIENTS[key]
@@ -0,0 +1,16 @@
+from dask.distributed import get_worker
+
+from stem_continuation_dataset_generator.cluster import CPU_DSP_POOL, ENCODER_POOL, get_local_cluster, get_pool_resources
+
+
+def get_worker_name(_: int) -> str:
+    return str(get_worker().name)
+
+
+def test_local_cluster_routes_tasks_to_pools() -> None:
+    with get_local_cluster(processes=False) as cluster, cluster.get_client() as client:
+        client.wait_for_workers(len(cluster.worker_spec))
+
+        for pool_name in [CPU_DSP_POOL, ENCODER_POOL]:
+            worker_names = client.gather(client.map(get_worker_name, range(8), resources=get_pool_resources(pool_name), pure=False))
+            assert all([worker_name.startswith(f'{pool_name}-') for worker_name in worker_names])
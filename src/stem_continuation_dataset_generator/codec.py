@@ -1,36 +1,198 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import fcntl
 from functools import lru_cache
 import math
+import os
 from os import PathLike
+import shutil
+import tempfile
+from accelerate import init_empty_weights
+from dask.distributed import Worker, WorkerPlugin
 import librosa.util
-from transformers import EncodecModel, AutoProcessor
+import numpy as np
+import soundfile
+import transformers
+from transformers import EncodecConfig, EncodecModel, AutoProcessor
 from encodec.utils import convert_audio
 import torchaudio
 import torch
 from torch import Tensor
-from typing import BinaryIO, List, Optional, Tuple, Union
+from typing import Any, BinaryIO, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from stem_continuation_dataset_generator.utils.device import Device
+from stem_continuation_dataset_generator.utils.device import Device, get_device
 
 ENCODER_BATCH_SIZE = 1
 ENCODED_TOKENS_PER_CHUNK = 512  # large values (over 1024) require a large amount of memory and can produce OOM errors
+STREAM_BLOCK_SIZE = 2**16  # Number of samples decoded at a time when streaming
+CODEC_MODEL_NAME = "facebook/encodec_32khz"
+
+
+@dataclass(frozen=True)
+class CpuInference:
+    quantize: bool = True  # Dynamic int8 quantization of the LSTM and linear layers of the encoder
+    compile: bool = False  # Compiles the encoder with torch.compile, each new chunk length pays for a compilation
+    threads: Optional[int] = None  # Intra-op threads of the encoder, by default the threads the process is pinned to (see utils/threads.py)
+
+
+# Set to CpuInference() to encode with the optimized CPU inference mode when running on CPU. Its tokens can differ from
+# the ones of the reference fp32 model, see codec_benchmark.py
+CPU_INFERENCE: Optional[CpuInference] = None
+FP32_INFERENCE = CpuInference(quantize=False)  # The reference fp32 model, whatever CPU_INFERENCE is set to
+
+# Directories of the codec weights shared by the processes of a host, by preference. /dev/shm is kept in memory but can
+# be small (64 MB by default in Docker), files of the temporary directory are shared through the page cache as well
+SHARED_WEIGHTS_DIRECTORIES = [directory for directory in ['/dev/shm', tempfile.gettempdir()] if os.path.isdir(directory)]
+SHARED_WEIGHTS_FREE_SPACE_MARGIN = 64 * 1024 * 1024  # In bytes, space left free in the directory of the shared weights
+
+# Whether this process loads the CPU codec from the shared weights, which outlive it. Only enabled in the workers of
+# the pools, through enable_shared_weights, other processes load their own copy of the weights
+SHARE_WEIGHTS = False
+
+
+def enable_shared_weights() -> None:
+    # Must be called before the codec is first loaded by the process
+    global SHARE_WEIGHTS
+    SHARE_WEIGHTS = True
+
+
+def get_shared_weights_name(config: EncodecConfig) -> str:
+    # The revision of the model and the version of transformers are part of the name, so that upgrades do not reuse stale weights
+    return f'{CODEC_MODEL_NAME.replace("/", "--")}-{config._commit_hash}-transformers{transformers.__version__}.pt'
+
+
+def find_shared_weights(directories: List[str], name: str) -> Optional[str]:
+    paths = [os.path.join(directory, name) for directory in directories]
+    return next((path for path in paths if os.path.exists(path)), None)
+
+
+def save_shared_weights(directories: List[str], name: str) -> str:
+    """
+    Saves the weights in the first directory with enough free space and returns their path. The weights are written by
+    the first process of the host, the other ones wait for it and reuse its file.
+    """
+    with open(os.path.join(directories[0], name + '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        path = find_shared_weights(directories, name)
+
+        if path is not None:
+            return path
+
+        state_dict = EncodecModel.from_pretrained(CODEC_MODEL_NAME, normalize=False).state_dict()
+        size = sum([tensor.numel() * tensor.element_size() for tensor in state_dict.values()])
+
+        for directory in directories:
+            if shutil.disk_usage(directory).free < size + SHARED_WEIGHTS_FREE_SPACE_MARGIN:
+                continue
+
+            path = os.path.join(directory, name)
+
+            try:
+                torch.save(state_dict, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                return path
+            except OSError as e:
+                print(f'Unable to save the codec weights to {directory}: {e}')
+                if os.path.exists(path + '.tmp'):
+                    os.remove(path + '.tmp')
+
+        raise OSError(f'Not enough space to save the codec weights in {directories}')
+
+
+def load_shared_codec(directories: List[str] = SHARED_WEIGHTS_DIRECTORIES) -> EncodecModel:
+    """
+    Loads the codec on CPU with its weights memory-mapped from a file shared by the processes of the host, so that the
+    weights are loaded once per host and their memory is shared by the processes rather than copied by each of them.
+    """
+    config = EncodecConfig.from_pretrained(CODEC_MODEL_NAME, normalize=False)
+    name = get_shared_weights_name(config)
+    path = find_shared_weights(directories, name) or save_shared_weights(directories, name)
+
+    # Only the buffers are allocated, the parameters are replaced by the mapped weights
+    with init_empty_weights(include_buffers=False):
+        model = EncodecModel(config)
+
+    model.load_state_dict(torch.load(path, mmap=True, weights_only=True), assign=True)
+    return model
+
+
+def load_cpu_codec() -> EncodecModel:
+    if SHARE_WEIGHTS:
+        try:
+            return load_shared_codec()
+        except OSError as e:
+            # The process loads its own copy of the weights instead
+            print(f'Unable to share the codec weights: {e}')
+
+    return EncodecModel.from_pretrained(CODEC_MODEL_NAME, normalize=False)
 
 
 @lru_cache(maxsize=1)
 def get_codec(device: Device):
     print(f'Encoding using device {device}')
-    model = EncodecModel.from_pretrained("facebook/encodec_32khz", normalize=False, device_map=device)
+
+    if device == 'cpu':
+        return load_cpu_codec().eval()
+
+    model = EncodecModel.from_pretrained(CODEC_MODEL_NAME, normalize=False, device_map=device)
     # print(model.config)
     return model.to(device).eval()
 
 
+@lru_cache(maxsize=2)
+def get_cpu_codec(cpu_inference: CpuInference) -> EncodecModel:
+    """
+    Returns the codec optimized for CPU inference. PyTorch only quantizes the LSTM and linear layers dynamically, the
+    convolutions of the encoder keep running in fp32. The decoder is left untouched.
+    """
+    model = load_cpu_codec().eval()
+
+    # Workers are already pinned to their share of the cores of the host, only an explicit setting overrides it
+    if cpu_inference.threads is not None:
+        torch.set_num_threads(cpu_inference.threads)
+
+    if cpu_inference.quantize:
+        model.encoder = torch.ao.quantization.quantize_dynamic(model.encoder, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+
+    if cpu_inference.compile:
+        model.encoder = torch.compile(model.encoder)
+
+    return model
+
+
+def get_encoding_codec(device: Device, cpu_inference: Optional[CpuInference] = None):
+    # Resolved when called rather than when defined, so that changes of CPU_INFERENCE apply to the default
+    cpu_inference = cpu_inference if cpu_inference is not None else CPU_INFERENCE
+
+    if device != 'cpu' or cpu_inference is None or cpu_inference == FP32_INFERENCE:
+        return get_codec(device)
+
+    return get_cpu_codec(cpu_inference)
+
+
+def get_codec_params() -> Dict[str, Any]:
+    # Parameters of the codec affecting the tokens, recorded in the manifests of the steps encoding audio
+    params: Dict[str, Any] = {'codec_model_name': CODEC_MODEL_NAME}
+
+    if CPU_INFERENCE is not None:
+        params['cpu_inference'] = {'quantize': CPU_INFERENCE.quantize, 'compile': CPU_INFERENCE.compile}
+
+    return params
+
+
 @lru_cache(maxsize=1)
 def get_processor(device: Device):
-    return AutoProcessor.from_pretrained("facebook/encodec_32khz", device_map=device)
+    return AutoProcessor.from_pretrained(CODEC_MODEL_NAME, device_map=device)
+
+
+def load_audio(audio_path: Union[BinaryIO, str, PathLike], format: Optional[str] = None) -> Tuple[Tensor, int]:
+    return torchaudio.load(audio_path, format=format, normalize=False)  # Normalization is later performed using librosa as it seems to work better
 
 
 def encode_file(audio_path: Union[BinaryIO, str, PathLike], device: Device, format: Optional[str] = None, batch_size: int = ENCODER_BATCH_SIZE) -> Tuple[Tensor, float]:
     # Load and pre-process the audio waveform
-    wav, sr = torchaudio.load(audio_path, format=format, normalize=False)  # Normalization is later performed using librosa as it seems to work better
+    wav, sr = load_audio(audio_path, format=format)
     return encode(wav, sr, device, batch_size=batch_size)
 
 
@@ -57,54 +219,250 @@ def chunk_list(lst, n: int):
         yield lst[i:i + n]
 
 
-def encode(audio: Tensor, sr: int, device: Device, batch_size: int = ENCODER_BATCH_SIZE) -> Tuple[Tensor, float]:
+def get_samples_per_chunk(frame_rate: int, sampling_rate: int) -> int:
+
+    return math.ceil((ENCODED_TOKENS_PER_CHUNK / frame_rate) * sampling_rate)
+
+
+def preprocess(audio: Tensor, sr: int, sampling_rate: int, audio_channels: int) -> Tensor:
+
+    wav = convert_audio(audio, sr, sampling_rate, audio_channels)
+    return normalize_audio(wav)
 
-    device = device if not device.startswith('mps') else 'cpu'  # Encoding is not supported on MPS
-    processor = get_processor(device)
-    codec = get_codec(device)
 
-    wav = convert_audio(audio, sr, processor.sampling_rate, codec.config.audio_channels)
-    wav = normalize_audio(wav)
-    length_in_seconds = wav.shape[1] / processor.sampling_rate
-    frames_no = math.ceil(length_in_seconds * codec.config.frame_rate)
+def split_into_chunks(wav: Tensor, samples_per_chunk: int) -> List[np.ndarray]:
 
-    # split wav in chunks
     num_samples = wav.shape[1]
-    samples_per_chunk = math.ceil((ENCODED_TOKENS_PER_CHUNK / codec.config.frame_rate) * processor.sampling_rate)
     total_chunks = get_total_chunks(samples_per_chunk, num_samples)
     chunks = []
     start_index = 0
 
-    # Split into chunks
     for _ in range(total_chunks):
         end_index = start_index + samples_per_chunk
         chunk = wav[:, start_index:end_index]
         chunks.append(chunk.squeeze(0).numpy())  # Remove the first empty dimension
         start_index = end_index
-    
-    encoded_chunks = []
 
-    # create audio chunks
-    batches: List[List[Tensor]] = list(chunk_list(chunks, batch_size))
+    return chunks
 
-    for batch in batches:
-        inputs = processor(raw_audio=batch, sampling_rate=processor.sampling_rate, return_tensors="pt")
+
+def encode_chunks(chunks: List[np.ndarray], device: Device, cpu_inference: Optional[CpuInference] = None) -> Tensor:
+    processor = get_processor(device)
+    codec = get_encoding_codec(device, cpu_inference)
+
+    with torch.inference_mode():
+        inputs = processor(raw_audio=chunks, sampling_rate=processor.sampling_rate, return_tensors="pt")
         bandwidth = 2.2
         result = codec.encode(inputs["input_values"].to(device), inputs["padding_mask"].to(device), bandwidth=bandwidth)
-        assert result.audio_codes.shape[0] == 1, 'Multiple elements returned by codec encoding, expected one'        
-        sequence = result.audio_codes[0]
-        
-        # Concatenate the batch items into a single sequence
-        batch_size, codebooks, seq_len = sequence.shape
-        result = sequence.permute(1, 0, 2).reshape(codebooks, seq_len * batch_size)
-        encoded_chunks.append(result)
-
-    encoded_audio = concat_chunks(encoded_chunks, device=device)
-
-    # Remove padding from the encoded audio
-    encoded_audio = encoded_audio[:, :frames_no]
-    
-    return encoded_audio, codec.config.frame_rate
+        assert result.audio_codes.shape[0] == 1, 'Multiple elements returned by codec encoding, expected one'
+        return result.audio_codes[0]
+
+
+def encode_batch(
+    audios: Iterable[Tuple[Tensor, int]],
+    device: Device,
+    batch_size: int = ENCODER_BATCH_SIZE,
+    cpu_inference: Optional[CpuInference] = None,
+) -> Iterator[Tuple[Tensor, float]]:
+    """
+    Encodes multiple waveforms, yielding the codes of each one in order. The fixed-size chunks of consecutive waveforms
+    are packed together into batches of `batch_size` chunks, so that short files do not leave most of each forward pass
+    unused. Waveforms are only consumed when their chunks are needed to fill the next batch, and their samples are
+    released as soon as their codes are yielded.
+    """
+    device = device if not device.startswith('mps') else 'cpu'  # Encoding is not supported on MPS
+    processor = get_processor(device)
+    codec = get_encoding_codec(device, cpu_inference)  # Only its configuration is read here
+    samples_per_chunk = get_samples_per_chunk(codec.config.frame_rate, processor.sampling_rate)
+
+    chunks: Deque[Tuple[List[Tensor], np.ndarray]] = deque()  # Chunks waiting for a batch, with the codes of their waveform
+    pending: Deque[Tuple[List[Tensor], int, int]] = deque()  # Codes, number of frames and number of chunks of each waveform
+
+    def encode_next_batch() -> None:
+        batch = [chunks.popleft() for _ in range(min(batch_size, len(chunks)))]
+        sequence = encode_chunks([chunk for _, chunk in batch], device, cpu_inference)
+
+        for j, (encoded_chunks, _) in enumerate(batch):
+            encoded_chunks.append(sequence[j])
+
+    def get_encoded_audios() -> Iterator[Tuple[Tensor, float]]:
+        while len(pending) > 0 and len(pending[0][0]) == pending[0][2]:
+            encoded_chunks, frames_no, _ = pending.popleft()
+            # Remove padding from the encoded audio
+            yield concat_chunks(encoded_chunks, device=device)[:, :frames_no], codec.config.frame_rate
+
+    for audio, sr in audios:
+        wav = preprocess(audio, sr, processor.sampling_rate, codec.config.audio_channels)
+        length_in_seconds = wav.shape[1] / processor.sampling_rate
+        audio_chunks = split_into_chunks(wav, samples_per_chunk)
+        encoded_chunks: List[Tensor] = []
+        pending.append((encoded_chunks, math.ceil(length_in_seconds * codec.config.frame_rate), len(audio_chunks)))
+        chunks.extend([(encoded_chunks, chunk) for chunk in audio_chunks])
+
+        while len(chunks) >= batch_size:
+            encode_next_batch()
+            yield from get_encoded_audios()
+
+    while len(chunks) > 0:
+        encode_next_batch()
+        yield from get_encoded_audios()
+
+    yield from get_encoded_audios()
+
+
+def encode(audio: Tensor, sr: int, device: Device, batch_size: int = ENCODER_BATCH_SIZE, cpu_inference: Optional[CpuInference] = None) -> Tuple[Tensor, float]:
+
+    return next(encode_batch([(audio, sr)], device, batch_size=batch_size, cpu_inference=cpu_inference))
+
+
+def convert_channels(wav: Tensor, channels: int) -> Tensor:
+    # Same channels conversion as encodec.utils.convert_audio
+    if channels == 1:
+        return wav.mean(0, keepdim=True)
+    return wav.expand(channels, -1)
+
+
+def resample_blocks(blocks: Iterator[Tensor], sr: int, target_sr: int) -> Iterator[Tensor]:
+    """
+    Resamples a stream of blocks with the same kernel used by torchaudio.transforms.Resample, keeping the filter context
+    across blocks so that the output matches resampling the whole waveform at once.
+    """
+    resample = torchaudio.transforms.Resample(sr, target_sr)
+
+    if resample.orig_freq == resample.new_freq:
+        yield from blocks
+        return
+
+    orig_freq = resample.orig_freq // resample.gcd
+    new_freq = resample.new_freq // resample.gcd
+    kernel_length = resample.kernel.shape[-1]
+    buffer: Optional[Tensor] = None
+    length = 0
+    emitted_samples = 0
+
+    def apply_kernel(waveform: Tensor) -> Tuple[Tensor, int]:
+        positions = (waveform.shape[-1] - kernel_length) // orig_freq + 1 if waveform.shape[-1] >= kernel_length else 0
+        window = waveform[:, :max(0, (positions - 1) * orig_freq + kernel_length)]
+        resampled = torch.nn.functional.conv1d(window[:, None], resample.kernel, stride=orig_freq)
+        return resampled.transpose(1, 2).reshape(waveform.shape[0], -1), positions
+
+    for block in blocks:
+        length += block.shape[-1]
+        # The beginning of the stream is padded with zeros, as in torchaudio
+        buffer = torch.cat([buffer, block], dim=-1) if buffer is not None else torch.nn.functional.pad(block, (resample.width, 0))
+        resampled, positions = apply_kernel(buffer)
+        buffer = buffer[:, positions * orig_freq:]
+        emitted_samples += resampled.shape[-1]
+        yield resampled
+
+    if buffer is not None:
+        buffer = torch.nn.functional.pad(buffer, (0, resample.width + orig_freq))
+        resampled, _ = apply_kernel(buffer)
+        target_length = math.ceil(new_freq * length / orig_freq)
+        yield resampled[:, :target_length - emitted_samples]
+
+
+def stream_audio(audio_path: Union[BinaryIO, str, PathLike], sampling_rate: int, audio_channels: int, block_size: int = STREAM_BLOCK_SIZE) -> Iterator[Tensor]:
+    # Decodes the file incrementally, converting each block to the codec's number of channels and sample rate
+    with soundfile.SoundFile(audio_path) as audio_file:
+        blocks = (
+            convert_channels(torch.from_numpy(np.ascontiguousarray(block.T)), audio_channels)
+            for block in audio_file.blocks(blocksize=block_size, dtype='float32', always_2d=True)
+        )
+        yield from resample_blocks(blocks, audio_file.samplerate, sampling_rate)
+
+
+def get_peak(audio_path: Union[BinaryIO, str, PathLike], device: Device, block_size: int = STREAM_BLOCK_SIZE) -> np.ndarray:
+    """Returns the peak amplitude of each channel of the audio, once converted to the codec's channels and sample rate."""
+    device = device if not device.startswith('mps') else 'cpu'
+    processor = get_processor(device)
+    codec = get_codec(device)
+    peak = np.zeros(codec.config.audio_channels, dtype=np.float64)
+
+    for block in stream_audio(audio_path, processor.sampling_rate, codec.config.audio_channels, block_size):
+        if block.shape[-1] > 0:
+            peak = np.maximum(peak, block.abs().amax(dim=-1).double().numpy())
+
+    return peak
+
+
+def encode_stream(
+    audio_path: Union[BinaryIO, str, PathLike],
+    device: Device,
+    peak: Optional[np.ndarray] = None,
+    block_size: int = STREAM_BLOCK_SIZE,
+) -> Iterator[Tuple[Tensor, int]]:
+    """
+    Encodes the audio with bounded memory, decoding the input incrementally and yielding a (codebooks, n_frames) block of
+    codes as soon as each chunk of ENCODED_TOKENS_PER_CHUNK tokens is complete. The produced tokens are identical to the
+    ones produced by `encode` with the default batch size.
+
+    The peak amplitude of each channel (see `get_peak`) is required for normalization. When it is not provided, it is
+    computed with a first pass over the audio.
+    """
+    device = device if not device.startswith('mps') else 'cpu'  # Encoding is not supported on MPS
+    processor = get_processor(device)
+    codec = get_codec(device)
+
+    if peak is None:
+        peak = get_peak(audio_path, device, block_size)
+        if not isinstance(audio_path, (str, PathLike)):
+            audio_path.seek(0)
+
+    # As in librosa.util.normalize, channels that are (almost) completely silent are left untouched
+    norm = torch.tensor(np.where(peak < np.finfo(np.float32).tiny, 1.0, peak), dtype=torch.float64)[:, None]
+    samples_per_chunk = get_samples_per_chunk(codec.config.frame_rate, processor.sampling_rate)
+    buffer = torch.zeros((codec.config.audio_channels, 0), dtype=torch.float32)
+    total_samples = 0
+    emitted_frames = 0
+
+    def encode_buffered_chunk(chunk: Tensor) -> Tensor:
+        normalized_chunk = (chunk.double() / norm).float()
+        return encode_chunks([normalized_chunk.squeeze(0).numpy()], device)[0]
+
+    for block in stream_audio(audio_path, processor.sampling_rate, codec.config.audio_channels, block_size):
+        total_samples += block.shape[-1]
+        buffer = torch.cat([buffer, block], dim=-1)
+
+        while buffer.shape[-1] >= samples_per_chunk:
+            codes = encode_buffered_chunk(buffer[:, :samples_per_chunk])
+            buffer = buffer[:, samples_per_chunk:]
+            emitted_frames += codes.shape[-1]
+            yield codes, codes.shape[-1]
+
+    frames_no = math.ceil(total_samples / processor.sampling_rate * codec.config.frame_rate)
+
+    if buffer.shape[-1] > 0:
+        # Remove padding from the encoded audio
+        codes = encode_buffered_chunk(buffer)[:, :frames_no - emitted_frames]
+        yield codes, codes.shape[-1]
+
+
+def warm_up_codec(device: Device) -> None:
+    """Loads the codec and runs a forward pass on a chunk of silence, so that the first task does not pay for them."""
+    device = device if not device.startswith('mps') else 'cpu'
+    processor = get_processor(device)
+    codec = get_encoding_codec(device)
+    samples_per_chunk = get_samples_per_chunk(codec.config.frame_rate, processor.sampling_rate)
+    encode_chunks(split_into_chunks(torch.zeros((codec.config.audio_channels, samples_per_chunk)), samples_per_chunk), device)
+
+
+class CodecPreloader(WorkerPlugin):
+    """
+    Warms up the codec when a worker of the pool starts, loading its weights from the ones shared by the workers of the
+    host when running on CPU. Workers of the other pools of the same cluster are skipped.
+    """
+
+    name = 'codec-preloader'
+
+    def __init__(self, pool_name: str):
+        self.pool_name = pool_name
+
+    async def setup(self, worker: Worker) -> None:
+        if self.pool_name in worker.state.total_resources:
+            enable_shared_weights()
+            # Run outside of the event loop of the worker, which keeps answering the scheduler in the meantime
+            await asyncio.to_thread(warm_up_codec, get_device())
 
 
 def decode(codes: Tensor, device: Device) -> Tuple[Tensor, int]:
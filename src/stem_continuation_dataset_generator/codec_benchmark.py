@@ -0,0 +1,36 @@
+import time
+import torch
+from torch import Tensor
+
+from stem_continuation_dataset_generator.codec import FP32_INFERENCE, CpuInference, encode, load_audio
+
+FILE_PATH = 'resources/audio.ogg'
+REPETITIONS = 3
+
+
+def benchmark(name: str, cpu_inference: CpuInference, audio: Tensor, sr: int, reference_codes: Tensor) -> None:
+    # The first run loads the model and compiles it when required
+    codes, _ = encode(audio, sr, 'cpu', cpu_inference=cpu_inference)
+    start = time.perf_counter()
+
+    for _ in range(REPETITIONS):
+        encode(audio, sr, 'cpu', cpu_inference=cpu_inference)
+
+    elapsed = time.perf_counter() - start
+    duration = audio.shape[-1] / sr
+    agreement = (codes == reference_codes).float().mean().item()
+    print(f'{name}: {duration * REPETITIONS / elapsed:.2f} audio seconds per second, {agreement * 100:.2f}% of the tokens agree with fp32 ({torch.get_num_threads()} threads)')
+
+
+def benchmark_cpu_inference() -> None:
+    audio, sr = load_audio(FILE_PATH)
+    reference_codes, _ = encode(audio, sr, 'cpu', cpu_inference=FP32_INFERENCE)
+
+    benchmark('fp32', FP32_INFERENCE, audio, sr, reference_codes)
+    benchmark('int8 quantization', CpuInference(), audio, sr, reference_codes)
+    benchmark('torch.compile', CpuInference(quantize=False, compile=True), audio, sr, reference_codes)
+    benchmark('int8 quantization and torch.compile', CpuInference(compile=True), audio, sr, reference_codes)
+
+
+if __name__ == '__main__':
+    benchmark_cpu_inference()
@@ -1,7 +1,14 @@
 import math
+import os
+from typing import Iterator, List, Tuple
 
+import pytest
+import soundfile
+import torch
 import torchaudio
-from stem_continuation_dataset_generator.codec import encode_file, get_codec, get_processor
+from transformers import EncodecModel
+from stem_continuation_dataset_generator import codec as codec_module
+from stem_continuation_dataset_generator.codec import CODEC_MODEL_NAME, FP32_INFERENCE, CpuInference, encode, encode_batch, encode_file, encode_stream, get_codec, get_processor, load_cpu_codec, load_shared_codec
 from stem_continuation_dataset_generator.utils.device import get_device
 
 FILE_PATH = 'resources/audio.ogg'
@@ -26,3 +33,76 @@ def test_encode_file():
     
     length_in_seconds = wav.shape[-1] / sr
     assert file.shape[1] == math.ceil(length_in_seconds * frame_rate)
+
+
+def test_encode_batch():
+    wav, sr = torchaudio.load(FILE_PATH, normalize=False)
+    short_wav = wav[:, :sr * 3]
+    encoded_audios = list(encode_batch([(wav, sr), (short_wav, sr)], device, batch_size=4))
+
+    assert len(encoded_audios) == 2
+
+    for (codes, frame_rate), audio in zip(encoded_audios, [wav, short_wav]):
+        assert frame_rate == codec.config.frame_rate
+        assert codes.shape[0] == 4  # Number of codebooks
+        assert codes.shape[1] == math.ceil(audio.shape[-1] / sr * frame_rate)
+
+
+def test_encode_batch_consumes_lazily():
+    wav, sr = torchaudio.load(FILE_PATH, normalize=False)
+    short_wav = wav[:, :sr]
+    consumed: List[int] = []
+
+    def get_audios() -> Iterator[Tuple[torch.Tensor, int]]:
+        for i in range(3):
+            consumed.append(i)
+            yield short_wav, sr
+
+    encoded_audios = encode_batch(get_audios(), device, batch_size=1)
+
+    # Each file fits in a single chunk, so it is yielded before the next file is consumed
+    for i, (codes, _) in enumerate(encoded_audios):
+        assert consumed == list(range(i + 1))
+        assert torch.equal(codes, encode(short_wav, sr, device)[0])
+
+
+def test_encode_stream():
+    audio, sr = soundfile.read(FILE_PATH, dtype='float32', always_2d=True)
+    expected_codes, _ = encode(torch.from_numpy(audio.T.copy()), sr, device)
+
+    blocks = list(encode_stream(FILE_PATH, device, block_size=10_000))
+    codes = torch.cat([block for block, _ in blocks], dim=-1)
+
+    assert sum([frames for _, frames in blocks]) == expected_codes.shape[1]
+    assert torch.equal(codes, expected_codes.to(codes.device))
+
+
+def test_load_shared_codec(tmp_path):
+    expected_weights = EncodecModel.from_pretrained(CODEC_MODEL_NAME, normalize=False).state_dict()
+    weights = load_shared_codec([str(tmp_path)]).state_dict()
+
+    assert weights.keys() == expected_weights.keys()
+    assert all([torch.equal(weights[name], expected_weights[name]) for name in weights])
+    assert len([file_name for file_name in os.listdir(tmp_path) if file_name.endswith('.pt')]) == 1
+
+
+def test_encode_cpu_inference():
+    wav, sr = torchaudio.load(FILE_PATH, normalize=False)
+    expected_codes, _ = encode(wav, sr, 'cpu', cpu_inference=FP32_INFERENCE)
+    codes, _ = encode(wav, sr, 'cpu', cpu_inference=CpuInference())
+
+    assert codes.shape == expected_codes.shape
+    assert (codes == expected_codes).float().mean().item() >= 0.99
+
+
+def test_load_shared_codec_without_directory(tmp_path):
+    # The error makes load_cpu_codec load the weights in the process instead
+    with pytest.raises(OSError):
+        load_shared_codec([str(tmp_path / 'missing')])
+
+
+def test_load_cpu_codec_without_shared_weights(monkeypatch):
+    # Shared weights are only enabled in the workers of the pools
+    monkeypatch.setattr(codec_module, 'load_shared_codec', lambda: pytest.fail('Shared weights loaded without being enabled'))
+
+    assert isinstance(load_cpu_codec(), EncodecModel)
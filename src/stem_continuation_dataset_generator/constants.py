@@ -6,12 +6,21 @@ CLEARML_DATASET_VERSION = '1.0.0'
 DEFAULT_STEM_NAME = 'drum'
 STORAGE_BUCKET_NAME = 'stem-continuation-dataset'
 DASK_CLUSTER_NAME = 'stem-continuation-dataset-generator-cluster'
+RIR_BANK_VERSION = 1  # Increase when the generation parameters of the room impulse response bank change
 
 
 def get_original_files_path():
     return os.path.join(STORAGE_BUCKET_NAME, 'original')
 
 
+def get_silence_index_path():
+    return os.path.join(STORAGE_BUCKET_NAME, 'original-silence-index.json')
+
+
+def get_rir_bank_path(version: int = RIR_BANK_VERSION):
+    return os.path.join(STORAGE_BUCKET_NAME, f'rir-bank-v{version}.npz')
+
+
 def get_merged_files_path(stem_name: str = DEFAULT_STEM_NAME):
     return os.path.join(STORAGE_BUCKET_NAME, stem_name, 'merged')
 
@@ -31,3 +40,6 @@ def get_encoded_files_path(stem_name: str = DEFAULT_STEM_NAME):
 def get_split_files_path(stem_name: str = DEFAULT_STEM_NAME):
     return os.path.join(STORAGE_BUCKET_NAME, stem_name, 'split')
 
+
+def get_packed_files_path(stem_name: str = DEFAULT_STEM_NAME):
+    return os.path.join(STORAGE_BUCKET_NAME, stem_name, 'packed')
@@ -0,0 +1,128 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import queue
+from typing import Any, Callable, Dict, Iterator, List, Literal, Tuple, cast
+from dask.distributed import Client
+from dask.system import CPU_COUNT
+from tqdm import tqdm
+
+from stem_continuation_dataset_generator.cluster import get_local_workers_count, get_pool_client, get_pool_resources
+from stem_continuation_dataset_generator.codec import enable_shared_weights
+from stem_continuation_dataset_generator.utils.retry import retry
+from stem_continuation_dataset_generator.utils.threads import pin_threads
+
+ExecutorBackend = Literal['dask-remote', 'dask-local', 'process-pool']
+
+# Backend running the tasks of the steps: the Coiled worker pools, a Dask cluster on the local machine, or a pool of
+# processes on the local machine, which skips the startup of Dask (e.g. "EXECUTOR_BACKEND=process-pool")
+EXECUTOR_BACKEND = cast(ExecutorBackend, os.environ.get('EXECUTOR_BACKEND', 'dask-remote'))
+
+TASK_RETRIES = 2
+
+# Executors created by this process, by backend and pool
+EXECUTORS: Dict[Tuple[ExecutorBackend, str], 'TaskExecutor'] = {}
+
+
+class TaskExecutor(ABC):
+    """Runs tasks, each a function called with its parameters. Returned futures support add_done_callback, exception and result."""
+
+    @abstractmethod
+    def submit(self, fn: Callable[[Any], Any], params: Any, priority: int = 0) -> Any:
+        pass
+
+
+class DaskExecutor(TaskExecutor):
+
+    def __init__(self, client: Client, resources: Dict[str, float]):
+        self.client = client
+        self.resources = resources
+
+    def submit(self, fn: Callable[[Any], Any], params: Any, priority: int = 0) -> Any:
+        return self.client.submit(fn, params, retries=TASK_RETRIES, priority=priority, resources=self.resources, pure=False)
+
+
+def call_with_retries(fn: Callable[[Any], Any], params: Any, attempts: int) -> Any:
+    return retry(lambda: fn(params), f'Task {fn.__name__}', attempts)
+
+
+def init_worker(threads: int) -> None:
+    pin_threads(threads)
+    # The processes of the pool run the tasks of all the pools, the encoding ones included
+    enable_shared_weights()
+
+
+class ProcessPoolTaskExecutor(TaskExecutor):
+    """
+    Runs the tasks in a pool of processes, without a scheduler. Processes are spawned rather than forked, since the
+    parent process runs threads (e.g. the event loop of s3fs). Tasks run in submission order, priorities are ignored.
+    """
+
+    def __init__(self, processes: int, threads_per_process: int):
+        self.pool = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(threads_per_process,),
+        )
+
+    def submit(self, fn: Callable[[Any], Any], params: Any, priority: int = 0) -> Any:
+        return self.pool.submit(call_with_retries, fn, params, TASK_RETRIES + 1)
+
+
+class CompletedFutures:
+    """Iterates over futures in completion order, for any backend. Futures can be added while iterating."""
+
+    def __init__(self) -> None:
+        self.completed: 'queue.Queue[Any]' = queue.Queue()
+        self.pending = 0
+
+    def add(self, future: Any) -> None:
+        self.pending += 1
+        future.add_done_callback(self.completed.put)
+
+    def __iter__(self) -> Iterator[Any]:
+        while self.pending > 0:
+            future = self.completed.get()
+            self.pending -= 1
+            yield future
+
+
+def get_process_pool_executor() -> ProcessPoolTaskExecutor:
+    # A process per core, as long as the memory of the machine allows it, sharing the cores equally
+    processes = get_local_workers_count()
+    return ProcessPoolTaskExecutor(processes, max(1, CPU_COUNT // processes))
+
+
+def get_executor(pool_name: str, backend: ExecutorBackend = EXECUTOR_BACKEND) -> TaskExecutor:
+    """Returns the executor of the tasks of a worker pool, created once per process. Local backends share their workers between the pools."""
+    key = (backend, pool_name if backend != 'process-pool' else '')
+
+    if key not in EXECUTORS:
+        if backend == 'process-pool':
+            EXECUTORS[key] = get_process_pool_executor()
+        else:
+            EXECUTORS[key] = DaskExecutor(get_pool_client(pool_name, run_locally=backend == 'dask-local'), get_pool_resources(pool_name))
+
+    return EXECUTORS[key]
+
+
+def run_tasks(executor: TaskExecutor, fn: Callable[[Any], Any], params_list: List[Any], description: str) -> List[Any]:
+    """Runs a task for each parameters, returning the results of the successful ones. Failed tasks are reported and skipped."""
+    futures = CompletedFutures()
+
+    for params in params_list:
+        futures.add(executor.submit(fn, params))
+
+    results: List[Any] = []
+
+    for future in tqdm(futures, total=len(params_list), desc=description):
+        error = future.exception()
+
+        if error is not None:
+            print(f'A task failed: {error}')
+        else:
+            results.append(future.result())
+
+    return results
@@ -0,0 +1,15 @@
+import math
+import os
+
+from stem_continuation_dataset_generator.executor import ProcessPoolTaskExecutor, run_tasks
+
+
+def test_process_pool_run_tasks() -> None:
+    # Task functions are importable from the spawned processes
+    executor = ProcessPoolTaskExecutor(processes=2, threads_per_process=1)
+
+    results = run_tasks(executor, math.sqrt, [4, -1, 9], 'Testing')
+    assert sorted(results) == [2, 3]
+
+    # The thread limits of the processes are set before the tasks run
+    assert run_tasks(executor, os.getenv, ['OMP_NUM_THREADS'], 'Testing') == ['1']
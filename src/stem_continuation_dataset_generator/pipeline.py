@@ -1,41 +1,65 @@
-from stem_continuation_dataset_generator.constants import DATASET_TAGS, get_augmented_files_path, get_distorted_files_path, get_encoded_files_path, get_merged_files_path, get_original_files_path, get_split_files_path
+from typing import Optional
+
+from stem_continuation_dataset_generator.constants import (
+    DATASET_TAGS,
+    get_augmented_files_path,
+    get_distorted_files_path,
+    get_encoded_files_path,
+    get_merged_files_path,
+    get_original_files_path,
+    get_packed_files_path,
+    get_split_files_path,
+)
 from stem_continuation_dataset_generator.steps.augment import augment_all
-from stem_continuation_dataset_generator.steps.convert_to_ogg import convert_to_ogg
 from stem_continuation_dataset_generator.steps.encode import encode_all
+from stem_continuation_dataset_generator.steps.fused import process_all
 from stem_continuation_dataset_generator.steps.merge import assort_and_merge_all
+from stem_continuation_dataset_generator.steps.pack import pack_all
+from stem_continuation_dataset_generator.steps.prepare_archives import prepare_archives
 from stem_continuation_dataset_generator.steps.split import split_all
-from stem_continuation_dataset_generator.steps.uncompress import uncompress_files
+from stem_continuation_dataset_generator.steps.stream import stream_all
 from stem_continuation_dataset_generator.steps.upload import upload
 from stem_continuation_dataset_generator.steps.distort import distort_all
 
 
-def uncompress_step(source_dir: str):
-    output_dir = uncompress_files(source_dir)
-    return output_dir
-
-
-def convert_to_ogg_step(source_dir):
-    output_dir = convert_to_ogg(source_dir)
-    return output_dir
-
-
-def dataset_preparation_pipeline(source_dir: str):
+def dataset_preparation_pipeline(source_dir: str, destination: Optional[str] = None, workers: Optional[int] = None, remove_archives: bool = True):
 
     print(f'Preparing dataset. Source dir: {source_dir}')
 
-    uncompressed_dir = uncompress_step(source_dir)
-    converted_to_ogg_dir = convert_to_ogg_step(uncompressed_dir)
+    # Archives are streamed straight to Ogg Opus, without extracting the wav files to disk
+    converted_to_ogg_dir = prepare_archives(source_dir, destination, workers, remove_archives)
 
     print(f'Succesfully prepared dataset in directory {converted_to_ogg_dir}')
 
 
-def dataset_creation_pipeline(stem_name: str):
+def dataset_creation_pipeline(stem_name: str, fused: bool = False, persist_intermediates: bool = False, streamed: bool = False):
     
     tags = DATASET_TAGS + [f'stem-{stem_name}']
 
-    assort_and_merge_all(get_original_files_path(), get_merged_files_path(stem_name), stem_name)
-    augment_all(get_merged_files_path(stem_name), get_augmented_files_path(stem_name))
-    distort_all(get_augmented_files_path(stem_name), get_distorted_files_path(stem_name))
-    encode_all(get_distorted_files_path(stem_name), get_encoded_files_path(stem_name))
+    if fused is True:
+        intermediate_directories = (
+            (get_merged_files_path(stem_name), get_augmented_files_path(stem_name), get_distorted_files_path(stem_name))
+            if persist_intermediates is True
+            else None
+        )
+        process_all(get_original_files_path(), get_encoded_files_path(stem_name), stem_name, intermediate_directories)
+
+    elif streamed is True:
+        stream_all(
+            get_original_files_path(),
+            get_merged_files_path(stem_name),
+            get_augmented_files_path(stem_name),
+            get_distorted_files_path(stem_name),
+            get_encoded_files_path(stem_name),
+            stem_name,
+        )
+
+    else:
+        assort_and_merge_all(get_original_files_path(), get_merged_files_path(stem_name), stem_name)
+        augment_all(get_merged_files_path(stem_name), get_augmented_files_path(stem_name))
+        distort_all(get_augmented_files_path(stem_name), get_distorted_files_path(stem_name))
+        encode_all(get_distorted_files_path(stem_name), get_encoded_files_path(stem_name))
+
     split_all(get_encoded_files_path(stem_name), get_split_files_path(stem_name))
-    upload(get_split_files_path(stem_name), tags)
+    pack_all(get_split_files_path(stem_name), get_packed_files_path(stem_name))
+    upload(get_packed_files_path(stem_name), tags)
@@ -5,7 +5,10 @@ from stem_continuation_dataset_generator.pipeline import dataset_preparation_pip
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Pre-process and compress audio stems")
     parser.add_argument("source_dir", help="Path to the directory containing the original compressed audio stems.", type=str)
+    parser.add_argument("--destination", help="Path or fsspec URL (e.g. s3://bucket/original) where the converted files are written. Defaults to the source directory.", type=str)
+    parser.add_argument("--workers", help="Number of processes used for the conversion. Defaults to the number of cores.", type=int)
+    parser.add_argument("--keep-archives", help="Do not delete the archives once converted.", action="store_true")
     args = parser.parse_args()
     path = args.source_dir
-    dataset_preparation_pipeline(path)
+    dataset_preparation_pipeline(path, args.destination, args.workers, remove_archives=not args.keep_archives)
     print('Pipeline completed')
\ No newline at end of file
@@ -6,9 +6,12 @@ from stem_continuation_dataset_generator.pipeline import dataset_creation_pipeli
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Create a dataset from an already pre-processed dataset")
     parser.add_argument("stem_name", help="Name of the stem (musical instrument) to process", type=str)
+    parser.add_argument("--fused", help="Merge, augment, distort and encode each song in a single task, keeping the audio in memory", action="store_true")
+    parser.add_argument("--persist-intermediates", help="When running in fused mode, also store the merged, augmented and distorted files", action="store_true")
+    parser.add_argument("--streamed", help="Run merge, augment, distort and encode at the same time, moving each song to the next step as soon as it is ready", action="store_true")
     args = parser.parse_args()
    
     source_dir = get_remote_dataset_by_tag('original')
 
-    dataset_creation_pipeline(args.stem_name)
+    dataset_creation_pipeline(args.stem_name, fused=args.fused, persist_intermediates=args.persist_intermediates, streamed=args.streamed)
     print('Pipeline completed')
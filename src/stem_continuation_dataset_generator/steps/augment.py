@@ -1,58 +1,89 @@
 import io
 import os
-from typing import Any, List, Tuple, cast
-from dask.distributed import Client
-from distributed import progress
+from typing import Dict, FrozenSet, List, Optional, Tuple
 import numpy as np
-from pydub import AudioSegment
 from audiomentations import Compose, PitchShift, TimeStretch, Gain
-import soundfile
 from s3fs.core import S3FileSystem
 
-from stem_continuation_dataset_generator.cluster import get_client
+from stem_continuation_dataset_generator.audio_io import read_audio
+from stem_continuation_dataset_generator.cluster import CPU_DSP_POOL
+from stem_continuation_dataset_generator.executor import get_executor, run_tasks
 from stem_continuation_dataset_generator.constants import get_augmented_files_path, get_merged_files_path
-from stem_continuation_dataset_generator.utils.utils import clamp_audio_data, convert_audio_to_int_16
+from stem_continuation_dataset_generator.steps.merge import export_ogg, load_audio
+from stem_continuation_dataset_generator.utils.manifest import (
+    TaskOutputs,
+    filter_existing,
+    get_manifest_path,
+    get_params_hash,
+    get_pending_items,
+    group_fingerprints,
+    group_sizes,
+    list_files,
+    list_outputs,
+    load_manifest,
+    remove_stale_outputs,
+    update_manifest,
+)
+from stem_continuation_dataset_generator.utils.filesystem import get_filesystem
+from stem_continuation_dataset_generator.utils.partition import partition_by_cost
+from stem_continuation_dataset_generator.utils.prefetch import BackgroundUploader, Inputs, fetch_files, process_prefetched
 
 AUGMENTATIONS_COUNT = 4
 AUGMENT_PITCH = False
+TASK_INPUT_SIZE = 32 * 1024 * 1024  # In bytes, size of the pairs augmented by a task
 
-# Set this flag to True to run locally (i.e. not on Coiled)
-RUN_LOCALLY = False
+# Pool of workers running the tasks of this step
+WORKER_POOL = CPU_DSP_POOL
 
+# Full track files, source directory, output directory and existing outputs of the files
+AugmentParams = Tuple[List[str], str, str, FrozenSet[str]]
 
-def get_full_track_files(fs: S3FileSystem, dir: str) -> List[str]:
-    return cast(List[str], fs.glob(os.path.join(dir, '**/all.ogg')))
+
+def is_track_file(path: str) -> bool:
+    return os.path.basename(path) in ['all.ogg', 'stem.ogg']
+
+
+def get_full_track_file(path: str) -> str:
+    return os.path.join(os.path.dirname(path), 'all.ogg')
+
+
+def list_track_files(fs: S3FileSystem, dir: str) -> Dict[str, str]:
+    return list_files(fs, dir, is_track_file)
+
+
+def get_full_track_fingerprints(files: Dict[str, str]) -> Dict[str, str]:
+    # Each full track is a work item together with its stem, items without a full track are skipped
+    return {file_path: fingerprint for file_path, fingerprint in group_fingerprints(files, get_full_track_file).items() if file_path in files}
+
+
+def get_pair_sizes(files: Dict[str, str], file_paths: List[str]) -> Dict[str, int]:
+    # The size of a full track and its stem is an estimate of the time needed to process them
+    sizes = group_sizes(files, get_full_track_file)
+    return {file_path: sizes[file_path] for file_path in file_paths}
+
+
+def get_augment_params_hash() -> str:
+    return get_params_hash('augment', {'augmentations_count': AUGMENTATIONS_COUNT, 'augment_pitch': AUGMENT_PITCH})
+
+
+def augment_audio(audio: np.ndarray, sr: int, transform: Compose) -> np.ndarray:
+    augmented_audio = transform(audio, sample_rate=sr)
+    length = augmented_audio.shape[1]
+    correct_length = length - (length % (augmented_audio.dtype.itemsize * sr))
+    return augmented_audio[:, :correct_length]
 
 
 def augment_files(fs: S3FileSystem, file_paths: List[Tuple[str, str]], transform: Compose) -> None:
 
     for file_path, output_file_path in file_paths:
-        with fs.open(file_path, 'rb') as input_file:
-            data = io.BytesIO(input_file.read())  # type: ignore
-            audio, sr = soundfile.read(data, dtype='float32')
-            audio = cast(np.ndarray[Any, np.dtype[np.float32]], audio)
-            channels = audio.shape[1]
-            audio = np.transpose(audio)
-            augmented_audio = audio
-            augmented_audio = transform(audio, sample_rate=sr)
-            transform.freeze_parameters()
-            length = augmented_audio.shape[1]
-            correct_length = length - (length % (augmented_audio.dtype.itemsize * sr))
-            augmented_audio = augmented_audio[:, :correct_length]
-            augmented_audio = np.transpose(augmented_audio).reshape(-1)
-            augmented_audio = convert_audio_to_int_16(clamp_audio_data(augmented_audio))
-            # Using AudioSegment to save to file as soundfile presents a bug with saving in OGG format
-            segment = AudioSegment(data=augmented_audio, sample_width=augmented_audio.dtype.itemsize, frame_rate=sr, channels=channels)
-
-            # Export the final merged track to a single .ogg file
-            with fs.open(output_file_path, 'wb') as output_file:
-                bytes_io = io.BytesIO()
-                segment.export(bytes_io, format='ogg', codec='libopus')  # type: ignore
-                output_file.write(bytes_io.getvalue())  # type: ignore
+        audio, sr = load_audio(fs, file_path)
+        augmented_audio = augment_audio(audio, sr, transform)
+        transform.freeze_parameters()
+        export_ogg(fs, augmented_audio, sr, output_file_path)
 
 
-def augment_pitch_and_tempo(fs, file_paths: List[Tuple[str, str]]) -> None:
-    transform = Compose(
+def get_augmentation_transform() -> Compose:
+    return Compose(
         transforms=[
             PitchShift(p=1 if AUGMENT_PITCH is True else 0, min_semitones=-2, max_semitones=2),
             TimeStretch(p=1, leave_length_unchanged=False),
@@ -61,68 +92,156 @@ def augment_pitch_and_tempo(fs, file_paths: List[Tuple[str, str]]) -> None:
         p=1,
     )
 
-    augment_files(fs, file_paths, transform)
 
+def augment_pitch_and_tempo(fs, file_paths: List[Tuple[str, str]]) -> None:
+    transform = get_augmentation_transform()
+    augment_files(fs, file_paths, transform)
 
-def augment(params: Tuple[S3FileSystem, str, str, str]) -> None:
-    
-    fs, file_path, source_directory, output_directory = params
-    file_dir = os.path.dirname(file_path)
-    stem_file_path = os.path.join(file_dir, 'stem.ogg')
-    file_dir = os.path.dirname(file_path)
-    relative_path = os.path.relpath(file_dir, source_directory)
-    output_file_path = os.path.join(output_directory, relative_path + '-original')
 
-    full_track_output_file_path = os.path.join(output_file_path, os.path.basename(file_path))
-    
-    if not fs.exists(full_track_output_file_path):
+def stack_pair(full_track: np.ndarray, stem: np.ndarray) -> np.ndarray:
+    # The stem is padded with silence when shorter than the full track (or vice versa), so that the pair stays sample-aligned
+    length = max(full_track.shape[1], stem.shape[1])
+    stacked = np.zeros((full_track.shape[0] + stem.shape[0], length), dtype=np.float32)
+    stacked[:full_track.shape[0], :full_track.shape[1]] = full_track
+    stacked[full_track.shape[0]:, :stem.shape[1]] = stem
+    return stacked
+
+
+def augment_pair(full_track: np.ndarray, stem: np.ndarray, sr: int, transform: Optional[Compose] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Augments the full track and the stem with the same transform parameters. The channels of both are stacked and
+    transformed in a single call, so the time stretch STFTs of the pair are computed together.
+    """
+    transform = transform if transform is not None else get_augmentation_transform()
+    augmented = augment_audio(stack_pair(full_track, stem), sr, transform)
+    return augmented[:full_track.shape[0]], augmented[full_track.shape[0]:]
+
+
+def load_pair(fs: S3FileSystem, file_path: str, stem_file_path: str, inputs: Optional[Inputs] = None) -> Tuple[np.ndarray, np.ndarray, int]:
+    # Prefetched files are decoded from memory, the others are downloaded
+    full_track, sr = read_audio(io.BytesIO(inputs[file_path])) if inputs is not None else load_audio(fs, file_path)
+    stem, stem_sr = read_audio(io.BytesIO(inputs[stem_file_path])) if inputs is not None else load_audio(fs, stem_file_path)
+    assert sr == stem_sr, f'Full track and stem have different sample rates: {sr} vs {stem_sr}'
+    return full_track, stem, sr
+
+
+def augment_pair_variants(
+    fs: S3FileSystem,
+    file_path: str,
+    stem_file_path: str,
+    output_file_paths: List[Tuple[str, str]],
+    uploader: BackgroundUploader,
+    inputs: Optional[Inputs] = None,
+) -> None:
+    # The pair is decoded once, each variant is then augmented in memory and encoded and uploaded in the background
+    full_track, stem, sr = load_pair(fs, file_path, stem_file_path, inputs)
+
+    for full_track_output_file_path, stem_output_file_path in output_file_paths:
+        augmented_full_track, augmented_stem = augment_pair(full_track, stem, sr)
+        uploader.submit(export_ogg, fs, augmented_full_track, sr, full_track_output_file_path)
+        uploader.submit(export_ogg, fs, augmented_stem, sr, stem_output_file_path)
+
+
+def get_output_file_paths(file_path: str, source_directory: str, output_directory: str) -> List[Tuple[str, str]]:
+    # Full track and stem output paths of the original and of each augmented variant
+    relative_path = os.path.relpath(os.path.dirname(file_path), source_directory)
+    variant_names = ['original'] + [f'augmented{i}' for i in range(AUGMENTATIONS_COUNT)]
+    output_directories = [os.path.join(output_directory, relative_path + f'-{variant_name}') for variant_name in variant_names]
+    return [(os.path.join(directory, 'all.ogg'), os.path.join(directory, 'stem.ogg')) for directory in output_directories]
+
+
+def get_pending_variant_file_paths(output_file_paths: List[Tuple[str, str]], existing_outputs: FrozenSet[str]) -> List[Tuple[str, str]]:
+    return [
+        (full_track_output_file_path, stem_output_file_path)
+        for full_track_output_file_path, stem_output_file_path in output_file_paths
+        if full_track_output_file_path not in existing_outputs or stem_output_file_path not in existing_outputs
+    ]
+
+
+def get_stem_file_path(file_path: str) -> str:
+    return os.path.join(os.path.dirname(file_path), 'stem.ogg')
+
+
+def fetch_pair(fs: S3FileSystem, file_path: str, source_directory: str, output_directory: str, existing_outputs: FrozenSet[str]) -> Inputs:
+    # Nothing is downloaded when all the augmented variants already exist, the originals are copied server side
+    augmented_output_file_paths = get_output_file_paths(file_path, source_directory, output_directory)[1:]
+    needs_pair = len(get_pending_variant_file_paths(augmented_output_file_paths, existing_outputs)) > 0
+    return fetch_files(fs, [file_path, get_stem_file_path(file_path)]) if needs_pair else {}
+
+
+def augment_file(
+    fs: S3FileSystem,
+    uploader: BackgroundUploader,
+    file_path: str,
+    inputs: Inputs,
+    source_directory: str,
+    output_directory: str,
+    existing_outputs: FrozenSet[str],
+) -> List[str]:
+
+    stem_file_path = get_stem_file_path(file_path)
+    output_file_paths = get_output_file_paths(file_path, source_directory, output_directory)
+    (full_track_output_file_path, stem_output_file_path), *augmented_output_file_paths = output_file_paths
+
+    if full_track_output_file_path not in existing_outputs:
         fs.makedirs(os.path.dirname(full_track_output_file_path), exist_ok=True)
-        if fs.exists(file_path):
-            fs.copy(file_path, full_track_output_file_path)
+        uploader.copy(file_path, full_track_output_file_path)
 
-    stem_output_file_path = os.path.join(output_file_path, os.path.basename(stem_file_path))
+    if stem_output_file_path not in existing_outputs:
+        fs.makedirs(os.path.dirname(stem_output_file_path), exist_ok=True)
+        uploader.copy(stem_file_path, stem_output_file_path)
 
-    if not fs.exists(stem_output_file_path):
-        fs.makedirs(os.path.dirname(full_track_output_file_path), exist_ok=True)
-        if fs.exists(stem_file_path):
-            fs.copy(stem_file_path, stem_output_file_path)
+    pending_output_file_paths = get_pending_variant_file_paths(augmented_output_file_paths, existing_outputs)
 
-    for i in range(AUGMENTATIONS_COUNT):
-        file_dir = os.path.dirname(file_path)
-        relative_path = os.path.relpath(file_dir, source_directory)
-        output_file_path = os.path.join(output_directory, relative_path + f'-augmented{i}')
-        full_track_output_file_path = os.path.join(output_file_path, os.path.basename(file_path))
-        stem_output_file_path = os.path.join(output_file_path, os.path.basename(stem_file_path))
+    if len(pending_output_file_paths) > 0:
+        for full_track_output_file_path, _ in pending_output_file_paths:
+            fs.makedirs(os.path.dirname(full_track_output_file_path), exist_ok=True)
+        augment_pair_variants(fs, file_path, stem_file_path, pending_output_file_paths, uploader, inputs)
 
-        if not fs.exists(full_track_output_file_path) or not fs.exists(stem_output_file_path):
+    return [path for paths in output_file_paths for path in paths]
 
-            fs.makedirs(output_file_path, exist_ok=True)
-            augment_pitch_and_tempo(
-                fs,
-                [
-                    (file_path, full_track_output_file_path),
-                    (stem_file_path, stem_output_file_path)
-                ]
-            )
 
+def augment(params: AugmentParams) -> TaskOutputs:
 
-def augment_all(source_directory: str, output_directory: str):
+    file_paths, source_directory, output_directory, existing_outputs = params
+    fs = get_filesystem()
 
-    fs = S3FileSystem()
-    files = get_full_track_files(fs, source_directory)
+    # The pairs of the next files are downloaded while the current pair is augmented
+    with BackgroundUploader(fs) as uploader:
+        return process_prefetched(
+            file_paths,
+            lambda file_path: fetch_pair(fs, file_path, source_directory, output_directory, existing_outputs),
+            lambda file_path, inputs: augment_file(fs, uploader, file_path, inputs, source_directory, output_directory, existing_outputs),
+            'augment',
+        )
 
-    client = cast(
-        Client,
-        get_client(
-            RUN_LOCALLY,
-        ),
-    )
-    
-    params_list: List[Tuple[S3FileSystem, str, str, str]] = [(fs, file_path, source_directory, output_directory) for file_path in files]
 
-    print('Augmenting audio tracks')
-    futures = client.map(augment, params_list, retries=2)
-    progress(futures)
+def get_augment_params(file_paths: List[str], source_directory: str, output_directory: str, existing_outputs: FrozenSet[str]) -> AugmentParams:
+    output_file_paths = [path for file_path in file_paths for paths in get_output_file_paths(file_path, source_directory, output_directory) for path in paths]
+    return (file_paths, source_directory, output_directory, filter_existing(existing_outputs, output_file_paths))
+
+
+def augment_all(source_directory: str, output_directory: str):
+
+    fs = get_filesystem()
+    track_files = list_track_files(fs, source_directory)
+    fingerprints = get_full_track_fingerprints(track_files)
+    manifest_path = get_manifest_path(output_directory)
+    manifest = load_manifest(fs, manifest_path)
+    params_hash = get_augment_params_hash()
+    files = get_pending_items(manifest, fingerprints, params_hash)
+    remove_stale_outputs(fs, manifest, files)
+    existing_outputs = list_outputs(fs, output_directory)
+
+    # Pairs are grouped by size into tasks of similar duration, the longest tasks are submitted first
+    params_list: List[AugmentParams] = [
+        get_augment_params(file_paths, source_directory, output_directory, existing_outputs)
+        for file_paths in partition_by_cost(get_pair_sizes(track_files, files), TASK_INPUT_SIZE)
+    ]
+
+    print(f'Augmenting audio tracks ({len(files)} of {len(fingerprints)} tracks to process)')
+    outputs = run_tasks(get_executor(WORKER_POOL), augment, params_list, 'Augmenting')
+    update_manifest(fs, manifest_path, manifest, fingerprints, params_hash, outputs)
 
     return output_directory
 
@@ -0,0 +1,43 @@
+import random
+import time
+from typing import Callable, Tuple
+import numpy as np
+
+from stem_continuation_dataset_generator.steps.augment import augment_audio, augment_pair, get_augmentation_transform
+
+SAMPLE_RATE = 48000
+DURATION = 30  # In seconds
+REPETITIONS = 5
+
+
+def augment_pair_separately(full_track: np.ndarray, stem: np.ndarray, sr: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Previous implementation: two transform calls, with the parameters frozen in between
+    transform = get_augmentation_transform()
+    augmented_full_track = augment_audio(full_track, sr, transform)
+    transform.freeze_parameters()
+    return augmented_full_track, augment_audio(stem, sr, transform)
+
+
+def benchmark(name: str, augment: Callable[[np.ndarray, np.ndarray, int], Tuple[np.ndarray, np.ndarray]], full_track: np.ndarray, stem: np.ndarray) -> None:
+    augment(full_track, stem, SAMPLE_RATE)  # Warm up
+    random.seed(0)  # Both paths draw the same sequence of stretch rates
+    start = time.perf_counter()
+
+    for _ in range(REPETITIONS):
+        augment(full_track, stem, SAMPLE_RATE)
+
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed / REPETITIONS:.3f} s per pair, {DURATION * REPETITIONS / elapsed:.1f} audio seconds per second')
+
+
+def benchmark_augment_pair() -> None:
+    rng = np.random.default_rng(0)
+    full_track = rng.uniform(-0.5, 0.5, (2, SAMPLE_RATE * DURATION)).astype(np.float32)
+    stem = rng.uniform(-0.5, 0.5, (2, SAMPLE_RATE * DURATION)).astype(np.float32)
+
+    benchmark('Separate calls', augment_pair_separately, full_track, stem)
+    benchmark('Joint call', augment_pair, full_track, stem)
+
+
+if __name__ == '__main__':
+    benchmark_augment_pair()
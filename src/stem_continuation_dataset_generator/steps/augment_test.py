@@ -0,0 +1,30 @@
+import numpy as np
+
+from stem_continuation_dataset_generator.steps.augment import augment_audio, augment_pair, get_augmentation_transform
+
+SAMPLE_RATE = 8000
+
+
+def test_augment_pair() -> None:
+    rng = np.random.default_rng(0)
+    full_track = rng.uniform(-0.5, 0.5, (2, SAMPLE_RATE * 10)).astype(np.float32)
+    stem = rng.uniform(-0.5, 0.5, (1, SAMPLE_RATE * 10)).astype(np.float32)
+    transform = get_augmentation_transform()
+
+    augmented_full_track, augmented_stem = augment_pair(full_track, stem, SAMPLE_RATE, transform)
+
+    # The joint transform must match transforming the full track and the stem separately with the same parameters
+    transform.freeze_parameters()
+    assert augmented_full_track.shape[0] == 2 and augmented_stem.shape[0] == 1
+    assert augmented_full_track.shape[1] == augmented_stem.shape[1]
+    assert np.allclose(augmented_full_track, augment_audio(full_track, SAMPLE_RATE, transform), atol=1e-5)
+    assert np.allclose(augmented_stem, augment_audio(stem, SAMPLE_RATE, transform), atol=1e-5)
+
+
+def test_augment_pair_different_lengths() -> None:
+    full_track = np.full((2, SAMPLE_RATE * 10), 0.1, dtype=np.float32)
+    stem = np.full((2, SAMPLE_RATE * 6), 0.1, dtype=np.float32)
+
+    augmented_full_track, augmented_stem = augment_pair(full_track, stem, SAMPLE_RATE)
+
+    assert augmented_full_track.shape == augmented_stem.shape
@@ -0,0 +1,54 @@
+import os
+import pickle
+from typing import List, Tuple, cast
+import multiprocessing
+import multiprocessing.pool
+from s3fs.core import S3FileSystem
+from torch import Tensor
+from tqdm import tqdm
+
+from stem_continuation_dataset_generator.constants import get_encoded_files_path
+from stem_continuation_dataset_generator.steps.encode import get_source_id
+from stem_continuation_dataset_generator.tokens import TOKENS_FILE_EXTENSION, write_tokens
+
+# Frame rate of the facebook/encodec_32khz model, used to encode the existing pickled tensors
+PICKLED_TOKENS_FRAME_RATE = 50
+
+
+def get_pickle_files(fs: S3FileSystem, dir: str) -> List[str]:
+    return [path for path in cast(List[str], fs.glob(os.path.join(dir, '**/*.pkl')))]
+
+
+def get_tokens_file_path(pickle_file_path: str) -> str:
+    return os.path.splitext(pickle_file_path)[0] + TOKENS_FILE_EXTENSION
+
+
+def convert_file(params: Tuple[S3FileSystem, str, str, bool]) -> None:
+    fs, file_path, source_directory, remove_source = params
+    output_file_path = get_tokens_file_path(file_path)
+
+    if not fs.exists(output_file_path):
+        with fs.open(file_path, 'rb') as file:
+            encoded_audio = cast(Tensor, pickle.load(file))
+
+        with fs.open(output_file_path, 'wb') as output_file:
+            write_tokens(output_file, encoded_audio, PICKLED_TOKENS_FRAME_RATE, get_source_id(file_path, source_directory))
+
+    if remove_source is True:
+        fs.rm(file_path)
+
+
+def convert_all(source_directory: str, remove_source: bool = False) -> str:
+    """Converts the pickled tensors produced by previous versions of the encode step into token files."""
+    fs = S3FileSystem(use_listings_cache=False)
+    files = get_pickle_files(fs, source_directory)
+    params = [(fs, file_path, source_directory, remove_source) for file_path in files]
+
+    with multiprocessing.pool.ThreadPool(multiprocessing.cpu_count()) as pool:
+        list(tqdm(pool.imap(convert_file, params), total=len(params), desc='Converting pickled tensors to token files'))
+
+    return source_directory
+
+
+if __name__ == '__main__':
+    convert_all(get_encoded_files_path())
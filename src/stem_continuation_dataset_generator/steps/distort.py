@@ -1,42 +1,99 @@
+from dataclasses import dataclass
 import io
 import os
-from typing import List, Tuple, cast
+import random
+from typing import BinaryIO, FrozenSet, Iterable, Iterator, List, Optional, Tuple
 from fsspec import AbstractFileSystem
 import numpy as np
-from pydub import AudioSegment
 from audiomentations import Compose, AddGaussianSNR, BandStopFilter, RoomSimulator, SevenBandParametricEQ, SomeOf
+from audiomentations.core.utils import calculate_desired_noise_rms, calculate_rms
+import scipy.signal
 from s3fs.core import S3FileSystem
-from dask.distributed import Client
-from distributed import progress
 
-from stem_continuation_dataset_generator.cluster import get_client
-from stem_continuation_dataset_generator.constants import get_augmented_files_path, get_distorted_files_path
-from stem_continuation_dataset_generator.utils.utils import clamp_audio_data, convert_audio_to_float_32, convert_audio_to_int_16
+from stem_continuation_dataset_generator.audio_io import WRITE_BLOCK_SIZE, AudioFile, encode_ogg, get_audio_info, read_audio, read_blocks, write_ogg_blocks
+from stem_continuation_dataset_generator.cluster import CPU_DSP_POOL
+from stem_continuation_dataset_generator.executor import get_executor, run_tasks
+from stem_continuation_dataset_generator.constants import get_augmented_files_path, get_distorted_files_path, get_rir_bank_path
+from stem_continuation_dataset_generator.steps.augment import get_full_track_fingerprints, get_pair_sizes, list_track_files
+from stem_continuation_dataset_generator.utils.manifest import (
+    TaskOutputs,
+    filter_existing,
+    get_manifest_path,
+    get_params_hash,
+    get_pending_items,
+    list_outputs,
+    load_manifest,
+    remove_stale_outputs,
+    update_manifest,
+)
+from stem_continuation_dataset_generator.utils.filesystem import get_filesystem
+from stem_continuation_dataset_generator.utils.partition import partition_by_cost
+from stem_continuation_dataset_generator.utils.prefetch import BackgroundUploader, Inputs, fetch_files, process_prefetched
+from stem_continuation_dataset_generator.utils.rir_bank import ApplyRirBank, RirBank, convolve_rir, ensure_rir_bank, get_rir, get_rir_bank
+from stem_continuation_dataset_generator.utils.streaming import RmsAccumulator, StreamingConvolver, StreamingSosFilter, get_block_noise
 
 
-# Set this flag to True to run locally (i.e. not on Coiled)
-RUN_LOCALLY = False
+# Pool of workers running the tasks of this step
+WORKER_POOL = CPU_DSP_POOL
 
+# Full track and stem file pairs, source directory, output directory, existing outputs of the pairs and room impulse response bank
+DistortParams = Tuple[List[Tuple[str, str]], str, str, FrozenSet[str], Optional[str]]
 
-def get_full_track_files(fs: S3FileSystem, dir: str) -> List[str]:
-    return [path for path in cast(List[str], fs.glob(os.path.join(dir, '**/all.ogg')))]
+# Set this flag to False to simulate a new room for each file instead of drawing from the room impulse response bank
+USE_RIR_BANK = True
+
+DISTORTION_PROBABILITY = 0.5
+TASK_INPUT_SIZE = 32 * 1024 * 1024  # In bytes, size of the pairs distorted by a task
+
+# In frames. Tracks are distorted a block at a time, and the noise of each block is drawn from a generator seeded with
+# the index of the block, so the block size must not change between runs.
+STREAM_BLOCK_SIZE = WRITE_BLOCK_SIZE
+
+
+@dataclass
+class DistortionPlan:
+    # Distortion parameters of a track, drawn with the same distributions as the transform of get_distortion_transform
+    sos: Optional[np.ndarray]  # Second order sections of the band-stop filter or of the parametric EQ
+    impulse_response: Optional[np.ndarray]
+    snr_db: Optional[float]
+    noise_seed: int
 
 
 def get_stem_file(dir: str):
     return os.path.join(dir, 'stem.ogg')
 
 
-def get_files_pairs(fs: S3FileSystem, dir: str) -> List[Tuple[str, str]]:
-    full_track_files = get_full_track_files(fs, dir)
+def get_files_pairs(full_track_files: List[str]) -> List[Tuple[str, str]]:
     pairs = [(full_track_file, get_stem_file(os.path.dirname(full_track_file))) for full_track_file in full_track_files]
     return pairs
 
 
-def distort_audio(original_audio: AudioSegment) -> AudioSegment:
-    sample_rate = original_audio.frame_rate
-    channels = original_audio.channels
-    audio = convert_audio_to_float_32(np.array(original_audio.get_array_of_samples()))
-    transform = Compose(
+def get_rir_bank_path_if_enabled() -> Optional[str]:
+    return get_rir_bank_path() if USE_RIR_BANK is True else None
+
+
+def get_distort_params_hash(rir_bank_path: Optional[str] = None) -> str:
+    return get_params_hash('distort', {'rir_bank_path': rir_bank_path, 'stream_block_size': STREAM_BLOCK_SIZE})
+
+
+def load_rir_bank_if_enabled(fs: AbstractFileSystem, rir_bank_path: Optional[str]) -> Optional[RirBank]:
+    return get_rir_bank(fs, rir_bank_path) if rir_bank_path is not None else None
+
+
+def get_band_stop_filter() -> BandStopFilter:
+    return BandStopFilter(p=1, min_center_freq=500., max_center_freq=4000.)
+
+
+def get_parametric_eq() -> SevenBandParametricEQ:
+    return SevenBandParametricEQ(p=1, min_gain_db=-3.5, max_gain_db=3.5)
+
+
+def get_noise_transform() -> AddGaussianSNR:
+    return AddGaussianSNR(min_snr_db=20., max_snr_db=35., p=0.8)
+
+
+def get_distortion_transform(rir_bank: Optional[RirBank] = None) -> Compose:
+    return Compose(
         transforms=[
             # ApplyImpulseResponse(),
             # BitCrush(p=1, min_bit_depth=5, max_bit_depth=10),
@@ -44,68 +101,265 @@ def distort_audio(original_audio: AudioSegment) -> AudioSegment:
             SomeOf(
                 1,
                 [
-                    BandStopFilter(p=1, min_center_freq=500., max_center_freq=4000.),
-                    RoomSimulator(p=1, leave_length_unchanged=True),
-                    SevenBandParametricEQ(p=1, min_gain_db=-3.5, max_gain_db=3.5),
+                    get_band_stop_filter(),
+                    ApplyRirBank(rir_bank, p=1) if rir_bank is not None else RoomSimulator(p=1, leave_length_unchanged=True),
+                    get_parametric_eq(),
                 ],
             ),
-            AddGaussianSNR(min_snr_db=20., max_snr_db=35., p=0.8),
+            get_noise_transform(),
         ],
-        p=0.5,
+        p=DISTORTION_PROBABILITY,
         shuffle=False,
     )
-    augmented_audio = transform(audio, sample_rate=sample_rate)
-    data = convert_audio_to_int_16(clamp_audio_data(augmented_audio))
-    data = data.reshape((-1, 2))
-    return AudioSegment(data=data, sample_width=2, frame_rate=sample_rate, channels=channels)  # type: ignore
 
 
-def distort_file(fs: AbstractFileSystem, file_path: str, output_file_path: str):
-    with fs.open(file_path, 'rb') as audio_file:
-        data = io.BytesIO(audio_file.read())  # type: ignore
-        audio = AudioSegment.from_ogg(data)  # type: ignore
-        augmented = distort_audio(audio)
+def get_band_stop_sos(band_stop_filter: BandStopFilter, sample_rate: int) -> np.ndarray:
+    # Same filter design as BandStopFilter.apply
+    center_freq, bandwidth = band_stop_filter.parameters['center_freq'], band_stop_filter.parameters['bandwidth']
+    high_freq = min(center_freq + bandwidth / 2, sample_rate // 2 * 0.9999)
+    order = band_stop_filter.parameters['rolloff'] // 6
+    return scipy.signal.butter(order, [center_freq - bandwidth / 2, high_freq], btype='bandstop', fs=sample_rate, output='sos')
+
+
+def get_parametric_eq_sos(parametric_eq: SevenBandParametricEQ, sample_rate: int) -> np.ndarray:
+    # The seven bands are cascaded into a single filter, with the coefficients computed by audiomentations
+    bands = [parametric_eq.low_shelf_filter] + parametric_eq.peaking_filters + [parametric_eq.high_shelf_filter]
+    return np.concatenate([
+        band._get_biquad_coefficients_from_input_parameters(
+            min(band.parameters['center_freq'], sample_rate // 2 * 0.9999),
+            band.parameters['gain_db'],
+            band.parameters['q_factor'],
+            sample_rate,
+        )
+        for band in bands
+    ])
+
+
+def get_distortion_plan(sample_rate: int, rir_bank: RirBank) -> DistortionPlan:
+    plan = DistortionPlan(sos=None, impulse_response=None, snr_db=None, noise_seed=random.getrandbits(32))
+
+    if random.random() >= DISTORTION_PROBABILITY:
+        return plan
+
+    samples = np.zeros((1, 1), dtype=np.float32)  # Filter parameters do not depend on the samples
+    distortion_index = random.randrange(3)
+
+    if distortion_index == 0:
+        band_stop_filter = get_band_stop_filter()
+        band_stop_filter.randomize_parameters(samples, sample_rate)
+        plan.sos = get_band_stop_sos(band_stop_filter, sample_rate)
+    elif distortion_index == 1:
+        plan.impulse_response = get_rir(rir_bank, random.randrange(len(rir_bank)), sample_rate)
+    else:
+        parametric_eq = get_parametric_eq()
+        parametric_eq.randomize_parameters(samples, sample_rate)
+        plan.sos = get_parametric_eq_sos(parametric_eq, sample_rate)
+
+    noise_transform = get_noise_transform()
+
+    if random.random() < noise_transform.p:
+        plan.snr_db = random.uniform(noise_transform.min_snr_db, noise_transform.max_snr_db)
+
+    return plan
+
+
+def get_noise(plan: DistortionPlan, shape: Tuple[int, ...], noise_std: float) -> np.ndarray:
+    # Same noise as the one added by distort_blocks, generated a block at a time
+    noise = np.empty(shape, dtype=np.float32)
+
+    for block_index, start in enumerate(range(0, shape[-1], STREAM_BLOCK_SIZE)):
+        block = noise[..., start:start + STREAM_BLOCK_SIZE]
+        block[...] = get_block_noise(plan.noise_seed, block_index, block.shape, noise_std)
+
+    return noise
+
+
+def apply_distortion_plan(audio: np.ndarray, plan: DistortionPlan) -> np.ndarray:
+    # Distorts a whole track held in memory
+    if plan.sos is not None:
+        audio = StreamingSosFilter(plan.sos).process(audio)
+
+    if plan.impulse_response is not None:
+        audio = convolve_rir(audio, plan.impulse_response)
+
+    if plan.snr_db is not None:
+        audio = audio + get_noise(plan, audio.shape, calculate_desired_noise_rms(calculate_rms(audio), plan.snr_db))
+
+    return audio
+
+
+def distort_blocks(blocks: Iterable[np.ndarray], plan: DistortionPlan) -> Iterator[np.ndarray]:
+    # Filters a track a block at a time, carrying the state of the filters and the tail of the impulse response across blocks
+    sos_filter = StreamingSosFilter(plan.sos) if plan.sos is not None else None
+    convolver = StreamingConvolver(plan.impulse_response) if plan.impulse_response is not None else None
+
+    for block in blocks:
+        if sos_filter is not None:
+            block = sos_filter.process(block)
+
+        if convolver is not None:
+            block = convolver.process(block)
+
+        yield block
+
+
+def get_noise_std(blocks: List[np.ndarray], plan: DistortionPlan) -> float:
+    # The noise level depends on the RMS of the whole distorted track
+    assert plan.snr_db is not None, 'The plan does not add noise'
+    rms = RmsAccumulator()
+
+    for block in blocks:
+        rms.add(block)
+
+    return calculate_desired_noise_rms(rms.get_rms(), plan.snr_db)
+
+
+def add_noise(blocks: Iterable[np.ndarray], plan: DistortionPlan, noise_std: float) -> Iterator[np.ndarray]:
+    """
+    Adds the noise of the plan to the distorted blocks. The blocks must have STREAM_BLOCK_SIZE frames (except the last
+    one) for the noise to match apply_distortion_plan.
+    """
+    for block_index, block in enumerate(blocks):
+        yield block + get_block_noise(plan.noise_seed, block_index, block.shape, noise_std)
+
+
+def distort_samples(audio: np.ndarray, sample_rate: int, rir_bank: Optional[RirBank] = None) -> np.ndarray:
+    if rir_bank is not None:
+        return apply_distortion_plan(audio, get_distortion_plan(sample_rate, rir_bank))
+
+    transform = get_distortion_transform()
+    return transform(audio, sample_rate=sample_rate)
+
+
+def distort_stream(input_file: BinaryIO, output_file: AudioFile, rir_bank: RirBank) -> None:
+    """
+    Decodes and filters the track once, a block at a time. Without noise, the blocks are written as they are filtered.
+    Otherwise the filtered blocks are kept until the end of the track, since the noise level depends on their RMS.
+    """
+    sample_rate, channels = get_audio_info(input_file)
+    input_file.seek(0)
+    plan = get_distortion_plan(sample_rate, rir_bank)
+    blocks = distort_blocks(read_blocks(input_file, STREAM_BLOCK_SIZE), plan)
+
+    if plan.snr_db is not None:
+        distorted_blocks = list(blocks)
+        blocks = add_noise(distorted_blocks, plan, get_noise_std(distorted_blocks, plan))
+
+    write_ogg_blocks(output_file, blocks, sample_rate, channels)
+
+
+def distort_data(data: bytes, rir_bank: Optional[RirBank] = None) -> bytes:
+    # Distorts an Ogg file held in memory (e.g. prefetched), returning the distorted Ogg file
+    if rir_bank is None:
+        audio, sample_rate = read_audio(io.BytesIO(data))
+        return encode_ogg(distort_samples(audio, sample_rate), sample_rate)
+
+    output_file = io.BytesIO()
+    distort_stream(io.BytesIO(data), output_file, rir_bank)
+    return output_file.getvalue()
+
+
+def distort_file(fs: AbstractFileSystem, file_path: str, output_file_path: str, rir_bank: Optional[RirBank] = None):
+    with fs.open(file_path, 'rb') as file:
+        data = file.read()
+
+    with fs.open(output_file_path, 'wb') as output_file:
+        output_file.write(distort_data(data, rir_bank))
+
+
+def get_output_file_paths(file_pair: Tuple[str, str], source_directory: str, output_directory: str) -> Tuple[str, str]:
+    full_track_file_path, stem_file_path = file_pair
+    return (
+        os.path.join(output_directory, os.path.relpath(full_track_file_path, source_directory)),
+        os.path.join(output_directory, os.path.relpath(stem_file_path, source_directory)),
+    )
+
+
+def fetch_full_track(fs: S3FileSystem, file_pair: Tuple[str, str], source_directory: str, output_directory: str, existing_outputs: FrozenSet[str]) -> Inputs:
+    # Only the full track is distorted, the stem is copied server side
+    full_track_output_file_path, _ = get_output_file_paths(file_pair, source_directory, output_directory)
+    return fetch_files(fs, [file_pair[0]]) if full_track_output_file_path not in existing_outputs else {}
+
+
+def distort_pair(
+    fs: S3FileSystem,
+    uploader: BackgroundUploader,
+    file_pair: Tuple[str, str],
+    inputs: Inputs,
+    source_directory: str,
+    output_directory: str,
+    existing_outputs: FrozenSet[str],
+    rir_bank: Optional[RirBank],
+) -> List[str]:
+
+    full_track_file_path, stem_file_path = file_pair
+    full_track_output_file_path, stem_output_file_path = get_output_file_paths(file_pair, source_directory, output_directory)
+
+    if full_track_output_file_path not in existing_outputs:
+        fs.makedirs(os.path.dirname(full_track_output_file_path), exist_ok=True)
+        uploader.write(full_track_output_file_path, distort_data(inputs[full_track_file_path], rir_bank))
 
-        # Export the final merged track to a single .ogg file
-        with fs.open(output_file_path, 'wb') as file:
-            bytes_io = io.BytesIO()
-            augmented.export(bytes_io, format='ogg', codec='libopus')  # type: ignore
-            file.write(bytes_io.getvalue())  # type: ignore
+    if stem_output_file_path not in existing_outputs:
+        fs.makedirs(os.path.dirname(stem_output_file_path), exist_ok=True)
+        uploader.copy(stem_file_path, stem_output_file_path)
 
+    return [full_track_output_file_path, stem_output_file_path]
 
-def distort(params: Tuple[S3FileSystem, Tuple[str, str], str, str]) -> None:
 
-    fs, (full_track_file_path, stem_file_path), source_directory, output_directory = params
+def distort(params: DistortParams) -> TaskOutputs:
 
-    file_dir = os.path.dirname(full_track_file_path)
-    full_track_relative_path = os.path.relpath(file_dir, source_directory)
-    actual_output_dir = os.path.join(output_directory, full_track_relative_path)
-    fs.makedirs(actual_output_dir, exist_ok=True)
-    full_track_output_file_path = os.path.join(actual_output_dir, os.path.basename(full_track_file_path))
+    file_pairs, source_directory, output_directory, existing_outputs, rir_bank_path = params
+    fs = get_filesystem()
+    rir_bank = load_rir_bank_if_enabled(fs, rir_bank_path)
 
-    if not fs.exists(full_track_output_file_path):
-        distort_file(fs, full_track_file_path, full_track_output_file_path)
+    # The next full tracks are downloaded while the current one is distorted, and the outputs are uploaded in the background
+    with BackgroundUploader(fs) as uploader:
+        outputs = process_prefetched(
+            file_pairs,
+            lambda file_pair: fetch_full_track(fs, file_pair, source_directory, output_directory, existing_outputs),
+            lambda file_pair, inputs: distort_pair(fs, uploader, file_pair, inputs, source_directory, output_directory, existing_outputs, rir_bank),
+            'distort',
+        )
 
-    stem_relative_path = os.path.relpath(stem_file_path, source_directory)
-    stem_output_file_path = os.path.join(output_directory, stem_relative_path)
-    if not fs.exists(stem_output_file_path):
-        fs.copy(stem_file_path, stem_output_file_path)
+    return {full_track_file_path: output_file_paths for (full_track_file_path, _), output_file_paths in outputs.items()}
+
+
+def get_distort_params(
+    full_track_files: List[str],
+    source_directory: str,
+    output_directory: str,
+    existing_outputs: FrozenSet[str],
+    rir_bank_path: Optional[str],
+) -> DistortParams:
+    file_pairs = get_files_pairs(full_track_files)
+    output_file_paths = [path for file_pair in file_pairs for path in get_output_file_paths(file_pair, source_directory, output_directory)]
+    return (file_pairs, source_directory, output_directory, filter_existing(existing_outputs, output_file_paths), rir_bank_path)
 
 
 def distort_all(source_directory: str, output_directory: str):
-    fs = S3FileSystem(use_listings_cache=False)
-    files: List[Tuple[str, str]] = get_files_pairs(fs, source_directory)
-    
-    params_list: List[Tuple[S3FileSystem, Tuple[str, str], str, str]] = [(fs, file_pair, source_directory, output_directory) for file_pair in files]
+    fs = get_filesystem()
+    track_files = list_track_files(fs, source_directory)
+    fingerprints = get_full_track_fingerprints(track_files)
+    manifest_path = get_manifest_path(output_directory)
+    manifest = load_manifest(fs, manifest_path)
+    rir_bank_path = get_rir_bank_path_if_enabled()
+    params_hash = get_distort_params_hash(rir_bank_path)
+    pending_files = get_pending_items(manifest, fingerprints, params_hash)
+    remove_stale_outputs(fs, manifest, pending_files)
+    existing_outputs = list_outputs(fs, output_directory)
 
-    client = cast(Client, get_client(
-        RUN_LOCALLY,
-        n_workers=[1, 10],
-    ))
+    if rir_bank_path is not None:
+        ensure_rir_bank(fs, rir_bank_path)
     
-    print('Distorting audio tracks')
-    futures = client.map(distort, params_list, retries=2)
-    progress(futures)
+    # Pairs are grouped by size into tasks of similar duration, the longest tasks are submitted first
+    params_list: List[DistortParams] = [
+        get_distort_params(files, source_directory, output_directory, existing_outputs, rir_bank_path)
+        for files in partition_by_cost(get_pair_sizes(track_files, pending_files), TASK_INPUT_SIZE)
+    ]
+
+    print(f'Distorting audio tracks ({len(pending_files)} of {len(fingerprints)} tracks to process)')
+    outputs = run_tasks(get_executor(WORKER_POOL), distort, params_list, 'Distorting')
+    update_manifest(fs, manifest_path, manifest, fingerprints, params_hash, outputs)
 
     return output_directory
 
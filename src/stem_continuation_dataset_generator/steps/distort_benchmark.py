@@ -0,0 +1,37 @@
+import random
+import time
+from audiomentations import RoomSimulator
+from audiomentations.core.transforms_interface import BaseWaveformTransform
+import numpy as np
+
+from stem_continuation_dataset_generator.utils.rir_bank import ApplyRirBank, generate_rir_bank
+
+SAMPLE_RATE = 48000
+DURATION = 30  # In seconds
+REPETITIONS = 5
+BANK_SIZE = 16
+
+
+def benchmark(name: str, transform: BaseWaveformTransform, audio: np.ndarray) -> None:
+    random.seed(0)
+    start = time.perf_counter()
+
+    for _ in range(REPETITIONS):
+        transform(audio, SAMPLE_RATE)
+
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed / REPETITIONS:.3f} s per file, {DURATION * REPETITIONS / elapsed:.1f} audio seconds per second')
+
+
+def benchmark_room_transform() -> None:
+    rng = np.random.default_rng(0)
+    audio = rng.uniform(-0.5, 0.5, (2, SAMPLE_RATE * DURATION)).astype(np.float32)
+    random.seed(0)
+    rir_bank = generate_rir_bank(BANK_SIZE, SAMPLE_RATE)
+
+    benchmark('Room simulation', RoomSimulator(p=1, leave_length_unchanged=True), audio)
+    benchmark('Room impulse response bank', ApplyRirBank(rir_bank, p=1), audio)
+
+
+if __name__ == '__main__':
+    benchmark_room_transform()
@@ -0,0 +1,70 @@
+import random
+from typing import List
+import numpy as np
+from fsspec.implementations.local import LocalFileSystem
+
+from stem_continuation_dataset_generator.audio_io import get_blocks, read_audio, write_ogg
+from stem_continuation_dataset_generator.steps.distort import (
+    STREAM_BLOCK_SIZE,
+    DistortionPlan,
+    apply_distortion_plan,
+    add_noise,
+    distort_blocks,
+    distort_file,
+    get_band_stop_filter,
+    get_band_stop_sos,
+    get_parametric_eq,
+    get_noise_std,
+    get_parametric_eq_sos,
+)
+from stem_continuation_dataset_generator.utils.rir_bank import generate_rir_bank
+
+SAMPLE_RATE = 48000
+
+
+def get_plans() -> List[DistortionPlan]:
+    random.seed(0)
+    samples = np.zeros((1, 1), dtype=np.float32)
+    band_stop_filter = get_band_stop_filter()
+    band_stop_filter.randomize_parameters(samples, SAMPLE_RATE)
+    parametric_eq = get_parametric_eq()
+    parametric_eq.randomize_parameters(samples, SAMPLE_RATE)
+    impulse_response = np.random.default_rng(1).uniform(-0.1, 0.1, STREAM_BLOCK_SIZE + 1000).astype(np.float32)
+
+    return [
+        DistortionPlan(sos=get_band_stop_sos(band_stop_filter, SAMPLE_RATE), impulse_response=None, snr_db=None, noise_seed=0),
+        DistortionPlan(sos=get_parametric_eq_sos(parametric_eq, SAMPLE_RATE), impulse_response=None, snr_db=25., noise_seed=1),
+        DistortionPlan(sos=None, impulse_response=impulse_response, snr_db=30., noise_seed=2),
+    ]
+
+
+def test_distort_blocks_matches_whole_track() -> None:
+    audio = np.random.default_rng(0).uniform(-0.5, 0.5, (2, STREAM_BLOCK_SIZE * 3 + 100)).astype(np.float32)
+
+    for plan in get_plans():
+        blocks = list(distort_blocks(get_blocks(audio, STREAM_BLOCK_SIZE), plan))
+
+        if plan.snr_db is not None:
+            blocks = list(add_noise(blocks, plan, get_noise_std(blocks, plan)))
+
+        streamed = np.concatenate(blocks, axis=-1)
+        distorted = apply_distortion_plan(audio, plan)
+
+        assert streamed.shape == audio.shape
+        assert np.allclose(streamed, distorted, atol=1e-4)
+
+
+def test_distort_file_streaming(tmp_path) -> None:
+    fs = LocalFileSystem()
+    input_path, output_path = str(tmp_path / 'all.ogg'), str(tmp_path / 'all-distorted.ogg')
+    audio = np.random.default_rng(0).uniform(-0.5, 0.5, (2, SAMPLE_RATE * 3)).astype(np.float32)
+    write_ogg(input_path, audio, SAMPLE_RATE)
+    random.seed(0)
+    rir_bank = generate_rir_bank(size=2, sample_rate=SAMPLE_RATE)
+
+    for _ in range(4):
+        distort_file(fs, input_path, output_path, rir_bank)
+        distorted, sample_rate = read_audio(output_path)
+
+        assert sample_rate == SAMPLE_RATE
+        assert distorted.shape == read_audio(input_path)[0].shape
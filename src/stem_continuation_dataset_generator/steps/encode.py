@@ -1,63 +1,141 @@
+from collections import deque
+import io
 import os
-import pickle
-from typing import List, Tuple, cast
-from distributed import Client, progress
+from typing import Deque, FrozenSet, Iterator, List, Set, Tuple
 from s3fs.core import S3FileSystem
+from torch import Tensor
 
-from stem_continuation_dataset_generator.cluster import get_client
-from stem_continuation_dataset_generator.codec import encode_file
+from stem_continuation_dataset_generator.cluster import ENCODER_POOL
+from stem_continuation_dataset_generator.codec import encode_batch, get_codec_params, load_audio
+from stem_continuation_dataset_generator.executor import get_executor, run_tasks
 from stem_continuation_dataset_generator.constants import get_distorted_files_path, get_encoded_files_path
+from stem_continuation_dataset_generator.tokens import TOKENS_FILE_EXTENSION, encode_tokens, write_tokens
 from stem_continuation_dataset_generator.utils.device import get_device
+from stem_continuation_dataset_generator.utils.manifest import (
+    TaskOutputs,
+    filter_existing,
+    get_manifest_path,
+    get_params_hash,
+    get_pending_items,
+    get_size,
+    list_files,
+    list_outputs,
+    load_manifest,
+    remove_stale_outputs,
+    update_manifest,
+)
+from stem_continuation_dataset_generator.utils.filesystem import get_filesystem
+from stem_continuation_dataset_generator.utils.partition import partition_by_cost
+from stem_continuation_dataset_generator.utils.prefetch import BackgroundUploader, fetch_files, prefetch_each
 
-# Set this flag to True to run locally (i.e. not on Coiled)
-RUN_LOCALLY = False
+ENCODE_BATCH_SIZE = 8  # Number of chunks encoded in a single forward pass, possibly coming from different files
+DECODED_FILES_QUEUE_SIZE = 2  # Number of files downloaded and decoded in the background, ahead of the encoder
+TASK_INPUT_SIZE = 64 * 1024 * 1024  # In bytes, size of the files encoded by a task
 
+# Pool of workers running the tasks of this step
+WORKER_POOL = ENCODER_POOL
 
-def get_ogg_files(fs: S3FileSystem, dir: str) -> List[str]:
-    return [path for path in cast(List[str], fs.glob(os.path.join(dir, '**/*.ogg')))]
+# Files, source directory, output directory and existing outputs of the files
+EncodeParams = Tuple[List[str], str, str, FrozenSet[str]]
 
 
-def encode(params: Tuple[S3FileSystem, str, str, str]):
-    fs, file_path, source_directory, output_directory = params
-    device = get_device()
+def is_ogg_file(path: str) -> bool:
+    return path.endswith('.ogg')
+
+
+def get_encode_params_hash() -> str:
+    return get_params_hash('encode', get_codec_params())
+
+
+def get_encoded_file_name(file_path: str) -> str:
+    return os.path.basename(file_path).split('.')[0] + TOKENS_FILE_EXTENSION
+
+
+def get_source_id(file_path: str, source_directory: str) -> str:
+    return os.path.splitext(os.path.relpath(file_path, source_directory))[0]
+
+
+def save_encoded_audio(fs: S3FileSystem, encoded_audio: Tensor, frame_rate: float, source_id: str, output_file_path: str) -> None:
+    with fs.open(output_file_path, 'wb') as output_file:
+        write_tokens(output_file, encoded_audio, frame_rate, source_id)
+
 
+def fetch_audio(fs: S3FileSystem, file_path: str) -> Tuple[Tensor, int]:
+    return load_audio(io.BytesIO(fetch_files(fs, [file_path])[file_path]))
+
+
+def get_output_file_path(file_path: str, source_directory: str, output_directory: str) -> str:
     file_dir = os.path.dirname(file_path)
     relative_path = os.path.relpath(file_dir, source_directory)
-    file_output_directory = os.path.join(output_directory, relative_path)
-
-    output_filename = os.path.basename(file_path).split('.')[0] + '.pkl'
-    output_file_path = os.path.join(file_output_directory, output_filename)
+    return os.path.join(output_directory, relative_path, get_encoded_file_name(file_path))
 
-    if not fs.exists(output_file_path):
-        with fs.open(file_path, 'rb') as file:
-            encoded_audio, frame_rate = encode_file(file, device, batch_size=2)                
 
-            fs.makedirs(file_output_directory, exist_ok=True)
-            with fs.open(output_file_path, 'wb') as output_file:
-                pickle.dump(encoded_audio.detach().to('cpu'), output_file)
-    else:
-        print(f'path {output_file_path} already exists')
+def encode(params: EncodeParams) -> TaskOutputs:
+    file_paths, source_directory, output_directory, existing_outputs = params
+    fs = get_filesystem()
+    device = get_device()
+    files_to_encode: List[Tuple[str, str]] = []
+    outputs: TaskOutputs = {}
+
+    for file_path in file_paths:
+        output_file_path = get_output_file_path(file_path, source_directory, output_directory)
+        outputs[file_path] = [output_file_path]
+
+        if output_file_path not in existing_outputs:
+            files_to_encode.append((file_path, output_file_path))
+        else:
+            print(f'path {output_file_path} already exists')
+
+    # Files decoded and waiting for their codes, in order. Decoding is bounded by the queue of the next files, which are
+    # downloaded and decoded in the background, and by the chunks needed to fill the next batch
+    decoded_files: Deque[Tuple[str, str]] = deque()
+    encoded_files: Set[str] = set()
+
+    def get_audios() -> Iterator[Tuple[Tensor, int]]:
+        for file, audio in prefetch_each(files_to_encode, lambda file: fetch_audio(fs, file[0]), 'decode', DECODED_FILES_QUEUE_SIZE):
+            decoded_files.append(file)
+            yield audio
+
+    # The chunks of consecutive files are encoded together, in full batches, and each file is uploaded once encoded
+    with BackgroundUploader(fs) as uploader:
+        for encoded_audio, frame_rate in encode_batch(get_audios(), device, batch_size=ENCODE_BATCH_SIZE):
+            file_path, output_file_path = decoded_files.popleft()
+            fs.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+            uploader.write(output_file_path, encode_tokens(encoded_audio, frame_rate, get_source_id(file_path, source_directory)))
+            encoded_files.add(file_path)
+
+    # Files that cannot be downloaded or decoded are left out of the outputs
+    for file_path, _ in files_to_encode:
+        if file_path not in encoded_files:
+            del outputs[file_path]
+
+    return outputs
     
 
-def encode_all(source_directory: str, output_directory: str):
-    fs = S3FileSystem(use_listings_cache=False)
-    files = get_ogg_files(fs, source_directory)
-    
-    params_list: List[Tuple[S3FileSystem, str, str, str]] = [(fs, file_path, source_directory, output_directory) for file_path in files]
-
-    client = cast(Client, get_client(
-        RUN_LOCALLY,
-        n_workers=[1, 6],
-        worker_vm_types=['g4dn.xlarge'],
-        scheduler_vm_types=['t3.medium'],
-        spot_policy='spot',
-        use_best_zone=True,
-    ))
-    
-    print('Encoding audio tracks')
+def get_encode_params(file_paths: List[str], source_directory: str, output_directory: str, existing_outputs: FrozenSet[str]) -> EncodeParams:
+    output_file_paths = [get_output_file_path(file_path, source_directory, output_directory) for file_path in file_paths]
+    return (file_paths, source_directory, output_directory, filter_existing(existing_outputs, output_file_paths))
 
-    futures = client.map(encode, params_list, retries=2, batch_size=8)
-    progress(futures)
+
+def encode_all(source_directory: str, output_directory: str):
+    fs = get_filesystem()
+    fingerprints = list_files(fs, source_directory, is_ogg_file)
+    manifest_path = get_manifest_path(output_directory)
+    manifest = load_manifest(fs, manifest_path)
+    params_hash = get_encode_params_hash()
+    files = get_pending_items(manifest, fingerprints, params_hash)
+    remove_stale_outputs(fs, manifest, files)
+    existing_outputs = list_outputs(fs, output_directory)
+
+    # Files are grouped by size into tasks of similar duration, the longest tasks are submitted first
+    params_list: List[EncodeParams] = [
+        get_encode_params(file_paths, source_directory, output_directory, existing_outputs)
+        for file_paths in partition_by_cost({file_path: get_size(fingerprints[file_path]) for file_path in files}, TASK_INPUT_SIZE)
+    ]
+
+    print(f'Encoding audio tracks ({len(files)} of {len(fingerprints)} files to process)')
+    outputs = run_tasks(get_executor(WORKER_POOL), encode, params_list, 'Encoding')
+    update_manifest(fs, manifest_path, manifest, fingerprints, params_hash, outputs)
 
     return output_directory
 
@@ -0,0 +1,246 @@
+import os
+import random
+from typing import Dict, FrozenSet, List, Optional, Tuple
+import numpy as np
+from s3fs.core import S3FileSystem
+import torch
+
+from stem_continuation_dataset_generator.cluster import CPU_DSP_POOL
+from stem_continuation_dataset_generator.codec import encode_batch, get_codec_params
+from stem_continuation_dataset_generator.executor import get_executor, run_tasks
+from stem_continuation_dataset_generator.constants import (
+    DEFAULT_STEM_NAME,
+    get_augmented_files_path,
+    get_distorted_files_path,
+    get_encoded_files_path,
+    get_merged_files_path,
+    get_original_files_path,
+    get_silence_index_path,
+)
+from stem_continuation_dataset_generator.steps.augment import AUGMENTATIONS_COUNT, AUGMENT_PITCH, augment_pair
+from stem_continuation_dataset_generator.steps.distort import distort_samples, get_distort_params_hash, get_rir_bank_path_if_enabled, load_rir_bank_if_enabled
+from stem_continuation_dataset_generator.steps.encode import ENCODE_BATCH_SIZE, get_source_id, save_encoded_audio
+from stem_continuation_dataset_generator.steps.merge import (
+    StemCache,
+    assort,
+    export_ogg,
+    get_assortment_directory_name,
+    get_directories_fingerprints,
+    get_directories_sizes,
+    get_directory_fingerprints,
+    get_directory_silence_index,
+    get_merge_params_hash,
+    group_outputs_by_directory,
+    list_stem_files,
+    merge_audio,
+    split_directory_results,
+    update_silence_index,
+)
+from stem_continuation_dataset_generator.tokens import TOKENS_FILE_EXTENSION
+from stem_continuation_dataset_generator.utils.constants import get_random_seed
+from stem_continuation_dataset_generator.utils.device import get_device
+from stem_continuation_dataset_generator.utils.filesystem import get_filesystem
+from stem_continuation_dataset_generator.utils.manifest import (
+    TaskOutputs,
+    get_manifest_path,
+    get_params_hash,
+    get_pending_items,
+    list_outputs,
+    load_manifest,
+    remove_stale_outputs,
+    update_manifest,
+)
+from stem_continuation_dataset_generator.utils.rir_bank import RirBank, ensure_rir_bank
+from stem_continuation_dataset_generator.utils.silence import SilenceIndex, load_silence_index
+
+FULL_TRACK_FILE_NAME = 'all'
+STEM_FILE_NAME = 'stem'
+
+# Pool of workers running the tasks of this step
+WORKER_POOL = CPU_DSP_POOL
+
+# Merged, augmented and distorted directories, used to persist intermediate artifacts for debugging
+IntermediateDirectories = Tuple[str, str, str]
+
+# Variant name (e.g. "original" or "augmented0"), full track and stem as float32 arrays with shape (channels, samples)
+Variant = Tuple[str, np.ndarray, np.ndarray]
+
+
+def get_variant_names() -> List[str]:
+    return ['original'] + [f'augmented{i}' for i in range(AUGMENTATIONS_COUNT)]
+
+
+def get_encoded_output_paths(output_directory: str, assortment_name: str, variant_name: str) -> Tuple[str, str]:
+    variant_directory = os.path.join(output_directory, f'{assortment_name}-{variant_name}')
+    return (
+        os.path.join(variant_directory, f'{FULL_TRACK_FILE_NAME}{TOKENS_FILE_EXTENSION}'),
+        os.path.join(variant_directory, f'{STEM_FILE_NAME}{TOKENS_FILE_EXTENSION}'),
+    )
+
+
+def get_fused_params_hash(stem_name: str, rir_bank_path: Optional[str] = None) -> str:
+    return get_params_hash('fused', {
+        'merge': get_merge_params_hash(stem_name),
+        'augmentations_count': AUGMENTATIONS_COUNT,
+        'augment_pitch': AUGMENT_PITCH,
+        'distort': get_distort_params_hash(rir_bank_path),
+        **get_codec_params(),
+    })
+
+
+def save_ogg(fs: S3FileSystem, audio: np.ndarray, sample_rate: int, directory: str, file_name: str) -> None:
+    fs.makedirs(directory, exist_ok=True)
+    export_ogg(fs, audio, sample_rate, os.path.join(directory, f'{file_name}.ogg'))
+
+
+def augment_variants(full_track: np.ndarray, stem: np.ndarray, sample_rate: int) -> List[Variant]:
+    variants: List[Variant] = [('original', full_track, stem)]
+
+    for variant_name in get_variant_names()[1:]:
+        augmented_full_track, augmented_stem = augment_pair(full_track, stem, sample_rate)
+        variants.append((variant_name, augmented_full_track, augmented_stem))
+
+    return variants
+
+
+def process_assortment(
+    fs: S3FileSystem,
+    cache: StemCache,
+    stem_file_path: str,
+    stems_to_merge: List[str],
+    assortment_name: str,
+    output_directory: str,
+    intermediate_directories: Optional[IntermediateDirectories],
+    rir_bank: Optional[RirBank],
+) -> None:
+
+    device = get_device()
+    merged_track, sample_rate = merge_audio(cache, stems_to_merge + [stem_file_path])
+    stem_track, _ = cache.get(stem_file_path)
+
+    if intermediate_directories is not None:
+        merged_directory = os.path.join(intermediate_directories[0], assortment_name)
+        save_ogg(fs, merged_track, sample_rate, merged_directory, FULL_TRACK_FILE_NAME)
+        fs.copy(stem_file_path, os.path.join(merged_directory, f'{STEM_FILE_NAME}.ogg'))
+
+    variants = augment_variants(merged_track, stem_track, sample_rate)
+    audios_to_encode: List[Tuple[torch.Tensor, int]] = []
+    output_paths: List[str] = []
+
+    for variant_name, full_track, stem in variants:
+        full_track_output_path, stem_output_path = get_encoded_output_paths(output_directory, assortment_name, variant_name)
+
+        # The stem is not distorted, only the full track is
+        distorted_full_track = distort_samples(full_track, sample_rate, rir_bank)
+
+        if intermediate_directories is not None:
+            variant_directory_name = f'{assortment_name}-{variant_name}'
+            augmented_directory = os.path.join(intermediate_directories[1], variant_directory_name)
+            distorted_directory = os.path.join(intermediate_directories[2], variant_directory_name)
+            save_ogg(fs, full_track, sample_rate, augmented_directory, FULL_TRACK_FILE_NAME)
+            save_ogg(fs, stem, sample_rate, augmented_directory, STEM_FILE_NAME)
+            save_ogg(fs, distorted_full_track, sample_rate, distorted_directory, FULL_TRACK_FILE_NAME)
+            save_ogg(fs, stem, sample_rate, distorted_directory, STEM_FILE_NAME)
+
+        audios_to_encode += [(torch.from_numpy(distorted_full_track), sample_rate), (torch.from_numpy(stem), sample_rate)]
+        output_paths += [full_track_output_path, stem_output_path]
+
+    # All the variants of the assortment are encoded together, in full batches
+    encoded_audios = encode_batch(audios_to_encode, device, batch_size=ENCODE_BATCH_SIZE)
+
+    for output_path, (encoded_audio, frame_rate) in zip(output_paths, encoded_audios):
+        fs.makedirs(os.path.dirname(output_path), exist_ok=True)
+        save_encoded_audio(fs, encoded_audio, frame_rate, get_source_id(output_path, output_directory), output_path)
+
+
+def process_directory(
+    params: Tuple[str, str, str, str, SilenceIndex, Dict[str, str], FrozenSet[str], Optional[IntermediateDirectories], Optional[str]],
+) -> Tuple[SilenceIndex, TaskOutputs]:
+
+    source_directory, output_directory, directory, stem_name, silence_index, fingerprints, existing_outputs, intermediate_directories, rir_bank_path = params
+    fs = get_filesystem()
+    cache = StemCache(fs)
+    rir_bank = load_rir_bank_if_enabled(fs, rir_bank_path)
+    assortments = assort(fs, directory, stem_name, silence_index, fingerprints)
+    relative_path = os.path.relpath(directory, source_directory)
+    output_keys: List[str] = []
+
+    # It is possible to have multiple stems for a stem name (e.g. "vocals" and "vocals_2")
+    for i, stem_assortments in enumerate(assortments):
+        for j, (stem, stems_to_merge) in enumerate(stem_assortments):
+            assortment_name = get_assortment_directory_name(relative_path, i, j)
+            output_paths = [
+                path
+                for variant_name in get_variant_names()
+                for path in get_encoded_output_paths(output_directory, assortment_name, variant_name)
+            ]
+
+            if not all([path in existing_outputs for path in output_paths]):
+                process_assortment(fs, cache, stem, list(stems_to_merge), assortment_name, output_directory, intermediate_directories, rir_bank)
+
+            output_keys += output_paths
+
+    return silence_index, {directory: output_keys}
+
+
+def process_all(
+    source_directory: str,
+    output_directory: str,
+    stem_name: str,
+    intermediate_directories: Optional[IntermediateDirectories] = None,
+    silence_index_path: str = get_silence_index_path(),
+):
+    """
+    Runs merge, augment, distort and encode in a single task per source directory, keeping the audio in memory.
+    Only the encoded files are written, unless intermediate directories are provided.
+    """
+    fs = get_filesystem()
+
+    files = list_stem_files(fs, source_directory)
+    fingerprints = get_directories_fingerprints(files)
+    manifest_path = get_manifest_path(output_directory)
+    manifest = load_manifest(fs, manifest_path)
+    rir_bank_path = get_rir_bank_path_if_enabled()
+    params_hash = get_fused_params_hash(stem_name, rir_bank_path)
+    dirs = get_pending_items(manifest, fingerprints, params_hash)
+    remove_stale_outputs(fs, manifest, dirs)
+    existing_outputs = group_outputs_by_directory(list_outputs(fs, output_directory), source_directory, output_directory)
+    silence_index = load_silence_index(fs, silence_index_path)
+
+    if rir_bank_path is not None:
+        ensure_rir_bank(fs, rir_bank_path)
+
+    # Each directory is already a long task, the largest ones are submitted first so that they do not finish last
+    sizes = get_directories_sizes(files, dirs)
+    params_list: List[Tuple[str, str, str, str, SilenceIndex, Dict[str, str], FrozenSet[str], Optional[IntermediateDirectories], Optional[str]]] = [
+        (
+            source_directory,
+            output_directory,
+            directory,
+            stem_name,
+            get_directory_silence_index(silence_index, directory),
+            get_directory_fingerprints(files, directory),
+            existing_outputs.get(directory, frozenset()),
+            intermediate_directories,
+            rir_bank_path,
+        )
+        for directory in sorted(dirs, key=lambda directory: -sizes[directory])
+    ]
+
+    print(f'Merging, augmenting, distorting and encoding audio tracks ({len(dirs)} of {len(fingerprints)} directories to process)')
+    results = run_tasks(get_executor(WORKER_POOL), process_directory, params_list, 'Processing directories')
+    directory_silence_indexes, outputs = split_directory_results(results)
+    update_silence_index(fs, silence_index_path, silence_index, directory_silence_indexes, files)
+    update_manifest(fs, manifest_path, manifest, fingerprints, params_hash, outputs)
+
+    return output_directory
+
+
+if __name__ == '__main__':
+    random.seed(get_random_seed())
+    process_all(
+        get_original_files_path(),
+        get_encoded_files_path(),
+        DEFAULT_STEM_NAME,
+        (get_merged_files_path(), get_augmented_files_path(), get_distorted_files_path()),
+    )
@@ -1,16 +1,34 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import io
 import os
 import random
-from typing import FrozenSet, List, Optional, Tuple, cast, Set
-import librosa
-from pydub import AudioSegment
-from dask.distributed import progress, Client
+import re
+from typing import Dict, FrozenSet, List, Optional, Tuple, cast, Set
+import numpy as np
 from s3fs.core import S3FileSystem
 
-from stem_continuation_dataset_generator.cluster import get_client
-from stem_continuation_dataset_generator.constants import DEFAULT_STEM_NAME, get_merged_files_path, get_original_files_path
+from stem_continuation_dataset_generator.audio_io import encode_ogg, read_audio
+from stem_continuation_dataset_generator.cluster import CPU_DSP_POOL
+from stem_continuation_dataset_generator.executor import get_executor, run_tasks
+from stem_continuation_dataset_generator.constants import DEFAULT_STEM_NAME, get_merged_files_path, get_original_files_path, get_silence_index_path
 from stem_continuation_dataset_generator.utils.constants import get_random_seed
+from stem_continuation_dataset_generator.utils.manifest import (
+    TaskOutputs,
+    get_manifest_path,
+    get_params_hash,
+    get_pending_items,
+    group_fingerprints,
+    group_sizes,
+    list_files,
+    list_outputs,
+    load_manifest,
+    remove_stale_outputs,
+    update_manifest,
+)
+from stem_continuation_dataset_generator.utils.filesystem import get_filesystem
+from stem_continuation_dataset_generator.utils.partition import partition_by_cost
+from stem_continuation_dataset_generator.utils.prefetch import BackgroundUploader, Inputs, fetch_files, process_prefetched
+from stem_continuation_dataset_generator.utils.silence import SilenceIndex, SilenceInfo, detect_silence, load_silence_index, save_silence_index
 
 STEM_NAMES = ['guitar', 'drum', 'bass', 'perc', 'fx', 'vocals', 'piano', 'synth', 'winds', 'strings', 'other']
 BASIC_STEM_NAMES = ['guitar', 'drum', 'bass', 'perc', 'gtr', 'drm', 'piano']
@@ -20,9 +38,17 @@ MAX_BASIC_STEM_RANDOM_ASSORTMENTS_PER_SONG = 4
 MAX_RANDOM_FULL_ASSORTMENTS_PER_SONG = 4
 MIN_PERCENTAGE_OF_AUDIO_IN_NON_SILENT_FILES = 0.5
 MAX_STEMS_IN_ASSORTMENT = 3
+MAX_MIX_PEAK = 1.0
+TASK_INPUT_SIZE = 128 * 1024 * 1024  # In bytes, size of the stems of the directories processed by a task
 
-# Set this flag to True to run locally (i.e. not on Coiled)
-RUN_LOCALLY = False
+# Name of the directories produced from a song, e.g. "song-inst0-assort1" or, when fused, "song-inst0-assort1-augmented2"
+ASSORTMENT_DIRECTORY_PATTERN = re.compile(r'^(?P<song>.+)-inst\d+-assort\d+(-[^-]+)?$')
+
+# Pool of workers running the tasks of this step
+WORKER_POOL = CPU_DSP_POOL
+
+# Source directory, output directory, directories, stem name, silence index, fingerprints of the stems and existing outputs of the directories
+AssortParams = Tuple[str, str, List[str], str, SilenceIndex, Dict[str, str], FrozenSet[str]]
 
 ADDITIONAL_STEM_NAMES = {
     'guitar': ['guitars', 'gtr'],
@@ -42,10 +68,36 @@ def get_ogg_file_paths(fs: S3FileSystem, dir: str) -> List[str]:
     return [path for path in cast(List[str], fs.glob(os.path.join(dir, '*.ogg')))]
 
 
-def get_directories_containing_ogg_files(fs: S3FileSystem, dir: str) -> FrozenSet[str]:
-    ogg_files = cast(List, fs.glob(os.path.join(dir, '**/*.ogg')))
-    directories = frozenset({os.path.dirname(ogg_file) for ogg_file in ogg_files})
-    return directories
+def is_ogg_file(path: str) -> bool:
+    return path.endswith('.ogg')
+
+
+def list_stem_files(fs: S3FileSystem, dir: str) -> Dict[str, str]:
+    return list_files(fs, dir, is_ogg_file)
+
+
+def get_directories_fingerprints(files: Dict[str, str]) -> Dict[str, str]:
+    # Each directory is a work item, whose fingerprint changes when any of its stems is added, removed or modified
+    return group_fingerprints(files, os.path.dirname)
+
+
+def get_directories_sizes(files: Dict[str, str], directories: List[str]) -> Dict[str, int]:
+    # The size of the stems of a directory is an estimate of the time needed to process it
+    sizes = group_sizes(files, os.path.dirname)
+    return {directory: sizes[directory] for directory in directories}
+
+
+def get_merge_params_hash(stem_name: str) -> str:
+    return get_params_hash('merge', {
+        'stem_name': stem_name,
+        'basic_stem_names': BASIC_STEM_NAMES,
+        'include_all_stems_assortment': INCLUDE_ALL_STEMS_ASSORTMENT,
+        'max_basic_stem_random_assortments_per_song': MAX_BASIC_STEM_RANDOM_ASSORTMENTS_PER_SONG,
+        'max_random_full_assortments_per_song': MAX_RANDOM_FULL_ASSORTMENTS_PER_SONG,
+        'min_percentage_of_audio_in_non_silent_files': MIN_PERCENTAGE_OF_AUDIO_IN_NON_SILENT_FILES,
+        'max_stems_in_assortment': MAX_STEMS_IN_ASSORTMENT,
+        'max_mix_peak': MAX_MIX_PEAK,
+    })
 
 
 def get_current_stem_files(stems: List[StemFile], stem_name: str) -> List[str]:
@@ -133,26 +185,64 @@ def create_stems_assortments(other_stems: List[StemFile], current_stem_file: str
     return [(current_stem_file, assortment) for assortment in assortments]
 
 
-def is_mostly_silent(fs: S3FileSystem, file_path: str) -> bool:
+class StemCache:
+    """Per-task cache of decoded stems, so that each stem is decoded once regardless of the number of assortments it appears in."""
+
+    def __init__(self, fs: S3FileSystem, inputs: Optional[Inputs] = None):
+        self.fs = fs
+        self.inputs = inputs if inputs is not None else {}
+        self.stems: Dict[str, Tuple[np.ndarray, int]] = {}
+
+    def get(self, file_path: str) -> Tuple[np.ndarray, int]:
+        if file_path not in self.stems:
+            self.stems[file_path] = read_audio(io.BytesIO(self.inputs[file_path])) if file_path in self.inputs else load_audio(self.fs, file_path)
+        return self.stems[file_path]
+
+
+def load_audio(fs: S3FileSystem, file_path: str) -> Tuple[np.ndarray, int]:
     with fs.open(file_path, 'rb') as file:
-        
-        audio, sr = librosa.load(file)  # type: ignore
-        no_of_samples = audio.shape[-1]
-        splits = librosa.effects.split(audio, top_db=60)
-        non_silent_samples = sum([end - start for (start, end) in splits])
-        return non_silent_samples / no_of_samples < MIN_PERCENTAGE_OF_AUDIO_IN_NON_SILENT_FILES
+        return read_audio(io.BytesIO(file.read()))  # type: ignore
+
+
+def get_silence_info(fs: S3FileSystem, file_path: str, fingerprint: str, silence_index: SilenceIndex, inputs: Optional[Inputs] = None) -> SilenceInfo:
+    # Entries of files modified since they were analyzed are computed again
+    if file_path not in silence_index or silence_index[file_path].fingerprint != fingerprint:
+        if inputs is not None and file_path in inputs:
+            silence_info = detect_silence(io.BytesIO(inputs[file_path]))
+        else:
+            with fs.open(file_path, 'rb') as file:
+                silence_info = detect_silence(file)  # type: ignore
+        silence_index[file_path] = replace(silence_info, fingerprint=fingerprint)
+    return silence_index[file_path]
+
+
+def is_mostly_silent(silence_info: SilenceInfo) -> bool:
+    return silence_info.non_silent_ratio < MIN_PERCENTAGE_OF_AUDIO_IN_NON_SILENT_FILES
 
 
 def get_stem(file_path: str, silent: bool) -> StemFile:
     return StemFile(file_path=file_path, is_mostly_silent=silent)
 
 
-def get_stems(fs: S3FileSystem, paths: List[str]) -> List[StemFile]:
-    return [get_stem(path, is_mostly_silent(fs, path)) for path in paths]
+def get_stems(fs: S3FileSystem, paths: List[str], silence_index: SilenceIndex, fingerprints: Dict[str, str], inputs: Optional[Inputs] = None) -> List[StemFile]:
+    return [get_stem(path, is_mostly_silent(get_silence_info(fs, path, fingerprints.get(path, ''), silence_index, inputs))) for path in paths]
+
+
+def fetch_directory(fs: S3FileSystem, directory: str) -> Inputs:
+    return fetch_files(fs, get_ogg_file_paths(fs, directory))
 
 
-def assort(fs: S3FileSystem, directory: str, stem_name: str) -> List[List[Tuple[str, FrozenSet[str]]]]:
-    stems = get_stems(fs, get_ogg_file_paths(fs, directory))
+def assort(
+    fs: S3FileSystem,
+    directory: str,
+    stem_name: str,
+    silence_index: SilenceIndex,
+    fingerprints: Dict[str, str],
+    inputs: Optional[Inputs] = None,
+) -> List[List[Tuple[str, FrozenSet[str]]]]:
+    # The stems of the directory are the prefetched files, when provided
+    paths = sorted(inputs) if inputs is not None else get_ogg_file_paths(fs, directory)
+    stems = get_stems(fs, paths, silence_index, fingerprints, inputs)
     current_stem_files = get_current_stem_files(stems, stem_name)
 
     assortments = []
@@ -164,61 +254,190 @@ def assort(fs: S3FileSystem, directory: str, stem_name: str) -> List[List[Tuple[
     return assortments
 
 
-def merge_stems(fs: S3FileSystem, ogg_files: List[str], output_file: str):
-    # Load the first stem as the base track
-    with fs.open(ogg_files[0], 'rb') as first_file:
-        bytes_io = io.BytesIO(first_file.read())  # type: ignore
-        merged_track = AudioSegment.from_file(bytes_io, format="ogg", codec='libopus')  # type: ignore
-    
-    # Load and overlay the rest of the stems
-    for ogg_file in ogg_files[1:]:
-        with fs.open(ogg_file, 'rb') as file:
-            bytes_io = io.BytesIO(file.read())  # type: ignore
-            stem = AudioSegment.from_file(bytes_io, format="ogg", codec='libopus')  # type: ignore
-            merged_track = merged_track.overlay(stem)
-    
-    # Export the final merged track to a single .ogg file
+def get_directory_silence_index(silence_index: SilenceIndex, directory: str) -> SilenceIndex:
+    return {file_path: info for file_path, info in silence_index.items() if os.path.dirname(file_path) == directory}
+
+
+def get_directory_fingerprints(files: Dict[str, str], directory: str) -> Dict[str, str]:
+    return {file_path: fingerprint for file_path, fingerprint in files.items() if os.path.dirname(file_path) == directory}
+
+
+def update_silence_index(fs: S3FileSystem, index_path: str, silence_index: SilenceIndex, directory_silence_indexes: List[SilenceIndex], files: Dict[str, str]) -> None:
+    # Results of failed tasks are skipped, their stems will be analyzed again on the next run
+    for directory_silence_index in directory_silence_indexes:
+        silence_index.update(directory_silence_index)
+    # Entries of the stems removed or modified since the listing are dropped
+    save_silence_index(fs, index_path, {file_path: info for file_path, info in silence_index.items() if info.fingerprint == files.get(file_path)})
+
+
+def split_directory_results(results: List[Tuple[SilenceIndex, TaskOutputs]]) -> Tuple[List[SilenceIndex], List[TaskOutputs]]:
+    return [silence_index for silence_index, _ in results], [outputs for _, outputs in results]
+
+
+def mix_stems(stems: List[np.ndarray]) -> np.ndarray:
+    # Mono stems are broadcast to all channels and shorter stems are padded with silence
+    channels = max([stem.shape[0] for stem in stems])
+    length = max([stem.shape[1] for stem in stems])
+    mixed_track = np.zeros((channels, length), dtype=np.float32)
+
+    for stem in stems:
+        mixed_track[:, :stem.shape[1]] += stem
+
+    # Scale the mix down instead of clipping it when the sum of the stems exceeds the available headroom
+    peak = np.max(np.abs(mixed_track)) if length > 0 else 0
+    if peak > MAX_MIX_PEAK:
+        mixed_track *= MAX_MIX_PEAK / peak
+
+    return mixed_track
+
+
+def merge_audio(cache: StemCache, ogg_files: List[str]) -> Tuple[np.ndarray, int]:
+    stems = [cache.get(ogg_file) for ogg_file in ogg_files]
+    sample_rates = {sr for _, sr in stems}
+    assert len(sample_rates) == 1, f'Stems have different sample rates: {sample_rates}'
+    return mix_stems([audio for audio, _ in stems]), stems[0][1]
+
+
+def export_ogg(fs: S3FileSystem, audio: np.ndarray, sample_rate: int, output_file: str) -> None:
+    # The file is encoded in memory first, so that it is uploaded with a single request
+    data = encode_ogg(audio, sample_rate)
     with fs.open(output_file, 'wb') as file:
-        bytes_io = io.BytesIO()
-        merged_track.export(bytes_io, format='ogg', codec='libopus')  # type: ignore
-        file.write(bytes_io.getvalue())  # type: ignore
+        file.write(data)  # type: ignore
+
+
+def merge_stems(fs: S3FileSystem, cache: StemCache, ogg_files: List[str], output_file: str, uploader: Optional[BackgroundUploader] = None):
+    merged_track, sr = merge_audio(cache, ogg_files)
+
+    # Export the final merged track to a single .ogg file. With an uploader, only the encoded file waits for the upload
+    if uploader is not None:
+        uploader.write(output_file, encode_ogg(merged_track, sr))
+    else:
+        export_ogg(fs, merged_track, sr, output_file)
 
 
-def assort_directory(params: Tuple[S3FileSystem, str, str, str, str]) -> None:
+def get_assortment_directory_name(relative_path: str, instrument_index: int, assortment_index: int) -> str:
+    return relative_path + f'-inst{instrument_index}-assort{assortment_index}'
 
-    fs, source_directory, output_directory, directory, stem_name = params
-    assortments = assort(fs, directory, stem_name)
+
+def group_outputs_by_directory(existing_outputs: FrozenSet[str], source_directory: str, output_directory: str) -> Dict[str, FrozenSet[str]]:
+    # Existing outputs are grouped by the source directory they were produced from, so each task only receives its own
+    groups: Dict[str, Set[str]] = {}
+
+    for output_key in existing_outputs:
+        assortment_directory = os.path.dirname(output_key)
+        match = ASSORTMENT_DIRECTORY_PATTERN.match(os.path.basename(assortment_directory))
+
+        if match is not None:
+            song_directory = os.path.join(os.path.dirname(assortment_directory), match.group('song'))
+            directory = os.path.join(source_directory, os.path.relpath(song_directory, output_directory))
+            groups.setdefault(directory, set()).add(output_key)
+
+    return {directory: frozenset(outputs) for directory, outputs in groups.items()}
+
+
+def assort_directory(
+    fs: S3FileSystem,
+    uploader: BackgroundUploader,
+    source_directory: str,
+    output_directory: str,
+    directory: str,
+    inputs: Inputs,
+    stem_name: str,
+    silence_index: SilenceIndex,
+    fingerprints: Dict[str, str],
+    existing_outputs: FrozenSet[str],
+) -> List[str]:
+
+    cache = StemCache(fs, inputs)
+    assortments = assort(fs, directory, stem_name, silence_index, fingerprints, inputs)
+    output_keys: List[str] = []
 
     # It is possible to have multiple stems for a stem name (e.g. "vocals" and "vocals_2")
     for i, stem_assortments in enumerate(assortments):
         relative_path = os.path.relpath(directory, source_directory)
 
         for j, assortment in enumerate(stem_assortments):
-            song_directory = os.path.join(output_directory, relative_path + f'-inst{i}-assort{j}')
+            song_directory = os.path.join(output_directory, get_assortment_directory_name(relative_path, i, j))
             stem, stems_to_merge = assortment
-            if not fs.exists(song_directory):
-                fs.makedirs(song_directory, exist_ok=True)
-            
             output_path = os.path.join(song_directory, "all.ogg")
-            if not fs.exists(output_path):
-                merge_stems(fs, list(stems_to_merge) + [stem], output_file=output_path)
-
             stem_output_file_path = os.path.join(song_directory, "stem.ogg")
-            if not fs.exists(stem_output_file_path):
-                fs.copy(stem, stem_output_file_path)
-
-
-def assort_and_merge_all(source_directory: str, output_directory: str, stem_name: str):
 
-    client = cast(Client, get_client(RUN_LOCALLY))
-    fs = S3FileSystem()
-
-    dirs = get_directories_containing_ogg_files(fs, source_directory)
-
-    params_list: List[Tuple[S3FileSystem, str, str, str, str]] = [(fs, source_directory, output_directory, directory, stem_name) for directory in dirs]
+            if output_path not in existing_outputs or stem_output_file_path not in existing_outputs:
+                fs.makedirs(song_directory, exist_ok=True)
 
-    print('Assorting and merging audio tracks')
-    progress(client.map(assort_directory, params_list, retries=2))
+            if output_path not in existing_outputs:
+                merge_stems(fs, cache, list(stems_to_merge) + [stem], output_file=output_path, uploader=uploader)
+
+            if stem_output_file_path not in existing_outputs:
+                uploader.copy(stem, stem_output_file_path)
+
+            output_keys += [output_path, stem_output_file_path]
+
+    return output_keys
+
+
+def assort_directories(params: AssortParams) -> Tuple[SilenceIndex, TaskOutputs]:
+
+    source_directory, output_directory, directories, stem_name, silence_index, fingerprints, existing_outputs = params
+    fs = get_filesystem()
+
+    # The stems of the next directories are downloaded while the current one is processed
+    with BackgroundUploader(fs) as uploader:
+        outputs = process_prefetched(
+            directories,
+            lambda directory: fetch_directory(fs, directory),
+            lambda directory, inputs: assort_directory(fs, uploader, source_directory, output_directory, directory, inputs, stem_name, silence_index, fingerprints, existing_outputs),
+            'merge',
+        )
+
+    return silence_index, outputs
+
+
+def get_assort_params(
+    source_directory: str,
+    output_directory: str,
+    directories: List[str],
+    stem_name: str,
+    silence_index: SilenceIndex,
+    files: Dict[str, str],
+    existing_outputs: Dict[str, FrozenSet[str]],
+) -> AssortParams:
+    return (
+        source_directory,
+        output_directory,
+        directories,
+        stem_name,
+        {file_path: info for directory in directories for file_path, info in get_directory_silence_index(silence_index, directory).items()},
+        {file_path: fingerprint for directory in directories for file_path, fingerprint in get_directory_fingerprints(files, directory).items()},
+        frozenset().union(*[existing_outputs.get(directory, frozenset()) for directory in directories]),
+    )
+
+
+def assort_and_merge_all(source_directory: str, output_directory: str, stem_name: str, silence_index_path: str = get_silence_index_path()):
+
+    fs = get_filesystem()
+
+    files = list_stem_files(fs, source_directory)
+    fingerprints = get_directories_fingerprints(files)
+    manifest_path = get_manifest_path(output_directory)
+    manifest = load_manifest(fs, manifest_path)
+    params_hash = get_merge_params_hash(stem_name)
+    dirs = get_pending_items(manifest, fingerprints, params_hash)
+    remove_stale_outputs(fs, manifest, dirs)
+    existing_outputs = group_outputs_by_directory(list_outputs(fs, output_directory), source_directory, output_directory)
+    silence_index = load_silence_index(fs, silence_index_path)
+
+    # Directories are grouped by size into tasks of similar duration, the longest tasks are submitted first
+    params_list: List[AssortParams] = [
+        get_assort_params(source_directory, output_directory, directories, stem_name, silence_index, files, existing_outputs)
+        for directories in partition_by_cost(get_directories_sizes(files, dirs), TASK_INPUT_SIZE)
+    ]
+
+    print(f'Assorting and merging audio tracks ({len(dirs)} of {len(fingerprints)} directories to process)')
+    results = run_tasks(get_executor(WORKER_POOL), assort_directories, params_list, 'Assorting and merging')
+    directory_silence_indexes, outputs = split_directory_results(results)
+    update_silence_index(fs, silence_index_path, silence_index, directory_silence_indexes, files)
+    update_manifest(fs, manifest_path, manifest, fingerprints, params_hash, outputs)
 
     return output_directory
 
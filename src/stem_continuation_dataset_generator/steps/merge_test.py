@@ -1,7 +1,19 @@
 
 
 import random
-from stem_continuation_dataset_generator.steps.merge import create_stems_assortments, get_stem
+from fsspec.implementations.local import LocalFileSystem
+import numpy as np
+import soundfile
+from stem_continuation_dataset_generator.steps.merge import (
+    MAX_MIX_PEAK,
+    create_stems_assortments,
+    get_silence_info,
+    get_stem,
+    group_outputs_by_directory,
+    mix_stems,
+    update_silence_index,
+)
+from stem_continuation_dataset_generator.utils.silence import SilenceInfo, load_silence_index
 from stem_continuation_dataset_generator.utils.constants import get_random_seed
 
 CURRENT_STEM_FILE = 'current'
@@ -61,4 +73,64 @@ def test_create_stems_assortments_all_silent() -> None:
     ]
     assortments = create_stems_assortments(other_stems, CURRENT_STEM_FILE)
 
-    assert assortments == []
\ No newline at end of file
+    assert assortments == []
+
+
+def test_mix_stems() -> None:
+
+    first = np.full((2, 4), 0.25, dtype=np.float32)
+    second = np.full((1, 2), 0.5, dtype=np.float32)
+    mixed_track = mix_stems([first, second])
+
+    assert mixed_track.shape == (2, 4)
+    assert mixed_track.dtype == np.float32
+    np.testing.assert_allclose(mixed_track, [[0.75, 0.75, 0.25, 0.25], [0.75, 0.75, 0.25, 0.25]])
+
+
+def test_mix_stems_headroom() -> None:
+
+    first = np.array([[0.8, -0.2]], dtype=np.float32)
+    second = np.array([[0.8, 0.2]], dtype=np.float32)
+    mixed_track = mix_stems([first, second])
+
+    assert np.max(np.abs(mixed_track)) <= MAX_MIX_PEAK
+    np.testing.assert_allclose(mixed_track, [[MAX_MIX_PEAK, 0]], atol=1e-6)
+
+
+def test_group_outputs_by_directory() -> None:
+    existing_outputs = frozenset({
+        'merged/artist/my-song-inst0-assort0/all.ogg',
+        'merged/artist/my-song-inst0-assort1/stem.ogg',
+        'merged/artist/other-inst1-assort0-augmented2/all.tok',
+        'merged/artist/unrelated/all.ogg',
+    })
+
+    assert group_outputs_by_directory(existing_outputs, 'original', 'merged') == {
+        'original/artist/my-song': frozenset({'merged/artist/my-song-inst0-assort0/all.ogg', 'merged/artist/my-song-inst0-assort1/stem.ogg'}),
+        'original/artist/other': frozenset({'merged/artist/other-inst1-assort0-augmented2/all.tok'}),
+    }
+
+
+def test_get_silence_info_modified_file(tmp_path) -> None:
+    fs = LocalFileSystem()
+    file_path = str(tmp_path / 'drum.ogg')
+    soundfile.write(file_path, np.full((48000, 2), 0.5, dtype=np.float32), 48000)
+    silence_index = {file_path: SilenceInfo(non_silent_ratio=0, intervals=[], sample_rate=48000, fingerprint='old')}
+
+    silence_info = get_silence_info(fs, file_path, 'new', silence_index)
+
+    assert silence_info.fingerprint == 'new'
+    assert silence_info.non_silent_ratio == 1
+    assert silence_index[file_path] == silence_info
+    assert get_silence_info(fs, file_path, 'new', silence_index) is silence_info
+
+
+def test_update_silence_index(tmp_path) -> None:
+    fs = LocalFileSystem()
+    index_path = str(tmp_path / 'silence-index.json')
+    silence_info = SilenceInfo(non_silent_ratio=1, intervals=[(0, 10)], sample_rate=48000, fingerprint='a')
+    silence_index = {'song/removed.ogg': silence_info, 'song/modified.ogg': silence_info}
+
+    update_silence_index(fs, index_path, silence_index, [{'song/drum.ogg': silence_info}], {'song/drum.ogg': 'a', 'song/modified.ogg': 'b'})
+
+    assert load_silence_index(fs, index_path) == {'song/drum.ogg': silence_info}
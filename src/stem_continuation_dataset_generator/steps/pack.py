@@ -0,0 +1,155 @@
+from dataclasses import asdict, dataclass
+import json
+import os
+import re
+from typing import List, Tuple, cast
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+from fsspec import AbstractFileSystem
+from s3fs.core import S3FileSystem
+from tqdm import tqdm
+
+from stem_continuation_dataset_generator.constants import get_packed_files_path, get_split_files_path
+from stem_continuation_dataset_generator.steps.split import SPLIT_NAMES, get_token_files_with_sizes, read_split_manifest
+from stem_continuation_dataset_generator.tokens import TOKENS_DTYPE, decode_tokens
+
+SHARD_TARGET_SIZE = 256 * 1024 * 1024  # In bytes
+SHARD_PAYLOAD_EXTENSION = '.bin'
+SHARD_INDEX_EXTENSION = '.index.json'
+
+# Name of the directories produced by the merge and augment steps, e.g. "song-inst0-assort1-augmented2"
+TRACK_DIRECTORY_PATTERN = re.compile(r'^(?P<song>.+)-inst(?P<instrument>\d+)-assort(?P<assortment>\d+)-(?P<augmentation>[^-]+)$')
+
+
+@dataclass
+class ShardEntry:
+    song: str
+    instrument: int
+    assortment: int
+    augmentation: str
+    track: str  # "all" or "stem"
+    offset: int  # In bytes, from the beginning of the shard payload
+    codebooks: int
+    length: int
+    frame_rate: float
+
+
+def parse_token_file_path(relative_path: str) -> Tuple[str, int, int, str, str]:
+    track_directory, file_name = os.path.split(relative_path)
+    artist_directory, track_directory_name = os.path.split(track_directory)
+    match = TRACK_DIRECTORY_PATTERN.match(track_directory_name)
+
+    if match is None:
+        raise ValueError(f'Unexpected token file path: {relative_path}')
+
+    return (
+        os.path.join(artist_directory, match.group('song')),
+        int(match.group('instrument')),
+        int(match.group('assortment')),
+        match.group('augmentation'),
+        os.path.splitext(file_name)[0],
+    )
+
+
+def get_split_token_files(fs: AbstractFileSystem, split_directory: str) -> Tuple[str, List[Tuple[str, int]]]:
+    # Returns the directory the token files are relative to and the files with their sizes, for copied and virtual splits
+    virtual_split = read_split_manifest(fs, split_directory)
+    source_directory, files = virtual_split if virtual_split is not None else (split_directory, get_token_files_with_sizes(fs, split_directory))
+    return source_directory, sorted(files.items())
+
+
+def group_into_shards(files: List[Tuple[str, int]], shard_size: int) -> List[List[str]]:
+    shards: List[List[str]] = []
+    current_shard: List[str] = []
+    current_shard_size = 0
+
+    for path, size in files:
+        if len(current_shard) > 0 and current_shard_size + size > shard_size:
+            shards.append(current_shard)
+            current_shard = []
+            current_shard_size = 0
+
+        current_shard.append(path)
+        current_shard_size += size
+
+    if len(current_shard) > 0:
+        shards.append(current_shard)
+
+    return shards
+
+
+def get_shard_paths(output_directory: str, shard_index: int) -> Tuple[str, str]:
+    shard_name = os.path.join(output_directory, f'shard-{shard_index:05d}')
+    return shard_name + SHARD_PAYLOAD_EXTENSION, shard_name + SHARD_INDEX_EXTENSION
+
+
+def write_shard(params: Tuple[AbstractFileSystem, List[str], str, str, int]) -> None:
+    fs, file_paths, source_directory, output_directory, shard_index = params
+    payload_path, index_path = get_shard_paths(output_directory, shard_index)
+    entries: List[ShardEntry] = []
+    offset = 0
+
+    with fs.open(payload_path, 'wb') as payload_file:
+        for file_path in file_paths:
+            codes, header = decode_tokens(cast(bytes, fs.cat_file(file_path)))
+            song, instrument, assortment, augmentation, track = parse_token_file_path(os.path.relpath(file_path, source_directory))
+            entries.append(ShardEntry(song, instrument, assortment, augmentation, track, offset, header.codebooks, header.length, header.frame_rate))
+            payload = codes.tobytes()
+            payload_file.write(payload)
+            offset += len(payload)
+
+    # The index is written last, so that a shard with an index is always complete
+    with fs.open(index_path, 'w') as index_file:
+        json.dump([asdict(entry) for entry in entries], index_file)
+
+
+def pack_split(fs: AbstractFileSystem, split_directory: str, output_directory: str, shard_size: int = SHARD_TARGET_SIZE) -> str:
+    source_directory, files = get_split_token_files(fs, split_directory)
+    shards = group_into_shards(files, shard_size)
+
+    # The shards of a previous run are removed, so that none of them outlives the current ones
+    if fs.exists(output_directory):
+        fs.rm(output_directory, recursive=True)
+
+    fs.makedirs(output_directory, exist_ok=True)
+    params = [(fs, file_paths, source_directory, output_directory, i) for i, file_paths in enumerate(shards)]
+
+    with multiprocessing.pool.ThreadPool(multiprocessing.cpu_count()) as pool:
+        list(tqdm(pool.imap(write_shard, params), total=len(params)))
+
+    return output_directory
+
+
+def pack_all(source_directory: str, output_directory: str, shard_size: int = SHARD_TARGET_SIZE) -> List[str]:
+    """
+    Packs the token files of each split into a small number of large shards. Each shard is made of the concatenated
+    token payloads and a JSON index with the offset and metadata of each entry.
+    """
+    fs = S3FileSystem(use_listings_cache=False)
+    output_directories = []
+
+    for split_name in SPLIT_NAMES:
+        print(f'Packing split {split_name}')
+        output_directories.append(pack_split(fs, os.path.join(source_directory, split_name), os.path.join(output_directory, split_name), shard_size))
+
+    return output_directories
+
+
+def read_shard_index(fs: AbstractFileSystem, index_path: str) -> List[ShardEntry]:
+    with fs.open(index_path, 'r') as index_file:
+        return [ShardEntry(**entry) for entry in json.load(index_file)]
+
+
+def memmap_shard(payload_path: str) -> np.ndarray:
+    return np.memmap(payload_path, dtype=TOKENS_DTYPE, mode='r')
+
+
+def read_shard_entry(payload: np.ndarray, entry: ShardEntry) -> np.ndarray:
+    # The payload is the whole shard as a uint16 array (e.g. from memmap_shard), the returned codes are a view on it
+    start = entry.offset // TOKENS_DTYPE.itemsize
+    return payload[start:start + entry.codebooks * entry.length].reshape((entry.codebooks, entry.length))
+
+
+if __name__ == '__main__':
+    pack_all(get_split_files_path(), get_packed_files_path())
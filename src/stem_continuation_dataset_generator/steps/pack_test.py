@@ -0,0 +1,90 @@
+import os
+
+from fsspec.implementations.local import LocalFileSystem
+import numpy as np
+import pytest
+
+from stem_continuation_dataset_generator.steps.pack import (
+    SHARD_INDEX_EXTENSION,
+    group_into_shards,
+    memmap_shard,
+    pack_split,
+    parse_token_file_path,
+    read_shard_entry,
+    read_shard_index,
+)
+from stem_continuation_dataset_generator.steps.split import get_token_files_with_sizes, write_split_manifest
+from stem_continuation_dataset_generator.tokens import encode_tokens
+
+
+def test_parse_token_file_path() -> None:
+    assert parse_token_file_path('artist/my-song-inst1-assort2-augmented3/stem.tok') == ('artist/my-song', 1, 2, 'augmented3', 'stem')
+    assert parse_token_file_path('artist/song-inst0-assort0-original/all.tok') == ('artist/song', 0, 0, 'original', 'all')
+
+    with pytest.raises(ValueError):
+        parse_token_file_path('artist/song/all.tok')
+
+
+def test_group_into_shards() -> None:
+    files = [('a', 4), ('b', 4), ('c', 10), ('d', 1), ('e', 1)]
+
+    assert group_into_shards(files, 8) == [['a', 'b'], ['c'], ['d', 'e']]
+    assert group_into_shards([], 8) == []
+
+
+def test_pack_split(tmp_path) -> None:
+    fs = LocalFileSystem()
+    source_directory = str(tmp_path / 'split')
+    output_directory = str(tmp_path / 'packed')
+    rng = np.random.default_rng(0)
+    expected_codes = {}
+
+    for augmentation in ['original', 'augmented0', 'augmented1']:
+        for track in ['all', 'stem']:
+            codes = rng.integers(0, 2048, (4, int(rng.integers(1, 100))))
+            directory = os.path.join(source_directory, 'artist', f'song-inst0-assort1-{augmentation}')
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f'{track}.tok'), 'wb') as file:
+                file.write(encode_tokens(codes, 50, f'artist/song-inst0-assort1-{augmentation}/{track}'))
+            expected_codes[(augmentation, track)] = codes
+
+    pack_split(fs, source_directory, output_directory, shard_size=1024)
+
+    index_paths = sorted(fs.glob(os.path.join(output_directory, f'*{SHARD_INDEX_EXTENSION}')))
+    assert len(index_paths) > 1
+
+    entries_count = 0
+    for index_path in index_paths:
+        payload = memmap_shard(index_path.replace(SHARD_INDEX_EXTENSION, '.bin'))
+        for entry in read_shard_index(fs, index_path):
+            assert (entry.song, entry.instrument, entry.assortment) == ('artist/song', 0, 1)
+            assert entry.frame_rate == 50
+            assert np.array_equal(read_shard_entry(payload, entry), expected_codes[(entry.augmentation, entry.track)])
+            entries_count += 1
+
+    assert entries_count == len(expected_codes)
+
+    # Packing again in fewer shards leaves no shard of the previous run
+    pack_split(fs, source_directory, output_directory)
+    assert len(fs.glob(os.path.join(output_directory, '*'))) == 2
+
+
+def test_pack_virtual_split(tmp_path) -> None:
+    fs = LocalFileSystem()
+    source_directory = str(tmp_path / 'encoded')
+    split_directory = str(tmp_path / 'split' / 'train')
+    output_directory = str(tmp_path / 'packed')
+    codes = np.random.default_rng(0).integers(0, 2048, (4, 10))
+    directory = os.path.join(source_directory, 'artist', 'song-inst0-assort1-original')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'all.tok'), 'wb') as file:
+        file.write(encode_tokens(codes, 50, 'artist/song-inst0-assort1-original/all'))
+
+    # The split only lists the files of the encoded directory
+    write_split_manifest(fs, split_directory, source_directory, get_token_files_with_sizes(fs, source_directory))
+    pack_split(fs, split_directory, output_directory)
+
+    index_path = os.path.join(output_directory, f'shard-00000{SHARD_INDEX_EXTENSION}')
+    (entry,) = read_shard_index(fs, index_path)
+    assert (entry.song, entry.augmentation, entry.track) == ('artist/song', 'original', 'all')
+    assert np.array_equal(read_shard_entry(memmap_shard(index_path.replace(SHARD_INDEX_EXTENSION, '.bin')), entry), codes)
@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+import glob
+import multiprocessing
+import os
+import shutil
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+from zipfile import ZipFile
+from fsspec.core import url_to_fs
+from tqdm import tqdm
+
+from stem_continuation_dataset_generator.audio_io import transcode_to_ogg
+
+ORIGINAL_FILES_DIR = os.path.join('../dataset/original')
+BITRATE = 160000
+AUDIO_FILE_EXTENSIONS = ['.wav']
+IGNORED_DIRECTORIES = ['__MACOSX']  # Resource forks added by macOS, which are not extracted
+
+# Archive or loose file, member of the archive (None for a loose file) and output path
+PrepareParams = Tuple[str, Optional[str], str]
+
+
+def get_compressed_files(dir: str) -> List[str]:
+    return glob.glob(os.path.join(dir, '**/*.zip'), recursive=True)
+
+
+def is_audio_file(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in AUDIO_FILE_EXTENSIONS
+
+
+def is_ignored(path: str) -> bool:
+    return any([part in IGNORED_DIRECTORIES for part in path.split('/')])
+
+
+def get_audio_files(dir: str) -> List[str]:
+    # Audio files already outside of the archives
+    files = glob.glob(os.path.join(dir, '**/*'), recursive=True)
+    return [file for file in files if is_audio_file(file) and not is_ignored(os.path.relpath(file, dir))]
+
+
+def get_members(zip_file_path: str) -> List[str]:
+    with ZipFile(zip_file_path, 'r') as zip_file:
+        return [member.filename for member in zip_file.infolist() if not member.is_dir() and not is_ignored(member.filename)]
+
+
+def get_audio_members(zip_file_path: str) -> List[str]:
+    return [member_name for member_name in get_members(zip_file_path) if is_audio_file(member_name)]
+
+
+def get_output_file_name(file_name: str) -> str:
+    # Audio files are converted to Ogg Opus, the other files are copied as they are
+    return os.path.splitext(file_name)[0] + '.ogg' if is_audio_file(file_name) else file_name
+
+
+def get_output_path(zip_file_path: str, member_name: str, source_directory: str, destination: str) -> str:
+    # Members are written where extracting the archive would have put them
+    relative_directory = os.path.relpath(os.path.dirname(zip_file_path), source_directory)
+    return os.path.join(destination, relative_directory, get_output_file_name(member_name))
+
+
+def get_file_output_path(file_path: str, source_directory: str, destination: str) -> str:
+    return os.path.join(destination, get_output_file_name(os.path.relpath(file_path, source_directory)))
+
+
+@contextmanager
+def open_input(source_path: str, member_name: Optional[str]) -> Iterator[IO[bytes]]:
+    if member_name is None:
+        with open(source_path, 'rb') as input_file:
+            yield input_file
+    else:
+        with ZipFile(source_path, 'r') as zip_file, zip_file.open(member_name) as member_file:
+            yield member_file
+
+
+def convert_member(params: PrepareParams) -> Tuple[str, Optional[str]]:
+    source_path, member_name, output_path = params
+    name = member_name if member_name is not None else source_path
+
+    try:
+        fs, path = url_to_fs(output_path)
+        fs.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open_input(source_path, member_name) as input_file, fs.open(path, 'wb') as output_file:
+            if is_audio_file(name):
+                transcode_to_ogg(input_file, output_file, bitrate=BITRATE)
+            else:
+                shutil.copyfileobj(input_file, output_file)
+
+        return source_path, None
+
+    except Exception as e:
+        return source_path, f'Unable to prepare {name} from {source_path}: {e}'
+
+
+def prepare_archives(source_directory: str, destination: Optional[str] = None, workers: Optional[int] = None, remove_archives: bool = True) -> str:
+    """
+    Converts the audio files of the source directory, whether contained in its zip archives or not, to Ogg Opus using a
+    process per core. The other members of the archives are copied as they are. Archive members are streamed to the
+    encoder and the results are written to the destination, which can be any fsspec URL (e.g. an S3 bucket) and defaults
+    to the source directory. Archives and audio files are only removed once all their contents have been written.
+    """
+    destination = destination if destination is not None else source_directory
+    files = get_compressed_files(source_directory)
+    audio_files = get_audio_files(source_directory)
+    params_list: List[PrepareParams] = [(file_path, None, get_file_output_path(file_path, source_directory, destination)) for file_path in audio_files]
+    failed_sources: Dict[str, List[str]] = {}
+
+    for zip_file_path in tqdm(files, 'Listing archives'):
+        try:
+            members = get_members(zip_file_path)
+            params_list += [(zip_file_path, member_name, get_output_path(zip_file_path, member_name, source_directory, destination)) for member_name in members]
+        except Exception as e:
+            failed_sources[zip_file_path] = [f'Unable to read archive: {e}']
+
+    with multiprocessing.Pool(workers if workers is not None else multiprocessing.cpu_count()) as pool:
+        for zip_file_path, error in tqdm(pool.imap_unordered(convert_member, params_list), total=len(params_list), desc='Converting files to Ogg Opus format'):
+            if error is not None:
+                failed_sources.setdefault(zip_file_path, []).append(error)
+
+    for file_path in files + audio_files:
+        if file_path in failed_sources:
+            print(f'Unable to prepare file: {file_path}')
+            print('\n'.join(failed_sources[file_path]))
+        elif remove_archives is True:
+            os.remove(file_path)
+
+    return destination
+
+
+if __name__ == '__main__':
+    prepare_archives(ORIGINAL_FILES_DIR)
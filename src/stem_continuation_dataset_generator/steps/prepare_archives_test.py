@@ -0,0 +1,64 @@
+import io
+import os
+from zipfile import ZipFile
+
+import numpy as np
+import soundfile
+
+from stem_continuation_dataset_generator.steps.prepare_archives import get_audio_members, prepare_archives
+
+SAMPLE_RATE = 44100
+
+
+def get_wav_bytes(duration: float) -> bytes:
+    audio = np.random.default_rng(0).uniform(-0.5, 0.5, (int(SAMPLE_RATE * duration), 2)).astype(np.float32)
+    data = io.BytesIO()
+    soundfile.write(data, audio, SAMPLE_RATE, format='WAV', subtype='PCM_16')
+    return data.getvalue()
+
+
+def test_prepare_archives(tmp_path) -> None:
+    source_directory = tmp_path / 'source'
+    destination = tmp_path / 'destination'
+    os.makedirs(source_directory / 'artist')
+    zip_file_path = source_directory / 'artist' / 'song.zip'
+
+    with ZipFile(zip_file_path, 'w') as zip_file:
+        zip_file.writestr('song/drum.wav', get_wav_bytes(1))
+        zip_file.writestr('song/bass.wav', get_wav_bytes(2))
+        zip_file.writestr('song/notes.txt', 'not audio')
+        zip_file.writestr('__MACOSX/song/._drum.wav', 'resource fork')
+
+    assert sorted(get_audio_members(str(zip_file_path))) == ['song/bass.wav', 'song/drum.wav']
+
+    prepare_archives(str(source_directory), str(destination), workers=2)
+
+    assert not zip_file_path.exists()
+    assert sorted(os.listdir(destination / 'artist' / 'song')) == ['bass.ogg', 'drum.ogg', 'notes.txt']
+    assert (destination / 'artist' / 'song' / 'notes.txt').read_text() == 'not audio'
+
+    info = soundfile.info(destination / 'artist' / 'song' / 'bass.ogg')
+    assert info.channels == 2
+    assert abs(info.duration - 2) < 0.05
+
+
+def test_prepare_archives_keeps_failed_archives(tmp_path) -> None:
+    zip_file_path = tmp_path / 'song.zip'
+
+    with ZipFile(zip_file_path, 'w') as zip_file:
+        zip_file.writestr('drum.wav', b'not a wav file')
+
+    prepare_archives(str(tmp_path), workers=1)
+
+    assert zip_file_path.exists()
+
+
+def test_prepare_archives_converts_audio_files(tmp_path) -> None:
+    os.makedirs(tmp_path / 'song')
+    file_path = tmp_path / 'song' / 'drum.wav'
+    file_path.write_bytes(get_wav_bytes(1))
+
+    prepare_archives(str(tmp_path), workers=1)
+
+    assert not file_path.exists()
+    assert abs(soundfile.info(tmp_path / 'song' / 'drum.ogg').duration - 1) < 0.05
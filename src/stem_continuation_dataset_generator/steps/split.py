@@ -1,25 +1,36 @@
+import json
 import os
 import random
-from typing import List, Set, Tuple, cast
+from typing import Any, Dict, List, Optional, Tuple, cast
+from fsspec import AbstractFileSystem
+from fsspec.asyn import AsyncFileSystem
 from s3fs.core import S3FileSystem
 from sklearn.model_selection import train_test_split
-from tqdm import tqdm
-from multiprocessing.pool import Pool 
-import multiprocessing
 
 from stem_continuation_dataset_generator.constants import get_encoded_files_path, get_split_files_path
+from stem_continuation_dataset_generator.tokens import TOKENS_FILE_EXTENSION
+from stem_continuation_dataset_generator.utils.bulk_copy import COPY_CONCURRENCY, CopyPair, copy_files
 from stem_continuation_dataset_generator.utils.constants import get_random_seed
+from stem_continuation_dataset_generator.utils.retry import RETRY_ATTEMPTS, RETRY_BASE_DELAY, retry
 
 SPLIT_NAMES = ['train', 'validation', 'test']
 VALIDATION_SIZE = 0.12
 TEST_SIZE = 0.06
 
+# Set this flag to True to write the list of the files of each split instead of copying them
+VIRTUAL_SPLITS = False
+SPLIT_MANIFEST_FILE_NAME = 'split.json'
 
-def get_directories_containing_pkl_files(fs: S3FileSystem, dir: str) -> Set[str]:
-    files = cast(List[str], fs.glob(os.path.join(dir, '**/*.pkl')))
-    directories = {os.path.dirname(file) for file in files}
-    
-    return directories
+
+def get_token_files_with_sizes(fs: AbstractFileSystem, dir: str) -> Dict[str, int]:
+    # A single recursive listing, instead of a listing per artist
+    files = cast(Dict[str, Dict[str, Any]], fs.find(dir, detail=True))
+    return {path: int(info['size']) for path, info in sorted(files.items()) if path.endswith(TOKENS_FILE_EXTENSION)}
+
+
+def get_artist(file_path: str, source_directory: str) -> str:
+    # Token files are stored as "artist/song-inst0-assort0-original/all.tok"
+    return os.path.relpath(file_path, source_directory).split(os.sep)[0]
 
 
 def split_by_artist(artists, validation_size, test_size, seed=get_random_seed()) -> Tuple[List[str], List[str], List[str]]:
@@ -29,22 +40,58 @@ def split_by_artist(artists, validation_size, test_size, seed=get_random_seed())
     return train_artists, validation_artists, test_artists
 
 
-def copy_artist(params: Tuple[S3FileSystem, str, str, str]) -> None:
-    fs, source_directory, output_directory, artist = params
-    artist_path = os.path.join(source_directory, artist)
-    relative_path = os.path.relpath(artist_path, source_directory)
-    file_output_dir = os.path.join(output_directory, relative_path)
-    fs.copy(artist_path, file_output_dir, recursive=True)
+def get_split_manifest_path(split_directory: str) -> str:
+    return os.path.join(split_directory, SPLIT_MANIFEST_FILE_NAME)
+
+
+def write_split_manifest(fs: AbstractFileSystem, split_directory: str, source_directory: str, files: Dict[str, int]) -> None:
+    fs.makedirs(split_directory, exist_ok=True)
+
+    with fs.open(get_split_manifest_path(split_directory), 'w') as manifest_file:
+        json.dump({'source_directory': source_directory, 'files': files}, manifest_file)
+
+
+def read_split_manifest(fs: AbstractFileSystem, split_directory: str) -> Optional[Tuple[str, Dict[str, int]]]:
+    # Returns the directory the files of a virtual split are stored in and their sizes, or None for a copied split
+    manifest_path = get_split_manifest_path(split_directory)
+
+    if not fs.exists(manifest_path):
+        return None
+
+    with fs.open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
 
+    return manifest['source_directory'], manifest['files']
 
-def split_all(source_directory: str, output_directory: str) -> List[str]:
-    
-    fs = S3FileSystem(use_listings_cache=False)
 
-    file_paths = get_directories_containing_pkl_files(fs, source_directory)
-    file_paths_artists = [os.path.split(os.path.split(file_path)[0])[-1] for file_path in file_paths]
+def get_copy_pairs(files: List[str], source_directory: str, split_directory: str) -> List[CopyPair]:
+    return [(file_path, os.path.join(split_directory, os.path.relpath(file_path, source_directory))) for file_path in files]
 
-    artists = list(set(file_paths_artists))
+
+def copy_split_files(fs: AsyncFileSystem, pairs: List[CopyPair], attempts: int = RETRY_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY) -> None:
+    """Copies the files, copying the failed ones again. An error is raised when some of them still fail after the retries."""
+    pending = list(pairs)
+
+    def copy_pending() -> None:
+        failures = copy_files(fs, pending)
+
+        if len(failures) > 0:
+            pending[:] = [pair for pair, _ in failures]
+            (source, _), error = failures[0]
+            raise IOError(f'Unable to copy {len(failures)} files, e.g. {source}: {error}')
+
+    retry(copy_pending, 'Copying the split files', attempts, base_delay)
+
+
+def split_all(source_directory: str, output_directory: str, virtual: bool = VIRTUAL_SPLITS) -> List[str]:
+    """
+    Splits the token files by artist. The files of each split are copied into the split directory, or, for virtual
+    splits, only listed in a manifest stored in the split directory.
+    """
+    fs = S3FileSystem(use_listings_cache=False, config_kwargs={'max_pool_connections': COPY_CONCURRENCY})
+
+    files = get_token_files_with_sizes(fs, source_directory)
+    artists = sorted(set([get_artist(file_path, source_directory) for file_path in files]))
     splits = split_by_artist(artists, validation_size=VALIDATION_SIZE, test_size=TEST_SIZE)
     output_directories = []
 
@@ -52,15 +99,22 @@ def split_all(source_directory: str, output_directory: str) -> List[str]:
         print(f'Creating split {SPLIT_NAMES[i]}')
 
         split_directory = os.path.join(output_directory, SPLIT_NAMES[i])
-        params: List[Tuple[S3FileSystem, str, str, str]] = [(fs, source_directory, split_directory, artist) for artist in split]
+        split_artists = set(split)
+        split_files = {file_path: size for file_path, size in files.items() if get_artist(file_path, source_directory) in split_artists}
+
+        if virtual is True:
+            write_split_manifest(fs, split_directory, source_directory, split_files)
+        else:
+            if fs.exists(get_split_manifest_path(split_directory)):
+                fs.rm(get_split_manifest_path(split_directory))
+
+            copy_split_files(cast(AsyncFileSystem, fs), get_copy_pairs(list(split_files), source_directory, split_directory))
 
-        with Pool(multiprocessing.cpu_count()) as pool:
-            list(tqdm(pool.imap(copy_artist, params), total=len(params)))
-            output_directories.append(split_directory)
+        output_directories.append(split_directory)
 
     return output_directories
 
 
 if __name__ == '__main__':
     random.seed(get_random_seed())
-    split_all(get_encoded_files_path(), get_split_files_path())
\ No newline at end of file
+    split_all(get_encoded_files_path(), get_split_files_path())
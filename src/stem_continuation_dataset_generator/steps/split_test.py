@@ -0,0 +1,52 @@
+import os
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+from fsspec.implementations.local import LocalFileSystem
+import pytest
+
+from stem_continuation_dataset_generator.steps.split import copy_split_files, get_artist, get_copy_pairs, read_split_manifest, write_split_manifest
+from stem_continuation_dataset_generator.utils.bulk_copy import copy_files
+
+
+def test_get_artist() -> None:
+    assert get_artist('bucket/encoded/artist/song-inst0-assort1-original/all.tok', 'bucket/encoded') == 'artist'
+
+
+def test_split_manifest(tmp_path) -> None:
+    fs = LocalFileSystem()
+    split_directory = str(tmp_path / 'split' / 'train')
+    files = {'bucket/encoded/artist/song-inst0-assort1-original/all.tok': 100}
+
+    assert read_split_manifest(fs, split_directory) is None
+
+    write_split_manifest(fs, split_directory, 'bucket/encoded', files)
+
+    assert read_split_manifest(fs, split_directory) == ('bucket/encoded', files)
+
+
+def test_copy_files(tmp_path) -> None:
+    fs = AsyncFileSystemWrapper(LocalFileSystem(auto_mkdir=True))
+    source_directory, split_directory = str(tmp_path / 'encoded'), str(tmp_path / 'split' / 'train')
+    files = [os.path.join(source_directory, 'artist', f'song-inst0-assort{i}-original', 'all.tok') for i in range(10)]
+
+    for i, file_path in enumerate(files):
+        os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as file:
+            file.write(bytes([i]))
+
+    failures = copy_files(fs, get_copy_pairs(files, source_directory, split_directory) + [(str(tmp_path / 'missing'), str(tmp_path / 'copy'))], concurrency=4)
+
+    assert [source for (source, _), _ in failures] == [str(tmp_path / 'missing')]
+    for i in range(10):
+        with open(os.path.join(split_directory, 'artist', f'song-inst0-assort{i}-original', 'all.tok'), 'rb') as file:
+            assert file.read() == bytes([i])
+
+
+def test_copy_split_files(tmp_path) -> None:
+    fs = AsyncFileSystemWrapper(LocalFileSystem(auto_mkdir=True))
+    (tmp_path / 'file').write_bytes(b'tokens')
+
+    copy_split_files(fs, [(str(tmp_path / 'file'), str(tmp_path / 'copy'))], base_delay=0)
+    assert (tmp_path / 'copy').read_bytes() == b'tokens'
+
+    with pytest.raises(IOError):
+        copy_split_files(fs, [(str(tmp_path / 'missing'), str(tmp_path / 'copy'))], attempts=2, base_delay=0)
@@ -0,0 +1,322 @@
+from collections import deque
+from dataclasses import dataclass, field
+import random
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, cast
+from fsspec import AbstractFileSystem
+from tqdm import tqdm
+
+from stem_continuation_dataset_generator.executor import CompletedFutures, TaskExecutor, get_executor
+from stem_continuation_dataset_generator.constants import (
+    DEFAULT_STEM_NAME,
+    get_augmented_files_path,
+    get_distorted_files_path,
+    get_encoded_files_path,
+    get_merged_files_path,
+    get_original_files_path,
+    get_silence_index_path,
+)
+from stem_continuation_dataset_generator.steps.augment import (
+    TASK_INPUT_SIZE as AUGMENT_TASK_INPUT_SIZE,
+    WORKER_POOL as AUGMENT_WORKER_POOL,
+    augment,
+    get_augment_params,
+    get_augment_params_hash,
+    get_full_track_file,
+    get_full_track_fingerprints,
+    get_pair_sizes,
+    list_track_files,
+)
+from stem_continuation_dataset_generator.steps.distort import (
+    TASK_INPUT_SIZE as DISTORT_TASK_INPUT_SIZE,
+    WORKER_POOL as DISTORT_WORKER_POOL,
+    distort,
+    get_distort_params,
+    get_distort_params_hash,
+    get_rir_bank_path_if_enabled,
+)
+from stem_continuation_dataset_generator.steps.encode import (
+    TASK_INPUT_SIZE as ENCODE_TASK_INPUT_SIZE,
+    WORKER_POOL as ENCODE_WORKER_POOL,
+    encode,
+    get_encode_params,
+    get_encode_params_hash,
+    is_ogg_file,
+)
+from stem_continuation_dataset_generator.steps.merge import (
+    TASK_INPUT_SIZE as MERGE_TASK_INPUT_SIZE,
+    WORKER_POOL as MERGE_WORKER_POOL,
+    assort_directories,
+    get_assort_params,
+    get_directories_fingerprints,
+    get_directories_sizes,
+    get_merge_params_hash,
+    group_outputs_by_directory,
+    list_stem_files,
+    update_silence_index,
+)
+from stem_continuation_dataset_generator.utils.constants import get_random_seed
+from stem_continuation_dataset_generator.utils.filesystem import get_filesystem
+from stem_continuation_dataset_generator.utils.manifest import (
+    Manifest,
+    TaskOutputs,
+    get_manifest_path,
+    get_pending_items,
+    get_size,
+    list_files,
+    list_outputs,
+    load_manifest,
+    remove_stale_outputs,
+    update_manifest,
+)
+from stem_continuation_dataset_generator.utils.partition import partition_by_cost
+from stem_continuation_dataset_generator.utils.rir_bank import ensure_rir_bank
+from stem_continuation_dataset_generator.utils.silence import load_silence_index
+
+
+@dataclass
+class StageConfig:
+    max_tasks: int  # Tasks of the stage submitted to the cluster and not completed yet
+    items_per_task: int  # Items produced by the previous stage are processed in tasks of this many items
+    max_queued_items: int  # While more items are waiting for this stage, the previous stage stops submitting tasks
+
+
+DEFAULT_STAGE_CONFIGS: Dict[str, StageConfig] = {
+    'merge': StageConfig(max_tasks=50, items_per_task=4, max_queued_items=0),
+    'augment': StageConfig(max_tasks=50, items_per_task=4, max_queued_items=400),
+    'distort': StageConfig(max_tasks=20, items_per_task=4, max_queued_items=400),
+    'encode': StageConfig(max_tasks=12, items_per_task=16, max_queued_items=800),
+}
+
+
+@dataclass
+class Stage:
+    name: str
+    config: StageConfig
+    executor: TaskExecutor  # Executor of the worker pool of the stage
+    task: Callable[[Any], Any]
+    # Parameters of a task processing the items. Items produced during the run (streamed) do not reuse previous outputs
+    get_params: Callable[[List[str], bool], Any]
+    get_outputs: Callable[[Any], TaskOutputs] = lambda result: cast(TaskOutputs, result)
+    # Items of the next stage produced by a task
+    get_next_items: Callable[[TaskOutputs], List[str]] = lambda outputs: []
+    # Called with the items produced by the previous stage before they are queued, e.g. to remove their stale outputs
+    prepare_streamed_items: Callable[[List[str]], None] = lambda items: None
+    queue: Deque[Tuple[List[str], bool]] = field(default_factory=deque)
+    seen_items: Set[str] = field(default_factory=set)
+    running_tasks: int = 0
+    results: List[Any] = field(default_factory=list)
+    progress: Optional[tqdm] = None
+
+
+def get_queued_items(stage: Stage) -> int:
+    return sum([len(items) for items, _ in stage.queue])
+
+
+def enqueue(stage: Stage, units: List[List[str]], streamed: bool) -> None:
+    for items in units:
+        stage.seen_items.update(items)
+        stage.queue.append((items, streamed))
+
+    if stage.progress is not None:
+        stage.progress.total = (stage.progress.total or 0) + len(units)
+        stage.progress.refresh()
+
+
+def stream_items(stage: Stage, items: List[str]) -> None:
+    # Items already queued (e.g. pending since a previous run) are not processed twice
+    new_items = [item for item in dict.fromkeys(items) if item not in stage.seen_items]
+
+    if len(new_items) > 0:
+        stage.prepare_streamed_items(new_items)
+        enqueue(stage, partition_by_cost({item: 1 for item in new_items}, stage.config.items_per_task), streamed=True)
+
+
+def can_submit(stage: Stage, next_stage: Optional[Stage]) -> bool:
+    has_capacity = stage.running_tasks < stage.config.max_tasks
+    has_room_downstream = next_stage is None or get_queued_items(next_stage) < next_stage.config.max_queued_items
+    return len(stage.queue) > 0 and has_capacity and has_room_downstream
+
+
+def submit_ready_tasks(stages: List[Stage], futures: CompletedFutures, submitted: Dict[Any, int]) -> None:
+    # Later stages are served first and have a higher priority, so that the items in flight reach the end of the pipeline
+    for i in reversed(range(len(stages))):
+        stage, next_stage = stages[i], stages[i + 1] if i + 1 < len(stages) else None
+
+        while can_submit(stage, next_stage):
+            items, streamed = stage.queue.popleft()
+            future = stage.executor.submit(stage.task, stage.get_params(items, streamed), priority=i)
+            futures.add(future)
+            submitted[future] = i
+            stage.running_tasks += 1
+
+
+def run_stages(stages: List[Stage]) -> None:
+    """
+    Runs the queued tasks of the stages on their executors. As soon as a task completes, the items it produced are queued
+    for the next stage, so that an item does not wait for the whole previous stage. A stage runs at most max_tasks tasks
+    at a time and stops submitting while the next stage has more than max_queued_items items waiting.
+    """
+    futures = CompletedFutures()
+    submitted: Dict[Any, int] = {}
+    submit_ready_tasks(stages, futures, submitted)
+
+    for future in futures:
+        i = submitted.pop(future)
+        stage = stages[i]
+        stage.running_tasks -= 1
+
+        if stage.progress is not None:
+            stage.progress.update()
+
+        error = future.exception()
+
+        if error is not None:
+            # The items of failed tasks are not recorded in the manifests, they will be processed again on the next run
+            print(f'A {stage.name} task failed: {error}')
+
+        else:
+            result = future.result()
+            stage.results.append(result)
+
+            if i + 1 < len(stages):
+                stream_items(stages[i + 1], stage.get_next_items(stage.get_outputs(result)))
+
+        submit_ready_tasks(stages, futures, submitted)
+
+    assert all([len(stage.queue) == 0 for stage in stages])
+
+
+def prepare_stage(fs: AbstractFileSystem, fingerprints: Dict[str, str], output_directory: str, params_hash: str) -> Tuple[str, Manifest, List[str]]:
+    manifest_path = get_manifest_path(output_directory)
+    manifest = load_manifest(fs, manifest_path)
+    pending_items = get_pending_items(manifest, fingerprints, params_hash)
+    remove_stale_outputs(fs, manifest, pending_items)
+    return manifest_path, manifest, pending_items
+
+
+def get_full_track_outputs(outputs: TaskOutputs) -> List[str]:
+    return [path for output_keys in outputs.values() for path in output_keys if get_full_track_file(path) == path]
+
+
+def get_all_outputs(outputs: TaskOutputs) -> List[str]:
+    return [path for output_keys in outputs.values() for path in output_keys]
+
+
+def stream_all(
+    source_directory: str,
+    merged_directory: str,
+    augmented_directory: str,
+    distorted_directory: str,
+    encoded_directory: str,
+    stem_name: str,
+    silence_index_path: str = get_silence_index_path(),
+    stage_configs: Dict[str, StageConfig] = DEFAULT_STAGE_CONFIGS,
+):
+    """
+    Runs merge, augment, distort and encode on the executors of their worker pools, streaming each item to the next stage as soon as it
+    is produced instead of waiting for the whole stage. Items pending since a previous run are resumed at their stage.
+    The manifests are updated once all the stages are done.
+    """
+    fs = get_filesystem()
+
+    stem_files = list_stem_files(fs, source_directory)
+    merge_fingerprints = get_directories_fingerprints(stem_files)
+    merge_params_hash = get_merge_params_hash(stem_name)
+    merge_manifest_path, merge_manifest, pending_directories = prepare_stage(fs, merge_fingerprints, merged_directory, merge_params_hash)
+    merge_existing_outputs = group_outputs_by_directory(list_outputs(fs, merged_directory), source_directory, merged_directory)
+    silence_index = load_silence_index(fs, silence_index_path)
+
+    merged_files = list_track_files(fs, merged_directory)
+    augment_params_hash = get_augment_params_hash()
+    augment_manifest_path, augment_manifest, pending_merged_files = prepare_stage(fs, get_full_track_fingerprints(merged_files), augmented_directory, augment_params_hash)
+    augment_existing_outputs = list_outputs(fs, augmented_directory)
+
+    augmented_files = list_track_files(fs, augmented_directory)
+    rir_bank_path = get_rir_bank_path_if_enabled()
+    distort_params_hash = get_distort_params_hash(rir_bank_path)
+    distort_manifest_path, distort_manifest, pending_augmented_files = prepare_stage(fs, get_full_track_fingerprints(augmented_files), distorted_directory, distort_params_hash)
+    distort_existing_outputs = list_outputs(fs, distorted_directory)
+
+    distorted_files = list_files(fs, distorted_directory, is_ogg_file)
+    encode_params_hash = get_encode_params_hash()
+    encode_manifest_path, encode_manifest, pending_distorted_files = prepare_stage(fs, distorted_files, encoded_directory, encode_params_hash)
+    encode_existing_outputs = list_outputs(fs, encoded_directory)
+
+    if rir_bank_path is not None:
+        ensure_rir_bank(fs, rir_bank_path)
+
+    stages = [
+        Stage(
+            'merge',
+            stage_configs['merge'],
+            get_executor(MERGE_WORKER_POOL),
+            assort_directories,
+            lambda directories, _: get_assort_params(source_directory, merged_directory, directories, stem_name, silence_index, stem_files, merge_existing_outputs),
+            get_outputs=lambda result: result[1],
+            get_next_items=get_full_track_outputs,
+        ),
+        Stage(
+            'augment',
+            stage_configs['augment'],
+            get_executor(AUGMENT_WORKER_POOL),
+            augment,
+            lambda files, streamed: get_augment_params(files, merged_directory, augmented_directory, frozenset() if streamed else augment_existing_outputs),
+            get_next_items=get_full_track_outputs,
+            prepare_streamed_items=lambda files: remove_stale_outputs(fs, augment_manifest, files),
+        ),
+        Stage(
+            'distort',
+            stage_configs['distort'],
+            get_executor(DISTORT_WORKER_POOL),
+            distort,
+            lambda files, streamed: get_distort_params(files, augmented_directory, distorted_directory, frozenset() if streamed else distort_existing_outputs, rir_bank_path),
+            get_next_items=get_all_outputs,
+            prepare_streamed_items=lambda files: remove_stale_outputs(fs, distort_manifest, files),
+        ),
+        Stage(
+            'encode',
+            stage_configs['encode'],
+            get_executor(ENCODE_WORKER_POOL),
+            encode,
+            lambda files, streamed: get_encode_params(files, distorted_directory, encoded_directory, frozenset() if streamed else encode_existing_outputs),
+            prepare_streamed_items=lambda files: remove_stale_outputs(fs, encode_manifest, files),
+        ),
+    ]
+
+    # The items pending at startup are grouped by size, like in the stage drivers
+    merge_stage, augment_stage, distort_stage, encode_stage = stages
+    enqueue(merge_stage, partition_by_cost(get_directories_sizes(stem_files, pending_directories), MERGE_TASK_INPUT_SIZE), streamed=False)
+    enqueue(augment_stage, partition_by_cost(get_pair_sizes(merged_files, pending_merged_files), AUGMENT_TASK_INPUT_SIZE), streamed=False)
+    enqueue(distort_stage, partition_by_cost(get_pair_sizes(augmented_files, pending_augmented_files), DISTORT_TASK_INPUT_SIZE), streamed=False)
+    enqueue(encode_stage, partition_by_cost({file: get_size(distorted_files[file]) for file in pending_distorted_files}, ENCODE_TASK_INPUT_SIZE), streamed=False)
+
+    print(f'Streaming audio tracks through merge, augment, distort and encode ({len(pending_directories)} of {len(merge_fingerprints)} directories to merge)')
+    for i, stage in enumerate(stages):
+        stage.progress = tqdm(desc=stage.name, total=len(stage.queue), unit='task', position=i)
+
+    run_stages(stages)
+
+    for stage in stages:
+        cast(tqdm, stage.progress).close()
+
+    update_silence_index(fs, silence_index_path, silence_index, [directory_silence_index for directory_silence_index, _ in merge_stage.results], stem_files)
+    update_manifest(fs, merge_manifest_path, merge_manifest, merge_fingerprints, merge_params_hash, [outputs for _, outputs in merge_stage.results])
+
+    # The inputs of the other stages were produced during the run, so they are listed again to get their fingerprints
+    update_manifest(fs, augment_manifest_path, augment_manifest, get_full_track_fingerprints(list_track_files(fs, merged_directory)), augment_params_hash, augment_stage.results)
+    update_manifest(fs, distort_manifest_path, distort_manifest, get_full_track_fingerprints(list_track_files(fs, augmented_directory)), distort_params_hash, distort_stage.results)
+    update_manifest(fs, encode_manifest_path, encode_manifest, list_files(fs, distorted_directory, is_ogg_file), encode_params_hash, encode_stage.results)
+
+    return encoded_directory
+
+
+if __name__ == '__main__':
+    random.seed(get_random_seed())
+    stream_all(
+        get_original_files_path(),
+        get_merged_files_path(),
+        get_augmented_files_path(),
+        get_distorted_files_path(),
+        get_encoded_files_path(),
+        DEFAULT_STEM_NAME,
+    )
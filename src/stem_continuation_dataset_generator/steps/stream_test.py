@@ -0,0 +1,72 @@
+import time
+from typing import Dict, List, Tuple
+from dask.distributed import Client, get_worker
+import pytest
+
+from stem_continuation_dataset_generator.cluster import CPU_DSP_POOL, ENCODER_POOL, get_local_cluster, get_pool_resources
+from stem_continuation_dataset_generator.executor import DaskExecutor
+from stem_continuation_dataset_generator.steps.stream import Stage, StageConfig, enqueue, run_stages
+from stem_continuation_dataset_generator.utils.manifest import TaskOutputs
+
+# Stage name, completion time and worker of each task
+completions: List[Tuple[str, float, str]] = []
+
+
+def split(items: List[str]) -> TaskOutputs:
+    time.sleep(0.05)
+    completions.append(('split', time.monotonic(), str(get_worker().name)))
+    return {item: [f'{item}-a', f'{item}-b'] for item in items}
+
+
+def collect(items: List[str]) -> TaskOutputs:
+    time.sleep(0.05)
+    completions.append(('collect', time.monotonic(), str(get_worker().name)))
+    if 'fail-a' in items:
+        raise ValueError('Failed')
+    return {item: [] for item in items}
+
+
+@pytest.fixture
+def client():
+    with get_local_cluster(processes=False) as cluster, cluster.get_client() as client:
+        client.wait_for_workers(len(cluster.worker_spec))
+        yield client
+
+
+def test_run_stages(client: Client) -> None:
+    completions.clear()
+    stages = [
+        Stage(
+            'split',
+            StageConfig(max_tasks=1, items_per_task=1, max_queued_items=0),
+            DaskExecutor(client, get_pool_resources(CPU_DSP_POOL)),
+            split,
+            lambda items, _: items,
+            get_next_items=lambda outputs: sum(outputs.values(), []),
+        ),
+        Stage(
+            'collect',
+            StageConfig(max_tasks=2, items_per_task=2, max_queued_items=4),
+            DaskExecutor(client, get_pool_resources(ENCODER_POOL)),
+            collect,
+            lambda items, _: items,
+        ),
+    ]
+    streamed_items: Dict[str, List[str]] = {}
+    stages[1].prepare_streamed_items = lambda items: streamed_items.setdefault('collect', []).extend(items)
+    enqueue(stages[0], [['first'], ['second'], ['third'], ['fail']], streamed=False)
+    enqueue(stages[1], [['first-a']], streamed=False)
+
+    run_stages(stages)
+
+    # Items already queued are not processed again, items of failed tasks are not recorded
+    assert sorted(streamed_items['collect']) == ['fail-a', 'fail-b', 'first-b', 'second-a', 'second-b', 'third-a', 'third-b']
+    assert sorted([item for outputs in stages[1].results for item in outputs]) == ['first-a', 'first-b', 'second-a', 'second-b', 'third-a', 'third-b']
+
+    # Items reach the next stage before the previous stage is done
+    first_collect = min([completion for stage, completion, _ in completions if stage == 'collect'])
+    last_split = max([completion for stage, completion, _ in completions if stage == 'split'])
+    assert first_collect < last_split
+
+    # The tasks of each stage run on the workers of its pool
+    assert all([worker_name.startswith(f'{CPU_DSP_POOL}-' if stage == 'split' else f'{ENCODER_POOL}-') for stage, _, worker_name in completions])
@@ -1,13 +1,28 @@
+from functools import partial
+import queue
+import shutil
 import tempfile
-from typing import List, cast, Tuple
+import threading
+from typing import Any, Callable, Dict, List, Union, cast, Tuple
 import os
+from clearml import Dataset
+from fsspec import AbstractFileSystem
 from s3fs.core import S3FileSystem
 from tqdm import tqdm
 import multiprocessing
 import multiprocessing.pool
 
 from stem_continuation_dataset_generator.constants import CLEARML_DATASET_VERSION, DATASET_TAGS, get_split_files_path
-from stem_continuation_dataset_generator.utils.utils import upload_dataset
+from stem_continuation_dataset_generator.steps.pack import group_into_shards
+from stem_continuation_dataset_generator.utils.retry import retry
+from stem_continuation_dataset_generator.utils.utils import create_dataset
+
+UPLOAD_DISK_BUDGET = 16 * 1024 * 1024 * 1024  # In bytes, maximum size of the files staged on the local disk
+STAGED_BATCHES = 2  # A batch is uploaded while the next one is downloaded
+DOWNLOAD_THREADS = multiprocessing.cpu_count()
+
+# Directory of a downloaded batch, the error raised while downloading, or None once all the batches are downloaded
+StagedBatch = Union[str, Exception, None]
 
 
 def get_input_dirs(split_files_path: str) -> List[str]:
@@ -18,51 +33,107 @@ def get_input_dirs(split_files_path: str) -> List[str]:
     ]
 
 
-def get_files(fs: S3FileSystem, dir: str) -> List[str]:
-    return [path for path in cast(List[str], fs.glob(os.path.join(dir, '**/*.pkl')))]
+def get_files_with_sizes(fs: AbstractFileSystem, dir: str) -> List[Tuple[str, int]]:
+    # Either token files or packed shards with their indexes
+    files = cast(Dict[str, Dict[str, Any]], fs.find(dir, detail=True))
+    return sorted([(path, int(info['size'])) for path, info in files.items()])
 
 
-def download_file(params: Tuple[S3FileSystem, str, str, str]):
+def download_file(params: Tuple[AbstractFileSystem, str, str, str]) -> None:
     (fs, file, source_directory, output_directory) = params
     local_file_path = os.path.join(output_directory, os.path.relpath(file, source_directory))
-    if not os.path.exists(local_file_path):
+    os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+    retry(lambda: fs.get_file(file, local_file_path), f'Downloading {file}')
+
+
+def stage_batches(
+    fs: AbstractFileSystem,
+    batches: List[List[str]],
+    source_directory: str,
+    staging_directory: str,
+    staged_batches: 'queue.Queue[StagedBatch]',
+    free_slots: threading.Semaphore,
+    stop: threading.Event,
+) -> None:
+    # Producer: downloads the batches in order, waiting for an uploaded batch to be removed before staging a new one. It
+    # stops as soon as possible once the consumer is gone, e.g. after a failed upload
+    try:
+        with multiprocessing.pool.ThreadPool(DOWNLOAD_THREADS) as pool:
+            for i, batch in enumerate(batches):
+                free_slots.acquire()
+
+                if stop.is_set():
+                    return
+
+                batch_directory = os.path.join(staging_directory, f'batch-{i:05d}')
+                params = [(fs, file, source_directory, batch_directory) for file in batch]
+                list(pool.imap_unordered(lambda file_params: download_file(file_params) if not stop.is_set() else None, params))
+                staged_batches.put(batch_directory)
+
+        staged_batches.put(None)
+
+    except Exception as e:
+        staged_batches.put(e)
+
+
+def upload_split(fs: AbstractFileSystem, split_directory: str, upload_batch: Callable[[str], None], disk_budget: int = UPLOAD_DISK_BUDGET) -> None:
+    """
+    Downloads the files of the split in batches and uploads each batch while the next one is being downloaded. At most
+    STAGED_BATCHES batches are on the local disk at any time, so the staged files fit in the disk budget (unless a single
+    file is larger than a batch).
+    """
+    batches = group_into_shards(get_files_with_sizes(fs, split_directory), disk_budget // STAGED_BATCHES)
+    staged_batches: 'queue.Queue[StagedBatch]' = queue.Queue()
+    free_slots = threading.Semaphore(STAGED_BATCHES)
+    stop = threading.Event()
+
+    with tempfile.TemporaryDirectory() as staging_directory:
+        producer = threading.Thread(
+            target=stage_batches,
+            args=(fs, batches, split_directory, staging_directory, staged_batches, free_slots, stop),
+            daemon=True,
+        )
+        producer.start()
+
         try:
-            fs.get(file, local_file_path, recursive=True)
-        except Exception as e:
-            print('Error getting the file, retrying')
-            print(e)
-            try:
-                fs.get(file, local_file_path, recursive=True)
-            except Exception as e2:
-                print('Error getting the file, retrying')
-                print(e2)
-                try:
-                    fs.get(file, local_file_path, recursive=True)
-                except Exception as e3:
-                    print('Error getting the file, abandoning')
-                    print(e3)
-
-
-def upload(split_files_path: str, tags: List[str]):
-    
+            with tqdm(total=len(batches), desc='Uploading batches') as progress:
+                while (batch_directory := staged_batches.get()) is not None:
+                    if isinstance(batch_directory, Exception):
+                        raise batch_directory
+
+                    upload_batch(batch_directory)
+                    shutil.rmtree(batch_directory)
+                    free_slots.release()
+                    progress.update()
+
+        finally:
+            # The producer is stopped, and unblocked if waiting for a free slot, before the staging directory is removed
+            stop.set()
+            free_slots.release()
+            producer.join()
+
+
+def upload_batch_to_dataset(dataset: Dataset, batch_directory: str) -> None:
+    # Each call uploads only the files added since the previous one
+    dataset.add_files(path=batch_directory)
+    dataset.upload(show_progress=True, preview=False)
+
+
+def upload(split_files_path: str, tags: List[str], disk_budget: int = UPLOAD_DISK_BUDGET):
+
     fs = S3FileSystem(use_listings_cache=False)
     input_dirs = get_input_dirs(split_files_path)
 
     for split_dir in input_dirs:
         set = os.path.split(split_dir)[1]
-        
-        with tempfile.TemporaryDirectory() as local_directory:
-            print(f'Downloading {set} dataset (folder {split_dir}) from S3 into {local_directory}')
-            
-            files = get_files(fs, split_dir)
-            inputs = [(fs, file, split_dir, local_directory) for file in files]
+        dataset = create_dataset(CLEARML_DATASET_VERSION, tags + ['final'], set)
 
-            with multiprocessing.pool.ThreadPool(multiprocessing.cpu_count()) as pool:
-                list(tqdm(pool.imap(download_file, inputs), total=len(inputs)))
+        print(f'Uploading {set} dataset (folder {split_dir}) to ClearML')
+        upload_split(fs, split_dir, partial(upload_batch_to_dataset, dataset), disk_budget)
 
-            print(f'Uploading {set} dataset to ClearML')
-            upload_dataset(path=local_directory, version=CLEARML_DATASET_VERSION, tags=tags + ['final'], dataset_set=set)
+        print('Finalizing')
+        dataset.finalize()
 
 
 if __name__ == '__main__':
-    upload(get_split_files_path(), DATASET_TAGS)
\ No newline at end of file
+    upload(get_split_files_path(), DATASET_TAGS)
@@ -0,0 +1,50 @@
+import os
+from typing import List, Tuple
+from fsspec.implementations.local import LocalFileSystem
+import pytest
+
+from stem_continuation_dataset_generator.steps.upload import STAGED_BATCHES, upload_split
+
+FILE_SIZE = 100
+
+
+def get_directory_size(directory: str) -> int:
+    return sum([os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(directory) for file in files])
+
+
+def test_upload_split(tmp_path) -> None:
+    fs = LocalFileSystem()
+    split_directory = str(tmp_path / 'packed' / 'train')
+    os.makedirs(split_directory)
+
+    for i in range(10):
+        with open(os.path.join(split_directory, f'shard-{i:05d}.bin'), 'wb') as file:
+            file.write(bytes([i]) * FILE_SIZE)
+
+    uploaded: List[Tuple[List[str], int]] = []
+
+    def upload_batch(batch_directory: str) -> None:
+        # Files of the batch, and size of all the batches staged while the batch is uploaded
+        uploaded.append((sorted(os.listdir(batch_directory)), get_directory_size(os.path.dirname(batch_directory))))
+
+    upload_split(fs, split_directory, upload_batch, disk_budget=FILE_SIZE * 2 * STAGED_BATCHES)
+
+    assert [files for files, _ in uploaded] == [[f'shard-{i:05d}.bin', f'shard-{i + 1:05d}.bin'] for i in range(0, 10, 2)]
+    assert all([staged_size <= FILE_SIZE * 2 * STAGED_BATCHES for _, staged_size in uploaded])
+
+
+def test_upload_split_failure(tmp_path) -> None:
+    fs = LocalFileSystem()
+    split_directory = str(tmp_path / 'packed' / 'train')
+    os.makedirs(split_directory)
+
+    for i in range(10):
+        with open(os.path.join(split_directory, f'shard-{i:05d}.bin'), 'wb') as file:
+            file.write(bytes([i]) * FILE_SIZE)
+
+    def upload_batch(batch_directory: str) -> None:
+        raise IOError('Upload failed')
+
+    # The error of the upload is raised once the producer has stopped
+    with pytest.raises(IOError, match='Upload failed'):
+        upload_split(fs, split_directory, upload_batch, disk_budget=FILE_SIZE * STAGED_BATCHES)
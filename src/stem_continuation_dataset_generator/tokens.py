@@ -0,0 +1,105 @@
+from dataclasses import dataclass
+from os import PathLike
+import struct
+from typing import BinaryIO, Tuple, Union
+import numpy as np
+from torch import Tensor
+
+from stem_continuation_dataset_generator.utils.constants import VOCAB_SIZE
+
+# Token files are made of a small header followed by the codes, stored as a C-ordered (codebooks, length) uint16 array
+TOKENS_FILE_EXTENSION = '.tok'
+TOKENS_FILE_MAGIC = b'SCDT'
+TOKENS_FILE_VERSION = 1
+HEADER_FORMAT = '<4sHHQfI'  # Magic, version, codebooks, length, frame rate, source id length
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+PAYLOAD_ALIGNMENT = 64
+TOKENS_DTYPE = np.dtype('<u2')
+
+
+@dataclass
+class TokensHeader:
+    codebooks: int
+    length: int
+    frame_rate: float
+    source_id: str
+    payload_offset: int
+
+
+def get_payload_offset(source_id_length: int) -> int:
+    header_length = HEADER_SIZE + source_id_length
+    return header_length + (-header_length % PAYLOAD_ALIGNMENT)
+
+
+def encode_tokens(codes: Union[Tensor, np.ndarray], frame_rate: float, source_id: str) -> bytes:
+    codes_array = codes.detach().cpu().numpy() if isinstance(codes, Tensor) else np.asarray(codes)
+    assert codes_array.ndim == 2, f'Expected codes with shape (codebooks, length), got {codes_array.shape}'
+    assert codes_array.size == 0 or (codes_array.min() >= 0 and codes_array.max() < VOCAB_SIZE), 'Codes out of the vocabulary range'
+
+    codebooks, length = codes_array.shape
+    encoded_source_id = source_id.encode('utf-8')
+    payload_offset = get_payload_offset(len(encoded_source_id))
+    header = struct.pack(HEADER_FORMAT, TOKENS_FILE_MAGIC, TOKENS_FILE_VERSION, codebooks, length, frame_rate, len(encoded_source_id))
+    padding = b'\0' * (payload_offset - HEADER_SIZE - len(encoded_source_id))
+
+    return header + encoded_source_id + padding + np.ascontiguousarray(codes_array, dtype=TOKENS_DTYPE).tobytes()
+
+
+def write_tokens(file: BinaryIO, codes: Union[Tensor, np.ndarray], frame_rate: float, source_id: str) -> None:
+    file.write(encode_tokens(codes, frame_rate, source_id))
+
+
+def unpack_header(data: bytes) -> Tuple[int, int, float, int]:
+    if len(data) < HEADER_SIZE:
+        raise ValueError('Invalid tokens file: header is truncated')
+
+    magic, version, codebooks, length, frame_rate, source_id_length = struct.unpack_from(HEADER_FORMAT, data)
+
+    if magic != TOKENS_FILE_MAGIC:
+        raise ValueError('Invalid tokens file: wrong magic number')
+    if version != TOKENS_FILE_VERSION:
+        raise ValueError(f'Unsupported tokens file version: {version}')
+
+    return codebooks, length, frame_rate, source_id_length
+
+
+def parse_tokens_header(data: bytes) -> TokensHeader:
+    codebooks, length, frame_rate, source_id_length = unpack_header(data)
+    source_id = bytes(data[HEADER_SIZE:HEADER_SIZE + source_id_length]).decode('utf-8')
+
+    return TokensHeader(
+        codebooks=codebooks,
+        length=length,
+        frame_rate=frame_rate,
+        source_id=source_id,
+        payload_offset=get_payload_offset(source_id_length),
+    )
+
+
+def decode_tokens(data: bytes) -> Tuple[np.ndarray, TokensHeader]:
+    # The returned array is a read-only view on the data, no copy is performed
+    header = parse_tokens_header(data)
+    codes = np.frombuffer(data, dtype=TOKENS_DTYPE, count=header.codebooks * header.length, offset=header.payload_offset)
+    return codes.reshape((header.codebooks, header.length)), header
+
+
+def read_tokens(file: BinaryIO) -> Tuple[np.ndarray, TokensHeader]:
+    return decode_tokens(file.read())
+
+
+def read_tokens_header(file: BinaryIO) -> TokensHeader:
+    data = file.read(HEADER_SIZE)
+    *_, source_id_length = unpack_header(data)
+    return parse_tokens_header(data + file.read(source_id_length))
+
+
+def memmap_tokens(path: Union[str, PathLike]) -> Tuple[np.ndarray, TokensHeader]:
+    with open(path, 'rb') as file:
+        header = read_tokens_header(file)
+
+    shape = (header.codebooks, header.length)
+
+    if header.codebooks * header.length == 0:
+        return np.zeros(shape, dtype=TOKENS_DTYPE), header
+
+    return np.memmap(path, dtype=TOKENS_DTYPE, mode='r', offset=header.payload_offset, shape=shape), header
@@ -0,0 +1,76 @@
+import io
+import pickle
+
+from fsspec.implementations.local import LocalFileSystem
+import numpy as np
+import pytest
+import torch
+
+from stem_continuation_dataset_generator.steps.convert_tokens import PICKLED_TOKENS_FRAME_RATE, convert_file
+from stem_continuation_dataset_generator.tokens import PAYLOAD_ALIGNMENT, TOKENS_DTYPE, encode_tokens, memmap_tokens, read_tokens, read_tokens_header, write_tokens
+from stem_continuation_dataset_generator.utils.constants import VOCAB_SIZE
+
+FRAME_RATE = 50
+SOURCE_ID = 'artist/song-inst0-assort0-original/all'
+
+
+def get_codes() -> torch.Tensor:
+    return torch.randint(0, VOCAB_SIZE, (4, 1000), generator=torch.Generator().manual_seed(0))
+
+
+def test_read_tokens() -> None:
+    codes = get_codes()
+    file = io.BytesIO()
+    write_tokens(file, codes, FRAME_RATE, SOURCE_ID)
+    file.seek(0)
+
+    read_codes, header = read_tokens(file)
+
+    assert read_codes.dtype == TOKENS_DTYPE
+    assert np.array_equal(read_codes, codes.numpy())
+    assert header.codebooks == 4 and header.length == 1000
+    assert header.frame_rate == FRAME_RATE
+    assert header.source_id == SOURCE_ID
+    assert header.payload_offset % PAYLOAD_ALIGNMENT == 0
+
+
+def test_memmap_tokens(tmp_path) -> None:
+    codes = get_codes()
+    path = tmp_path / 'all.tok'
+    path.write_bytes(encode_tokens(codes, FRAME_RATE, SOURCE_ID))
+
+    with open(path, 'rb') as file:
+        header = read_tokens_header(file)
+    mapped_codes, mapped_header = memmap_tokens(path)
+
+    assert mapped_header == header
+    assert isinstance(mapped_codes, np.memmap)
+    assert np.array_equal(mapped_codes, codes.numpy())
+    assert path.stat().st_size == header.payload_offset + codes.numel() * 2
+
+
+def test_encode_tokens_out_of_vocabulary() -> None:
+    with pytest.raises(AssertionError):
+        encode_tokens(np.array([[VOCAB_SIZE]]), FRAME_RATE, SOURCE_ID)
+
+
+def test_read_tokens_invalid_file() -> None:
+    with pytest.raises(ValueError):
+        read_tokens(io.BytesIO(b'not a tokens file' * 4))
+
+
+def test_convert_file(tmp_path) -> None:
+    fs = LocalFileSystem()
+    codes = get_codes()
+    pickle_path = tmp_path / 'artist' / 'song' / 'all.pkl'
+    pickle_path.parent.mkdir(parents=True)
+    with open(pickle_path, 'wb') as file:
+        pickle.dump(codes, file)
+
+    convert_file((fs, str(pickle_path), str(tmp_path), True))
+
+    read_codes, header = memmap_tokens(tmp_path / 'artist' / 'song' / 'all.tok')
+    assert not pickle_path.exists()
+    assert np.array_equal(read_codes, codes.numpy())
+    assert header.source_id == 'artist/song/all'
+    assert header.frame_rate == PICKLED_TOKENS_FRAME_RATE
@@ -0,0 +1,37 @@
+import asyncio
+from typing import Iterator, List, Tuple
+from fsspec.asyn import AsyncFileSystem, sync
+from tqdm import tqdm
+
+# Number of copies in flight. The connection pool of the filesystem should be at least as large
+# (e.g. S3FileSystem(config_kwargs={'max_pool_connections': COPY_CONCURRENCY})).
+COPY_CONCURRENCY = 64
+
+# Source and destination paths
+CopyPair = Tuple[str, str]
+
+
+async def copy_files_async(fs: AsyncFileSystem, pairs: List[CopyPair], concurrency: int, progress: tqdm) -> List[Tuple[CopyPair, Exception]]:
+    pending: Iterator[CopyPair] = iter(pairs)
+    failures: List[Tuple[CopyPair, Exception]] = []
+
+    async def copy_worker() -> None:
+        # Workers share the iterator, so that at most one copy per worker is in flight and the window stays bounded
+        for source, destination in pending:
+            try:
+                await fs._cp_file(source, destination)
+            except Exception as e:
+                failures.append(((source, destination), e))
+            progress.update()
+
+    await asyncio.gather(*[copy_worker() for _ in range(min(concurrency, len(pairs)))])
+    return failures
+
+
+def copy_files(fs: AsyncFileSystem, pairs: List[CopyPair], concurrency: int = COPY_CONCURRENCY) -> List[Tuple[CopyPair, Exception]]:
+    """
+    Copies the files concurrently on the event loop of the filesystem, reusing its connections. On S3 each copy is done
+    server side, so no bytes go through this machine. Returns the copies that failed.
+    """
+    with tqdm(total=len(pairs), desc='Copying files') as progress:
+        return sync(fs.loop, copy_files_async, fs, pairs, concurrency, progress)
@@ -0,0 +1,8 @@
+from functools import lru_cache
+from s3fs.core import S3FileSystem
+
+
+@lru_cache(maxsize=1)
+def get_filesystem() -> S3FileSystem:
+    # Created once per worker process and reused by its tasks, instead of being pickled into the parameters of each task
+    return S3FileSystem(use_listings_cache=False)
@@ -0,0 +1,149 @@
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, cast
+from fsspec import AbstractFileSystem
+
+MANIFEST_FILE_EXTENSION = '.manifest.sqlite'
+
+
+@dataclass
+class ManifestEntry:
+    fingerprint: str  # ETag (or modification time) and size of the inputs of the work item
+    params_hash: str
+    output_keys: List[str]
+
+
+# Completed work items of a stage, by input key
+Manifest = Dict[str, ManifestEntry]
+
+# Outputs produced by a task, by input key
+TaskOutputs = Dict[str, List[str]]
+
+
+def get_manifest_path(output_directory: str) -> str:
+    # The manifest is stored alongside the output prefix, e.g. "bucket/drum/augmented.manifest.sqlite"
+    return output_directory.rstrip('/') + MANIFEST_FILE_EXTENSION
+
+
+def get_fingerprint(info: Dict[str, Any]) -> str:
+    version = str(info.get('ETag', info.get('mtime', ''))).strip('"')
+    return f'{version}:{info["size"]}'
+
+
+def get_size(fingerprint: str) -> int:
+    # Size in bytes of a file, from its fingerprint
+    return int(fingerprint.rsplit(':', 1)[1])
+
+
+def combine_fingerprints(fingerprints: List[str]) -> str:
+    return hashlib.sha1('|'.join(sorted(fingerprints)).encode('utf-8')).hexdigest()
+
+
+def get_params_hash(stage: str, params: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps([stage, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def list_files(fs: AbstractFileSystem, dir: str, file_filter: Callable[[str], bool]) -> Dict[str, str]:
+    """Lists the files under the directory with a single recursive listing, returning the fingerprint of each file."""
+    files = cast(Dict[str, Dict[str, Any]], fs.find(dir, detail=True))
+    return {path: get_fingerprint(info) for path, info in sorted(files.items()) if file_filter(path)}
+
+
+def list_outputs(fs: AbstractFileSystem, output_directory: str) -> FrozenSet[str]:
+    # Listing the output prefix once replaces an existence probe per output in the tasks
+    return frozenset(cast(List[str], fs.find(output_directory)))
+
+
+def filter_existing(existing_outputs: FrozenSet[str], output_keys: Iterable[str]) -> FrozenSet[str]:
+    return frozenset({output_key for output_key in output_keys if output_key in existing_outputs})
+
+
+def group_fingerprints(files: Dict[str, str], get_input_key: Callable[[str], str]) -> Dict[str, str]:
+    groups: Dict[str, List[str]] = {}
+
+    for path, fingerprint in files.items():
+        groups.setdefault(get_input_key(path), []).append(f'{os.path.basename(path)}:{fingerprint}')
+
+    return {input_key: combine_fingerprints(fingerprints) for input_key, fingerprints in groups.items()}
+
+
+def group_sizes(files: Dict[str, str], get_input_key: Callable[[str], str]) -> Dict[str, int]:
+    # Total size of the files of each work item, used as an estimate of the cost of processing it
+    sizes: Dict[str, int] = {}
+
+    for path, fingerprint in files.items():
+        input_key = get_input_key(path)
+        sizes[input_key] = sizes.get(input_key, 0) + get_size(fingerprint)
+
+    return sizes
+
+
+def get_pending_items(manifest: Manifest, fingerprints: Dict[str, str], params_hash: str) -> List[str]:
+    # New items, items whose inputs changed and items produced with different parameters
+    return [
+        input_key
+        for input_key, fingerprint in fingerprints.items()
+        if input_key not in manifest or manifest[input_key].fingerprint != fingerprint or manifest[input_key].params_hash != params_hash
+    ]
+
+
+def remove_stale_outputs(fs: AbstractFileSystem, manifest: Manifest, pending_items: List[str]) -> None:
+    # Outputs of changed items are removed, so that tasks skipping existing outputs produce them again
+    stale_outputs = [output_key for input_key in pending_items if input_key in manifest for output_key in manifest.pop(input_key).output_keys]
+    existing_outputs = [output_key for output_key in stale_outputs if fs.exists(output_key)]
+
+    if len(existing_outputs) > 0:
+        fs.rm(existing_outputs)
+
+
+def load_manifest(fs: AbstractFileSystem, manifest_path: str) -> Manifest:
+    if not fs.exists(manifest_path):
+        return {}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_path = os.path.join(temp_dir, os.path.basename(manifest_path))
+        fs.get(manifest_path, local_path)
+
+        with sqlite3.connect(local_path) as connection:
+            rows = connection.execute('SELECT input_key, fingerprint, params_hash, output_keys FROM items').fetchall()
+        connection.close()
+
+    return {
+        input_key: ManifestEntry(fingerprint=fingerprint, params_hash=params_hash, output_keys=json.loads(output_keys))
+        for input_key, fingerprint, params_hash, output_keys in rows
+    }
+
+
+def save_manifest(fs: AbstractFileSystem, manifest_path: str, manifest: Manifest) -> None:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_path = os.path.join(temp_dir, os.path.basename(manifest_path))
+
+        with sqlite3.connect(local_path) as connection:
+            connection.execute('CREATE TABLE items (input_key TEXT PRIMARY KEY, fingerprint TEXT, params_hash TEXT, output_keys TEXT)')
+            connection.executemany(
+                'INSERT INTO items VALUES (?, ?, ?, ?)',
+                [(input_key, entry.fingerprint, entry.params_hash, json.dumps(entry.output_keys)) for input_key, entry in manifest.items()],
+            )
+        connection.close()
+
+        fs.put(local_path, manifest_path)
+
+
+def update_manifest(
+    fs: AbstractFileSystem,
+    manifest_path: str,
+    manifest: Manifest,
+    fingerprints: Dict[str, str],
+    params_hash: str,
+    outputs: List[TaskOutputs],
+) -> None:
+    # Only the items of successful tasks are recorded, the others will be scheduled again on the next run
+    for task_outputs in outputs:
+        for input_key, output_keys in task_outputs.items():
+            manifest[input_key] = ManifestEntry(fingerprint=fingerprints[input_key], params_hash=params_hash, output_keys=output_keys)
+
+    save_manifest(fs, manifest_path, manifest)
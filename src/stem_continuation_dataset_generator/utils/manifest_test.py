@@ -0,0 +1,77 @@
+import os
+
+from fsspec.implementations.local import LocalFileSystem
+
+from stem_continuation_dataset_generator.utils.manifest import (
+    ManifestEntry,
+    get_manifest_path,
+    get_pending_items,
+    group_fingerprints,
+    group_sizes,
+    list_files,
+    load_manifest,
+    remove_stale_outputs,
+    save_manifest,
+    update_manifest,
+)
+
+
+def test_save_and_load_manifest(tmp_path) -> None:
+    fs = LocalFileSystem()
+    manifest_path = get_manifest_path(str(tmp_path / 'merged'))
+    manifest = {
+        'original/artist/song': ManifestEntry(fingerprint='abc', params_hash='def', output_keys=['merged/artist/song-inst0-assort0/all.ogg']),
+    }
+
+    assert load_manifest(fs, manifest_path) == {}
+
+    save_manifest(fs, manifest_path, manifest)
+
+    assert manifest_path.endswith('merged.manifest.sqlite')
+    assert load_manifest(fs, manifest_path) == manifest
+
+
+def test_incremental_run(tmp_path) -> None:
+    fs = LocalFileSystem()
+    source_directory = tmp_path / 'original'
+    output_directory = tmp_path / 'merged'
+    for song in ['first', 'second']:
+        os.makedirs(source_directory / song)
+        (source_directory / song / 'drum.ogg').write_bytes(b'drum')
+        (source_directory / song / 'bass.ogg').write_bytes(b'bass')
+        os.makedirs(output_directory / song)
+        (output_directory / song / 'all.ogg').write_bytes(b'all')
+    (source_directory / 'first' / 'notes.txt').write_bytes(b'not audio')
+
+    def list_directories():
+        return group_fingerprints(list_files(fs, str(source_directory), lambda path: path.endswith('.ogg')), os.path.dirname)
+
+    fingerprints = list_directories()
+    manifest_path = get_manifest_path(str(output_directory))
+    manifest = load_manifest(fs, manifest_path)
+
+    assert sorted(get_pending_items(manifest, fingerprints, 'params')) == sorted([str(source_directory / 'first'), str(source_directory / 'second')])
+
+    outputs = [{str(source_directory / song): [str(output_directory / song / 'all.ogg')]} for song in ['first', 'second']]
+    update_manifest(fs, manifest_path, manifest, fingerprints, 'params', outputs)
+    manifest = load_manifest(fs, manifest_path)
+
+    assert get_pending_items(manifest, fingerprints, 'params') == []
+    assert len(get_pending_items(manifest, fingerprints, 'other params')) == 2
+
+    # Adding a stem changes the fingerprint of its directory only
+    (source_directory / 'second' / 'guitar.ogg').write_bytes(b'guitar')
+    fingerprints = list_directories()
+    pending_items = get_pending_items(manifest, fingerprints, 'params')
+
+    assert pending_items == [str(source_directory / 'second')]
+    assert group_sizes(list_files(fs, str(source_directory), lambda path: path.endswith('.ogg')), os.path.dirname) == {
+        str(source_directory / 'first'): 8,
+        str(source_directory / 'second'): 14,
+    }
+
+    remove_stale_outputs(fs, manifest, pending_items)
+
+    assert not (output_directory / 'second' / 'all.ogg').exists()
+    assert (output_directory / 'first' / 'all.ogg').exists()
+    assert str(source_directory / 'second') not in manifest
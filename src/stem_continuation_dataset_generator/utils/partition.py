@@ -0,0 +1,25 @@
+import heapq
+import math
+from typing import Dict, List, Tuple
+
+
+def partition_by_cost(costs: Dict[str, int], target_cost: int) -> List[List[str]]:
+    """
+    Groups the items into work units of roughly the target cost (e.g. bytes of input), so that a task is neither a
+    single short file nor a straggler. The most expensive items are assigned first, each to the least loaded unit
+    (longest processing time first). The units are returned from the most to the least expensive, so that the longest
+    ones are scheduled first instead of at the end of the run. An item more expensive than the target is a unit alone.
+    """
+    if len(costs) == 0:
+        return []
+
+    units_count = min(len(costs), max(1, math.ceil(sum(costs.values()) / target_cost)))
+    units: List[List[str]] = [[] for _ in range(units_count)]
+    unit_costs: List[Tuple[int, int]] = [(0, i) for i in range(units_count)]
+
+    for item in sorted(costs, key=lambda item: (-costs[item], item)):
+        unit_cost, i = heapq.heappop(unit_costs)
+        units[i].append(item)
+        heapq.heappush(unit_costs, (unit_cost + costs[item], i))
+
+    return [units[i] for _, i in sorted(unit_costs, key=lambda unit_cost: (-unit_cost[0], unit_cost[1]))]
@@ -0,0 +1,20 @@
+from stem_continuation_dataset_generator.utils.partition import partition_by_cost
+
+
+def test_partition_by_cost() -> None:
+    costs = {'a': 90, 'b': 50, 'c': 40, 'd': 30, 'e': 20, 'f': 10}
+
+    units = partition_by_cost(costs, target_cost=100)
+
+    # Every item is in exactly one unit, the most expensive unit comes first
+    assert sorted([item for unit in units for item in unit]) == sorted(costs)
+    assert len(units) == 3
+    assert units[0] == ['a']
+    unit_costs = [sum([costs[item] for item in unit]) for unit in units]
+    assert unit_costs == [90, 80, 70]
+
+
+def test_partition_by_cost_edge_cases() -> None:
+    assert partition_by_cost({}, target_cost=100) == []
+    assert partition_by_cost({'a': 1000, 'b': 1}, target_cost=100) == [['a'], ['b']]
+    assert partition_by_cost({'a': 0, 'b': 0}, target_cost=100) == [['a', 'b']]
@@ -0,0 +1,55 @@
+import threading
+from typing import Dict, Optional, Tuple
+import numpy as np
+
+# Kernels take and return arrays with shape (..., samples), with any strides. Interleaved (samples, channels) buffers can
+# be read or written through their planar view, so that interleaving happens during the conversion, without a copy.
+BLOCK_SIZE = 2**14  # In samples per channel, small enough for the processed block to stay in cache
+
+
+class BufferPool:
+    """Reusable buffers, one set per thread, so that converting many files does not allocate a new array each time."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get(self, name: str, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = {}
+        buffers: Dict[Tuple[str, np.dtype], np.ndarray] = self.local.buffers
+        size = int(np.prod(shape))
+        buffer = buffers.get((name, np.dtype(dtype)))
+
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            buffers[(name, np.dtype(dtype))] = buffer
+
+        return buffer[:size].reshape(shape)
+
+
+BUFFER_POOL = BufferPool()
+
+
+def planar_view(interleaved: np.ndarray) -> np.ndarray:
+    # (samples, channels) -> (channels, samples)
+    return interleaved.T
+
+
+def get_output(out: Optional[np.ndarray], shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+
+    assert out.shape == shape, f'Output has shape {out.shape}, expected {shape}'
+    assert out.dtype == dtype, f'Output has dtype {out.dtype}, expected {dtype}'
+    return out
+
+
+def clip_float(audio: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Clips the audio to [-1, 1] as float32 in a single pass. The output can be the input itself."""
+    output = get_output(out, audio.shape, np.dtype(np.float32))
+
+    for start in range(0, audio.shape[-1], BLOCK_SIZE):
+        np.clip(audio[..., start:start + BLOCK_SIZE], -1, 1, out=output[..., start:start + BLOCK_SIZE], casting='same_kind')
+
+    return output
+
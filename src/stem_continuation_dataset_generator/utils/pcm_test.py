@@ -0,0 +1,30 @@
+import numpy as np
+
+from stem_continuation_dataset_generator.utils.pcm import BLOCK_SIZE, BufferPool, clip_float, planar_view
+
+
+def test_clip_float_interleaved() -> None:
+    # Long enough to span several blocks
+    planar_audio = np.random.default_rng(0).uniform(-2, 2, (2, BLOCK_SIZE * 3 + 5)).astype(np.float32)
+    interleaved_audio = np.empty((planar_audio.shape[1], 2), dtype=np.float32)
+
+    output = clip_float(planar_audio, out=planar_view(interleaved_audio))
+
+    assert np.shares_memory(output, interleaved_audio)
+    assert np.array_equal(interleaved_audio, np.clip(planar_audio, -1, 1).T)
+
+
+def test_clip_float_in_place() -> None:
+    audio = np.array([[-3, 0.25, 3]], dtype=np.float32)
+
+    assert clip_float(audio, out=audio) is audio
+    assert audio.tolist() == [[-1, 0.25, 1]]
+
+
+def test_buffer_pool() -> None:
+    pool = BufferPool()
+    buffer = pool.get('buffer', (10, 2), np.dtype(np.float32))
+    smaller_buffer = pool.get('buffer', (5, 2), np.dtype(np.float32))
+
+    assert smaller_buffer.shape == (5, 2)
+    assert np.shares_memory(buffer, smaller_buffer)
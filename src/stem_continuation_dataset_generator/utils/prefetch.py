@@ -0,0 +1,123 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Iterator, List, Tuple, TypeVar, Union, cast
+from fsspec import AbstractFileSystem
+
+# The inputs of the next items of a task are downloaded while the current item is processed, and the outputs are
+# uploaded in the background, so that the network and the CPU of a worker are busy at the same time. The filesystem
+# calls are made from background threads: s3fs runs them on its event loop, sharing its connection pool.
+PREFETCH_ITEMS = 2  # Number of queued items whose inputs are downloaded in advance
+UPLOAD_THREADS = 4
+MAX_PENDING_UPLOADS = 8  # When reached, the task waits for the oldest upload before queueing a new one
+
+T = TypeVar('T')
+U = TypeVar('U')
+R = TypeVar('R')
+
+# Contents of the input files of an item, by path
+Inputs = Dict[str, bytes]
+
+
+def fetch_files(fs: AbstractFileSystem, paths: List[str]) -> Inputs:
+    # s3fs downloads the files of a list concurrently
+    return cast(Inputs, fs.cat(paths, on_error='raise')) if len(paths) > 0 else {}
+
+
+def prefetch(items: List[T], fetch: Callable[[T], U], window: int = PREFETCH_ITEMS) -> Iterator[Tuple[T, U]]:
+    """Yields each item with its inputs, while the inputs of the next items are being downloaded."""
+    pending_items = iter(items)
+
+    with ThreadPoolExecutor(window) as executor:
+        futures: Deque[Tuple[T, Future]] = deque([(item, executor.submit(fetch, item)) for item in islice(pending_items, window)])
+
+        while len(futures) > 0:
+            item, future = futures.popleft()
+            futures.extend([(next_item, executor.submit(fetch, next_item)) for next_item in islice(pending_items, 1)])
+            yield item, future.result()
+
+
+class UploadError(Exception):
+    """Error of a background upload, which fails the whole task since it can belong to any of its items."""
+
+
+def try_fetch(fetch: Callable[[T], U], item: T) -> Union[U, Exception]:
+    try:
+        return fetch(item)
+    except Exception as e:
+        return e
+
+
+def process_prefetched(items: List[T], fetch: Callable[[T], Inputs], process: Callable[[T, Inputs], R], description: str) -> Dict[T, R]:
+    """
+    Processes each item with its prefetched inputs. An item whose inputs cannot be downloaded or processed is reported
+    and skipped, so that it does not fail the other items of the task, and is left to the next run.
+    """
+    results: Dict[T, R] = {}
+
+    for item, inputs in prefetch(items, lambda item: try_fetch(fetch, item)):
+        try:
+            if isinstance(inputs, Exception):
+                raise inputs
+
+            results[item] = process(item, inputs)
+
+        except UploadError:
+            raise
+        except Exception as e:
+            print(f'Unable to {description} {item}: {e}')
+
+    return results
+
+
+def prefetch_each(items: List[T], fetch: Callable[[T], U], description: str, window: int = PREFETCH_ITEMS) -> Iterator[Tuple[T, U]]:
+    """
+    Yields each item with the result of its fetch, run in the background for at most `window` items ahead. An item whose
+    fetch fails is reported and skipped, and is left to the next run.
+    """
+    for item, result in prefetch(items, lambda item: try_fetch(fetch, item), window):
+        if isinstance(result, Exception):
+            print(f'Unable to {description} {item}: {result}')
+        else:
+            yield item, result
+
+
+class BackgroundUploader:
+    """Bounded queue of uploads running in background threads. Leaving the context waits for all of them and raises their first error."""
+
+    def __init__(self, fs: AbstractFileSystem, threads: int = UPLOAD_THREADS, max_pending: int = MAX_PENDING_UPLOADS):
+        self.fs = fs
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(threads)
+        self.futures: Deque[Future] = deque()
+
+    def __enter__(self) -> 'BackgroundUploader':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> None:
+        while len(self.futures) > 0 and (self.futures[0].done() or len(self.futures) >= self.max_pending):
+            self.wait_oldest()
+
+        self.futures.append(self.executor.submit(fn, *args))
+
+    def write(self, path: str, data: bytes) -> None:
+        self.submit(self.fs.pipe_file, path, data)
+
+    def copy(self, source: str, destination: str) -> None:
+        self.submit(self.fs.copy, source, destination)
+
+    def wait_oldest(self) -> None:
+        try:
+            self.futures.popleft().result()
+        except Exception as e:
+            raise UploadError(f'Upload failed: {e}') from e
+
+    def wait(self) -> None:
+        while len(self.futures) > 0:
+            self.wait_oldest()
@@ -0,0 +1,78 @@
+import os
+import threading
+from typing import List
+from fsspec.implementations.local import LocalFileSystem
+import pytest
+
+from stem_continuation_dataset_generator.utils.prefetch import BackgroundUploader, Inputs, UploadError, fetch_files, prefetch, prefetch_each, process_prefetched
+
+
+def test_prefetch(tmp_path) -> None:
+    fs = LocalFileSystem()
+    paths = [str(tmp_path / f'{i}.ogg') for i in range(5)]
+    for i, path in enumerate(paths):
+        with open(path, 'wb') as file:
+            file.write(bytes([i]))
+
+    fetched: List[str] = []
+    lock = threading.Lock()
+
+    def fetch(path: str) -> Inputs:
+        with lock:
+            fetched.append(path)
+        return fetch_files(fs, [path])
+
+    for i, (path, inputs) in enumerate(prefetch(paths, fetch, window=2)):
+        # The inputs of the current item and of at most the two next ones have been requested
+        assert inputs == {path: bytes([i])}
+        assert len(fetched) <= min(i + 3, len(paths))
+
+
+def test_background_uploader(tmp_path) -> None:
+    fs = LocalFileSystem()
+
+    with BackgroundUploader(fs, threads=2, max_pending=2) as uploader:
+        for i in range(5):
+            uploader.write(str(tmp_path / f'{i}.tok'), bytes([i]))
+
+    assert sorted(os.listdir(tmp_path)) == [f'{i}.tok' for i in range(5)]
+
+    with pytest.raises(UploadError) as error:
+        with BackgroundUploader(fs) as uploader:
+            uploader.copy(str(tmp_path / 'missing.tok'), str(tmp_path / 'copy.tok'))
+
+    assert isinstance(error.value.__cause__, FileNotFoundError)
+
+
+def test_process_prefetched(tmp_path) -> None:
+    fs = LocalFileSystem()
+    paths = [str(tmp_path / f'{i}.ogg') for i in range(4)]
+    for i, path in enumerate(paths[:3]):
+        with open(path, 'wb') as file:
+            file.write(bytes([i]))
+
+    def process(path: str, inputs: Inputs) -> int:
+        if inputs[path] == bytes([1]):
+            raise ValueError('Corrupt file')
+        return inputs[path][0]
+
+    # The missing and the corrupt files are skipped, the other files are processed
+    assert process_prefetched(paths, lambda path: fetch_files(fs, [path]), process, 'process') == {paths[0]: 0, paths[2]: 2}
+
+    def fail_upload(path: str, inputs: Inputs) -> int:
+        raise UploadError('Upload failed')
+
+    # Uploads can belong to any item, so their errors fail all the items
+    with pytest.raises(UploadError):
+        process_prefetched(paths, lambda path: fetch_files(fs, [path]), fail_upload, 'process')
+
+
+def test_prefetch_each(tmp_path) -> None:
+    fs = LocalFileSystem()
+    paths = [str(tmp_path / f'{i}.ogg') for i in range(3)]
+    for i, path in enumerate(paths[::2]):
+        with open(path, 'wb') as file:
+            file.write(bytes([i]))
+
+    # The missing file is skipped, the other ones are yielded in order
+    assert list(prefetch_each(paths, lambda path: fetch_files(fs, [path])[path], 'fetch')) == [(paths[0], bytes([0])), (paths[2], bytes([1]))]
@@ -0,0 +1,36 @@
+import random
+import time
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.  # In seconds
+RETRY_MAX_DELAY = 60.  # In seconds
+
+
+def get_backoff_delay(attempt: int, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY) -> float:
+    # Exponential backoff with full jitter, so that workers failing together do not retry together
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry(
+    fn: Callable[[], T],
+    description: str,
+    attempts: int = RETRY_ATTEMPTS,
+    base_delay: float = RETRY_BASE_DELAY,
+    max_delay: float = RETRY_MAX_DELAY,
+) -> T:
+    """Calls the function until it succeeds, waiting longer after each failure. The last error is raised."""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+
+            delay = get_backoff_delay(attempt, base_delay, max_delay)
+            print(f'{description} failed ({e}), retrying in {delay:.1f} s')
+            time.sleep(delay)
+
+    raise AssertionError('Unreachable')
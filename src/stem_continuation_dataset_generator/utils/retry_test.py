@@ -0,0 +1,23 @@
+import pytest
+
+from stem_continuation_dataset_generator.utils.retry import get_backoff_delay, retry
+
+
+def test_retry() -> None:
+    calls = []
+
+    def fail_twice() -> str:
+        calls.append(1)
+        if len(calls) < 3:
+            raise IOError('Connection reset')
+        return 'done'
+
+    assert retry(fail_twice, 'Test', base_delay=0.) == 'done'
+    assert len(calls) == 3
+
+    with pytest.raises(FileNotFoundError):
+        retry(lambda: open('/nonexistent/file'), 'Test', attempts=2, base_delay=0.)
+
+
+def test_get_backoff_delay() -> None:
+    assert all([0 <= get_backoff_delay(attempt, 1., 60.) <= min(60., 2 ** attempt) for attempt in range(10)])
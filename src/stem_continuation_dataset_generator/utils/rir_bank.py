@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+import io
+import json
+import random
+from typing import Any, Dict, List, cast
+import numpy as np
+from audiomentations import RoomSimulator
+from audiomentations.core.transforms_interface import BaseWaveformTransform
+from fsspec import AbstractFileSystem
+import scipy.signal
+import soxr
+from tqdm import tqdm
+
+from stem_continuation_dataset_generator.constants import RIR_BANK_VERSION
+
+RIR_BANK_SIZE = 256
+RIR_BANK_SAMPLE_RATE = 48000  # Sample rate of the decoded Ogg Opus files
+
+# RoomSimulator arguments used to draw the rooms of the bank, the audiomentations defaults when empty
+RIR_BANK_PARAMETERS: Dict[str, Any] = {}
+
+
+@dataclass
+class RirBank:
+    rirs: np.ndarray  # All the impulse responses, concatenated into a single float32 array
+    offsets: np.ndarray  # Start of each impulse response in rirs, followed by the total length
+    sample_rate: int
+    version: int
+    parameters: Dict[str, Any]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get(self, index: int) -> np.ndarray:
+        return self.rirs[self.offsets[index]:self.offsets[index + 1]]
+
+
+# Banks loaded by the current process, by path, so that each worker only downloads a bank once
+LOADED_RIR_BANKS: Dict[str, RirBank] = {}
+
+
+def generate_rir_bank(
+    size: int = RIR_BANK_SIZE,
+    sample_rate: int = RIR_BANK_SAMPLE_RATE,
+    parameters: Dict[str, Any] = RIR_BANK_PARAMETERS,
+    version: int = RIR_BANK_VERSION,
+) -> RirBank:
+    """
+    Simulates rooms with pyroomacoustics, drawing their dimensions, absorption and source and microphone positions with
+    RoomSimulator itself, so that the bank has the same spread of room acoustics as applying RoomSimulator directly.
+    """
+    room_simulator = RoomSimulator(p=1, **parameters)
+    samples = np.zeros(sample_rate, dtype=np.float32)
+    rirs: List[np.ndarray] = []
+
+    for _ in tqdm(range(size), desc='Simulating rooms'):
+        room_simulator.randomize_parameters(samples, sample_rate)
+        rirs.append(room_simulator.room.rir[0][0].astype(np.float32))
+
+    offsets = np.cumsum([0] + [len(rir) for rir in rirs])
+    return RirBank(np.concatenate(rirs), offsets, sample_rate, version, parameters)
+
+
+def save_rir_bank(fs: AbstractFileSystem, path: str, rir_bank: RirBank) -> None:
+    data = io.BytesIO()
+    np.savez(
+        data,
+        rirs=rir_bank.rirs,
+        offsets=rir_bank.offsets,
+        sample_rate=rir_bank.sample_rate,
+        version=rir_bank.version,
+        parameters=json.dumps(rir_bank.parameters),
+    )
+    fs.pipe_file(path, data.getvalue())
+
+
+def load_rir_bank(fs: AbstractFileSystem, path: str) -> RirBank:
+    with np.load(io.BytesIO(cast(bytes, fs.cat_file(path)))) as data:
+        return RirBank(
+            data['rirs'],
+            data['offsets'],
+            int(data['sample_rate']),
+            int(data['version']),
+            json.loads(str(data['parameters'])),
+        )
+
+
+def ensure_rir_bank(fs: AbstractFileSystem, path: str, size: int = RIR_BANK_SIZE, sample_rate: int = RIR_BANK_SAMPLE_RATE) -> None:
+    # The bank is generated once, by the driver, and then shared by all the runs using the same version
+    if not fs.exists(path):
+        print(f'Generating room impulse response bank {path}')
+        save_rir_bank(fs, path, generate_rir_bank(size, sample_rate))
+
+
+def get_rir_bank(fs: AbstractFileSystem, path: str) -> RirBank:
+    if path not in LOADED_RIR_BANKS:
+        LOADED_RIR_BANKS[path] = load_rir_bank(fs, path)
+
+    return LOADED_RIR_BANKS[path]
+
+
+def get_rir(rir_bank: RirBank, index: int, sample_rate: int) -> np.ndarray:
+    rir = rir_bank.get(index)
+    return soxr.resample(rir, rir_bank.sample_rate, sample_rate) if sample_rate != rir_bank.sample_rate else rir
+
+
+def convolve_rir(samples: np.ndarray, rir: np.ndarray) -> np.ndarray:
+    # Overlap-add FFT convolution of each channel, truncated to the input length like RoomSimulator(leave_length_unchanged=True)
+    kernel = rir.reshape((1,) * (samples.ndim - 1) + (-1,))
+    return scipy.signal.oaconvolve(samples, kernel, axes=-1)[..., :samples.shape[-1]].astype(np.float32)
+
+
+class ApplyRirBank(BaseWaveformTransform):
+    """Applies a random room impulse response of a precomputed bank, as a cheaper replacement for RoomSimulator."""
+
+    supports_multichannel = True
+
+    def __init__(self, rir_bank: RirBank, p: float = 0.5):
+        super().__init__(p)
+        self.rir_bank = rir_bank
+
+    def randomize_parameters(self, samples: np.ndarray, sample_rate: int):
+        super().randomize_parameters(samples, sample_rate)
+        if self.parameters['should_apply']:
+            self.parameters['rir_index'] = random.randrange(len(self.rir_bank))
+
+    def apply(self, samples: np.ndarray, sample_rate: int) -> np.ndarray:
+        return convolve_rir(samples, get_rir(self.rir_bank, self.parameters['rir_index'], sample_rate))
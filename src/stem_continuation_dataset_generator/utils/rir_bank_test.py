@@ -0,0 +1,47 @@
+import random
+import numpy as np
+import scipy.signal
+from fsspec.implementations.local import LocalFileSystem
+
+from stem_continuation_dataset_generator.utils.rir_bank import ApplyRirBank, convolve_rir, generate_rir_bank, load_rir_bank, save_rir_bank
+
+SAMPLE_RATE = 8000
+
+
+def test_save_and_load_rir_bank(tmp_path) -> None:
+    fs = LocalFileSystem()
+    path = str(tmp_path / 'rir-bank-v1.npz')
+    random.seed(0)
+    rir_bank = generate_rir_bank(size=3, sample_rate=SAMPLE_RATE)
+
+    save_rir_bank(fs, path, rir_bank)
+    loaded_rir_bank = load_rir_bank(fs, path)
+
+    assert len(loaded_rir_bank) == 3
+    assert loaded_rir_bank.sample_rate == SAMPLE_RATE
+    assert loaded_rir_bank.version == rir_bank.version
+    assert all([np.array_equal(loaded_rir_bank.get(i), rir_bank.get(i)) for i in range(3)])
+
+
+def test_convolve_rir() -> None:
+    rng = np.random.default_rng(0)
+    audio = rng.uniform(-0.5, 0.5, (2, SAMPLE_RATE * 2)).astype(np.float32)
+    rir = rng.uniform(-0.1, 0.1, 3000).astype(np.float32)
+
+    convolved = convolve_rir(audio, rir)
+
+    # Same as the direct convolution of each channel done by RoomSimulator, truncated to the input length
+    assert convolved.shape == audio.shape and convolved.dtype == np.float32
+    assert np.allclose(convolved[1], scipy.signal.convolve(audio[1], rir)[:audio.shape[1]], atol=1e-5)
+
+
+def test_apply_rir_bank() -> None:
+    random.seed(0)
+    rir_bank = generate_rir_bank(size=2, sample_rate=SAMPLE_RATE)
+    audio = np.random.default_rng(0).uniform(-0.5, 0.5, (2, SAMPLE_RATE)).astype(np.float32)
+    transform = ApplyRirBank(rir_bank, p=1)
+
+    distorted = transform(audio, SAMPLE_RATE)
+
+    assert distorted.shape == audio.shape
+    assert np.allclose(distorted, convolve_rir(audio, rir_bank.get(transform.parameters['rir_index'])))
@@ -0,0 +1,91 @@
+from dataclasses import asdict, dataclass
+import json
+from typing import BinaryIO, Dict, List, Tuple, Union
+from fsspec import AbstractFileSystem
+import numpy as np
+import soundfile
+
+SILENCE_FRAME_DURATION = 0.05  # In seconds
+SILENCE_TOP_DB = 60
+FRAMES_PER_BLOCK = 1024
+MIN_ENERGY = 1e-10
+
+
+@dataclass
+class SilenceInfo:
+    non_silent_ratio: float
+    intervals: List[Tuple[int, int]]  # Start and end sample of each non-silent interval, at the file's native sample rate
+    sample_rate: int
+    fingerprint: str = ''  # Fingerprint of the file when it was analyzed (see list_files), the entry is stale once it changes
+
+
+SilenceIndex = Dict[str, SilenceInfo]
+
+
+def get_frames_energy(block: np.ndarray, frame_length: int) -> np.ndarray:
+    mono_block = block.mean(axis=1) if block.ndim > 1 else block
+    frames_no = -(-len(mono_block) // frame_length)
+    padded_block = np.zeros(frames_no * frame_length, dtype=np.float32)
+    padded_block[:len(mono_block)] = mono_block
+    return np.mean(np.square(padded_block.reshape((frames_no, frame_length))), axis=1)
+
+
+def get_non_silent_intervals(non_silent_frames: np.ndarray, frame_length: int, no_of_samples: int) -> List[Tuple[int, int]]:
+    # Find the boundaries of the runs of consecutive non-silent frames
+    edges = np.diff(np.concatenate([[0], non_silent_frames.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return [(int(start * frame_length), int(min(end * frame_length, no_of_samples))) for start, end in zip(starts, ends)]
+
+
+def detect_silence(file: Union[BinaryIO, str], top_db: float = SILENCE_TOP_DB) -> SilenceInfo:
+    """
+    Streams the file at its native sample rate, computing the energy of fixed-size frames. Frames whose energy is more than
+    `top_db` decibels below the loudest frame are considered silent, as in `librosa.effects.split`.
+    """
+    energies: List[np.ndarray] = []
+    no_of_samples = 0
+
+    with soundfile.SoundFile(file) as audio_file:
+        sample_rate = audio_file.samplerate
+        frame_length = max(1, int(sample_rate * SILENCE_FRAME_DURATION))
+
+        for block in audio_file.blocks(blocksize=frame_length * FRAMES_PER_BLOCK, dtype='float32'):
+            energies.append(get_frames_energy(block, frame_length))
+            no_of_samples += len(block)
+
+    frames_energy = np.concatenate(energies) if len(energies) > 0 else np.zeros(0, dtype=np.float32)
+
+    if len(frames_energy) == 0:
+        return SilenceInfo(non_silent_ratio=0, intervals=[], sample_rate=sample_rate)
+
+    reference_energy = max(float(np.max(frames_energy)), MIN_ENERGY)
+    frames_db = 10 * np.log10(np.maximum(frames_energy, MIN_ENERGY) / reference_energy)
+    non_silent_frames = frames_db > -top_db
+    intervals = get_non_silent_intervals(non_silent_frames, frame_length, no_of_samples)
+    non_silent_samples = sum([end - start for (start, end) in intervals])
+
+    return SilenceInfo(non_silent_ratio=non_silent_samples / no_of_samples, intervals=intervals, sample_rate=sample_rate)
+
+
+def load_silence_index(fs: AbstractFileSystem, index_path: str) -> SilenceIndex:
+    if not fs.exists(index_path):
+        return {}
+
+    with fs.open(index_path, 'r') as index_file:
+        entries = json.load(index_file)
+
+    return {
+        file_path: SilenceInfo(
+            non_silent_ratio=entry['non_silent_ratio'],
+            intervals=[(start, end) for start, end in entry['intervals']],
+            sample_rate=entry['sample_rate'],
+            fingerprint=entry.get('fingerprint', ''),  # Entries saved without a fingerprint are analyzed again
+        )
+        for file_path, entry in entries.items()
+    }
+
+
+def save_silence_index(fs: AbstractFileSystem, index_path: str, index: SilenceIndex) -> None:
+    with fs.open(index_path, 'w') as index_file:
+        json.dump({file_path: asdict(info) for file_path, info in index.items()}, index_file)
@@ -0,0 +1,45 @@
+import io
+from fsspec.implementations.local import LocalFileSystem
+import numpy as np
+import soundfile
+
+from stem_continuation_dataset_generator.utils.silence import SilenceInfo, detect_silence, load_silence_index, save_silence_index
+
+SAMPLE_RATE = 48000
+
+
+def get_wav_file(audio: np.ndarray) -> io.BytesIO:
+    file = io.BytesIO()
+    soundfile.write(file, audio, SAMPLE_RATE, format='WAV', subtype='FLOAT')
+    file.seek(0)
+    return file
+
+
+def test_detect_silence() -> None:
+    time = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+    tone = 0.5 * np.sin(2 * np.pi * 440 * time)
+    silence = np.zeros(SAMPLE_RATE * 3)
+    audio = np.stack([np.concatenate([silence, tone])] * 2, axis=1)
+
+    silence_info = detect_silence(get_wav_file(audio))
+
+    assert silence_info.sample_rate == SAMPLE_RATE
+    assert silence_info.intervals == [(3 * SAMPLE_RATE, 4 * SAMPLE_RATE)]
+    assert silence_info.non_silent_ratio == 0.25
+
+
+def test_detect_silence_empty_file() -> None:
+    silence_info = detect_silence(get_wav_file(np.zeros((0, 2))))
+
+    assert silence_info.non_silent_ratio == 0
+    assert silence_info.intervals == []
+
+
+def test_silence_index(tmp_path) -> None:
+    fs = LocalFileSystem()
+    index_path = str(tmp_path / 'silence-index.json')
+    index = {'artist/song/drum.ogg': SilenceInfo(non_silent_ratio=0.5, intervals=[(0, 10), (20, 30)], sample_rate=SAMPLE_RATE, fingerprint='etag:1024')}
+
+    assert load_silence_index(fs, index_path) == {}
+    save_silence_index(fs, index_path, index)
+    assert load_silence_index(fs, index_path) == index
@@ -0,0 +1,61 @@
+from typing import Optional
+import numpy as np
+import scipy.signal
+
+# Stateful kernels processing audio blocks with shape (channels, samples), so that a whole track never has to be in
+# memory. Processing the blocks of a track one at a time gives the same result as processing the track at once.
+
+
+class StreamingSosFilter:
+    """Filters blocks with cascaded second order sections, carrying the filter state across blocks."""
+
+    def __init__(self, sos: np.ndarray):
+        self.sos = sos
+        self.state: Optional[np.ndarray] = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if self.state is None:
+            # Steady state for the first sample of each channel, as done by audiomentations
+            self.state = scipy.signal.sosfilt_zi(self.sos)[:, np.newaxis, :] * block[np.newaxis, :, :1]
+
+        filtered, self.state = scipy.signal.sosfilt(self.sos, block, axis=-1, zi=self.state)
+        return filtered.astype(np.float32)
+
+
+class StreamingConvolver:
+    """Convolves blocks with an impulse response by overlap-add, carrying the tail of each block over to the next ones."""
+
+    def __init__(self, impulse_response: np.ndarray):
+        self.impulse_response = impulse_response
+        self.tail: Optional[np.ndarray] = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        kernel = self.impulse_response.reshape((1,) * (block.ndim - 1) + (-1,))
+        convolved = scipy.signal.oaconvolve(block, kernel, axes=-1)
+
+        if self.tail is not None:
+            convolved[..., :self.tail.shape[-1]] += self.tail
+
+        # The tail left after the last block is dropped, so that the output has the same length as the input
+        self.tail = convolved[..., block.shape[-1]:]
+        return convolved[..., :block.shape[-1]].astype(np.float32)
+
+
+def get_block_noise(seed: int, block_index: int, shape: tuple, std: float) -> np.ndarray:
+    # The noise of a block only depends on the seed and on the index of the block, not on the blocks processed before it
+    rng = np.random.default_rng([seed, block_index])
+    return rng.standard_normal(shape, dtype=np.float32) * np.float32(std)
+
+
+class RmsAccumulator:
+
+    def __init__(self):
+        self.sum_of_squares = 0.
+        self.count = 0
+
+    def add(self, block: np.ndarray) -> None:
+        self.sum_of_squares += float(np.sum(np.square(block, dtype=np.float64)))
+        self.count += block.size
+
+    def get_rms(self) -> float:
+        return float(np.sqrt(self.sum_of_squares / self.count)) if self.count > 0 else 0.
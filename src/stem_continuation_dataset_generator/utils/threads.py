@@ -0,0 +1,21 @@
+import os
+from typing import Dict
+from threadpoolctl import threadpool_limits
+import torch
+
+THREAD_ENVIRONMENT_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def get_thread_environment(threads: int) -> Dict[str, str]:
+    return {name: str(threads) for name in THREAD_ENVIRONMENT_VARIABLES}
+
+
+def pin_threads(threads: int) -> None:
+    """
+    Limits the threads used by a worker process for numerical computations, so that the processes of a machine do not
+    oversubscribe its cores. The BLAS and OpenMP libraries already loaded are limited directly, the environment
+    variables apply to the libraries loaded afterwards.
+    """
+    os.environ.update(get_thread_environment(threads))
+    threadpool_limits(threads)
+    torch.set_num_threads(threads)